@@ -37,8 +37,13 @@ export class Fleet extends Construct {
       handler: 'fleethandler.on_event',
     });
 
+    // vehicles not associated before on_event times out are handed to is_complete
+    const isCompleteHandler = new Handler(this, 'IsCompleteHandler', {
+      handler: 'fleethandler.is_complete',
+    });
+
     const resource = new cdk.CustomResource(this, 'Resource', {
-      serviceToken: Provider.getOrCreate(this, handler).provider.serviceToken,
+      serviceToken: Provider.getOrCreate(this, handler, isCompleteHandler).provider.serviceToken,
       properties: {
         fleet_id: this.fleetId,
         signal_catalog_arn: this.signalCatalog.arn,
@@ -1,85 +1,253 @@
 from pydoc import describe
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+
+# concurrent vehicle association: calls run on ASSOCIATION_WORKERS threads, paced by an adaptive rate limiter that
+# halves its rate on throttling and grows it back on success. A throttled call, or one that failed with a transient
+# service or connection error, is retried with a jittered backoff.
+# The work stops DEADLINE_MARGIN_MS before the lambda times out, the vehicles left are handed to is_complete
+ASSOCIATION_WORKERS = 16
+INITIAL_RATE = 10.0        # calls per second
+MIN_RATE = 1.0
+MAX_RATE = 50.0
+RATE_INCREASE = 1.0        # calls per second added after each successful call
+RATE_DECREASE_COOLDOWN = 1.0   # seconds, the calls in flight when throttled halve the rate once
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 0.2         # seconds
+BACKOFF_CAP = 10.0
+DEADLINE_MARGIN_MS = 30000
+
+THROTTLING_ERRORS = ('ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded')
+TRANSIENT_ERRORS = ('InternalServerException', 'InternalFailure', 'InternalError', 'ServiceUnavailableException',
+                    'ServiceUnavailable', 'RequestTimeout', 'RequestTimeoutException')
+# EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError, ConnectionClosedError...
+CONNECTION_ERRORS = (BotoConnectionError, HTTPClientError)
+
+# per-vehicle outcomes
+DONE = 'done'
+PENDING = 'pending'
 
 def on_event(event, context):
     print(f'on_event {event} {context}')
     request_type = event['RequestType']
-    if request_type == 'Create': 
-        return on_create(event)
-    if request_type == 'Update': 
-        return on_update(event)
-    if request_type == 'Delete': 
-        return on_delete(event)
+    if request_type == 'Create':
+        return on_create(event, context)
+    if request_type == 'Update':
+        return on_update(event, context)
+    if request_type == 'Delete':
+        return on_delete(event, context)
     raise Exception("Invalid request type: {request_type}")
 
-def on_create(event):
+def on_create(event, context):
     props = event["ResourceProperties"]
     print(f"create new resource with props {props}")
-    client=boto3.client('iotfleetwise')
-    
+    client=fleetwise_client()
+
     response = client.create_fleet(
       fleetId = props['fleet_id'],
       description = props['description'],
       signalCatalogArn = props['signal_catalog_arn'],
     )
     print(f"create_fleet response {response}")
-    
-    for name in props['vehicle_names']:
-      print(f"associating vehicle {name} to fleet {props['fleet_id']}")    
-      response = client.associate_vehicle_fleet(
-        fleetId = props['fleet_id'],
-        vehicleName = name,
-      )
-      print(f"associate_vehicle response {response}")      
-
-    return { 'PhysicalResourceId': props['fleet_id'] }
-
-def on_update(event):
+
+    results = update_vehicles(association_client(), props['fleet_id'], props['vehicle_names'], [], deadline(context))
+    return { 'PhysicalResourceId': props['fleet_id'], 'Data': summary(results) }
+
+def on_update(event, context):
     physical_id = event["PhysicalResourceId"]
     props = event["ResourceProperties"]
     old_props = event["OldResourceProperties"]
     c = Counter(props['vehicle_names'])
     c.subtract(old_props['vehicle_names'])
-    client=boto3.client('iotfleetwise')
-    for vehicleName, operation in c.items():
-        if operation == -1:
-            print(f"removing {vehicleName} to {props['fleet_id']}")
-            response = client.disassociate_vehicle_fleet(
-                fleetId = props['fleet_id'],
-                vehicleName = vehicleName)
-            print(f"disassociate_vehicle response {response}")
-        elif operation == 1:
-            print(f"adding {vehicleName} to {props['fleet_id']}")
-            response = client.associate_vehicle_fleet(
-                fleetId = props['fleet_id'],
-                vehicleId = vehicleName)
-            print(f"associate_vehicle response {response}")            
-        
-    print(f"update resource {physical_id} with props {props}")
-    #raise Exception("update not implemented yet")
-    return { 'PhysicalResourceId': physical_id }
+    to_associate = [vehicleName for vehicleName, operation in c.items() if operation == 1]
+    to_disassociate = [vehicleName for vehicleName, operation in c.items() if operation == -1]
+    print(f"update resource {physical_id} adding {to_associate} removing {to_disassociate} to {props['fleet_id']}")
+    results = update_vehicles(association_client(), props['fleet_id'], to_associate, to_disassociate, deadline(context))
+    return { 'PhysicalResourceId': physical_id, 'Data': summary(results) }
 
-def on_delete(event):
+def on_delete(event, context):
     physical_id = event["PhysicalResourceId"]
     props = event["ResourceProperties"]
     print(f"delete resource {props['fleet_id']} {physical_id}")
-    client=boto3.client('iotfleetwise')
-
-    print(f"list_vehicles_in_fleet {props['fleet_id']}")
-    response = client.list_vehicles_in_fleet(fleetId = props['fleet_id'])
-    print(f"list_vehicles_in_fleet response {response}")
-    for v in response["vehicles"]:
-        print(f"disassociate_vehicle_fleet {v} from {props['fleet_id']}")
-        response = client.disassociate_vehicle_fleet(
-            fleetId = props['fleet_id'],
-            vehicleName = v)
-        print(f"disassociate_vehicle_fleet response {response}")
-
-    print(f"delete_fleet {props['fleet_id']}")    
+    delete_fleet(fleetwise_client(), association_client(), props['fleet_id'], deadline(context))
+    return { 'PhysicalResourceId': physical_id }
+
+def delete_fleet(client, association, fleet_id, stop_at):
+    """
+    Disassociates every vehicle of the fleet with the association client, then deletes it
+    :return: True if the fleet is deleted, False if vehicles are left at stop_at
+    """
+    try:
+        vehicles = list_fleet_vehicles(client, fleet_id)
+    except client.exceptions.ResourceNotFoundException:
+        print(f"fleet {fleet_id} already deleted")
+        return True
+    print(f"list_vehicles_in_fleet {fleet_id}: {len(vehicles)} vehicles")
+    results = update_vehicles(association, fleet_id, [], sorted(vehicles), stop_at)
+    if any(outcome == PENDING for outcome in results.values()):
+        return False
+
+    print(f"delete_fleet {fleet_id}")
     response = client.delete_fleet(
-      fleetId = props['fleet_id'],
+      fleetId = fleet_id,
     )
     print(f"delete_fleet response {response}")
+    return True
 
-    return { 'PhysicalResourceId': physical_id }
+def is_complete(event, context):
+    physical_id = event["PhysicalResourceId"]
+    props = event["ResourceProperties"]
+    print(f"is_complete for resource {physical_id} with props {props}")
+    client=fleetwise_client()
+    if event['RequestType'] == 'Delete':
+        return { 'IsComplete': delete_fleet(client, association_client(), props['fleet_id'], deadline(context)) }
+
+    # the fleet is listed again, so the vehicles left are those on_event or a previous check could not update
+    fleet_vehicles = list_fleet_vehicles(client, props['fleet_id'])
+    to_associate = [v for v in props['vehicle_names'] if v not in fleet_vehicles]
+    to_disassociate = []
+    if event['RequestType'] == 'Update':
+        to_disassociate = [v for v in event['OldResourceProperties']['vehicle_names']
+                           if v in fleet_vehicles and v not in props['vehicle_names']]
+    if not to_associate and not to_disassociate:
+        return { 'IsComplete': True }
+
+    print(f"is_complete adding {len(to_associate)} removing {len(to_disassociate)} vehicles to {props['fleet_id']}")
+    results = update_vehicles(association_client(), props['fleet_id'], to_associate, to_disassociate,
+                              deadline(context))
+    return { 'IsComplete': all(outcome == DONE for outcome in results.values()), 'Data': summary(results) }
+
+def fleetwise_client():
+    # botocore retries throttled, transient and connection errors of the fleet calls
+    return boto3.client('iotfleetwise', config=Config(
+        retries={'max_attempts': 5, 'mode': 'standard'},
+    ))
+
+def association_client():
+    # the association engine retries throttled, transient and connection errors itself, botocore retries would hide
+    # throttling from the limiter
+    return boto3.client('iotfleetwise', config=Config(
+        retries={'max_attempts': 1, 'mode': 'standard'},
+        max_pool_connections=ASSOCIATION_WORKERS,
+    ))
+
+def deadline(context):
+    """
+    :return: the time.monotonic() at which the work stops, DEADLINE_MARGIN_MS before the lambda times out
+    """
+    return time.monotonic() + (context.get_remaining_time_in_millis() - DEADLINE_MARGIN_MS) / 1000.0
+
+def list_fleet_vehicles(client, fleet_id):
+    vehicles = set()
+    kwargs = {'fleetId': fleet_id}
+    while True:
+        response = client.list_vehicles_in_fleet(**kwargs)
+        vehicles.update(response['vehicles'])
+        if not response.get('nextToken'):
+            return vehicles
+        kwargs['nextToken'] = response['nextToken']
+
+def summary(results):
+    """
+    :return: the count of vehicles per outcome, the custom resource Data
+    """
+    return dict(Counter(outcome if outcome in (DONE, PENDING) else 'failed' for outcome in results.values()))
+
+def update_vehicles(client, fleet_id, to_associate, to_disassociate, stop_at):
+    """
+    Associates and disassociates vehicles to the fleet concurrently until stop_at
+    :return: {vehicle name: outcome}, DONE, PENDING when stop_at came first or the retries ran out, or the error of
+    the vehicle. Raises when a vehicle failed with a non-retryable error
+    """
+    limiter = RateLimiter(INITIAL_RATE, MIN_RATE, MAX_RATE)
+    calls = [(name, client.associate_vehicle_fleet) for name in to_associate] + \
+            [(name, client.disassociate_vehicle_fleet) for name in to_disassociate]
+    with ThreadPoolExecutor(max_workers=ASSOCIATION_WORKERS) as executor:
+        futures = {name: executor.submit(call_with_retries, call, fleet_id, name, limiter, stop_at)
+                   for name, call in calls}
+    results = {name: future.result() for name, future in futures.items()}
+
+    for name, outcome in results.items():
+        print(f"{fleet_id} vehicle {name}: {outcome}")
+    print(f"{fleet_id} vehicles {summary(results)}, final rate {limiter.rate:.1f}/s")
+    failed = {name: outcome for name, outcome in results.items() if outcome not in (DONE, PENDING)}
+    if failed:
+        raise Exception(f"Vehicle association to fleet {fleet_id} has failed {failed}")
+    return results
+
+def call_with_retries(call, fleet_id, name, limiter, stop_at):
+    """
+    :return: DONE, PENDING if the call is still throttled or failing with a transient error at the last attempt or at
+    stop_at, otherwise the error of the call
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        if not limiter.acquire(stop_at):
+            return PENDING
+        try:
+            call(fleetId = fleet_id, vehicleName = name)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in THROTTLING_ERRORS:
+                limiter.throttled()
+            elif code not in TRANSIENT_ERRORS:
+                return f"{code}: {e.response['Error'].get('Message')}"
+            print(f"{fleet_id} vehicle {name}: retrying {code}")
+        except CONNECTION_ERRORS as e:
+            print(f"{fleet_id} vehicle {name}: retrying {e.__class__.__name__}")
+        except BotoCoreError as e:
+            return f"{e.__class__.__name__}: {e}"
+        else:
+            limiter.succeeded()
+            return DONE
+        # full jitter: concurrent calls throttled together do not retry together
+        backoff = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+        if time.monotonic() + backoff >= stop_at:
+            return PENDING
+        time.sleep(backoff)
+    # still failing, is_complete will try again
+    return PENDING
+
+class RateLimiter:
+    """
+    Paces calls from several threads at rate calls per second: additive increase on success,
+    multiplicative decrease on throttling
+    """
+
+    def __init__(self, rate, min_rate, max_rate):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._next_call = time.monotonic()
+        self._decreased_at = None
+        self._lock = threading.Lock()
+
+    def acquire(self, stop_at):
+        """
+        Waits for the next call slot
+        :return: False if the slot comes after stop_at
+        """
+        with self._lock:
+            slot = max(self._next_call, time.monotonic())
+            if slot >= stop_at:
+                return False
+            self._next_call = slot + 1.0 / self.rate
+        time.sleep(max(0.0, slot - time.monotonic()))
+        return True
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def throttled(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._decreased_at is None or now - self._decreased_at >= RATE_DECREASE_COOLDOWN:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._decreased_at = now
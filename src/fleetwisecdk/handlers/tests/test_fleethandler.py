@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+# ---------------------------------------------------------------------------
+#   Retries of the fleet vehicle association, against a fake FleetWise client. From the handlers directory:
+#     python -m unittest discover -s tests
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from botocore.exceptions import ClientError, EndpointConnectionError, ParamValidationError, ReadTimeoutError  # noqa: E402
+
+import fleethandler  # noqa: E402
+from fleethandler import DONE, PENDING  # noqa: E402
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'AssociateVehicleFleet')
+
+
+class FakeFleetWiseClient:
+    """
+    Raises the errors given for a vehicle, one per call, then succeeds
+    """
+
+    def __init__(self, errors):
+        self.errors = {name: list(vehicle_errors) for name, vehicle_errors in errors.items()}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def associate_vehicle_fleet(self, fleetId, vehicleName):
+        with self._lock:
+            self.calls[vehicleName] = self.calls.get(vehicleName, 0) + 1
+            vehicle_errors = self.errors.get(vehicleName)
+            error = vehicle_errors.pop(0) if vehicle_errors else None
+        if error is not None:
+            raise error
+
+    disassociate_vehicle_fleet = associate_vehicle_fleet
+
+
+class UpdateVehiclesTest(unittest.TestCase):
+    """
+    Throttled, transient and connection errors are retried, vehicles still failing are left PENDING to is_complete
+    and the other errors fail the update
+    """
+
+    def setUp(self):
+        self.constants = {name: getattr(fleethandler, name) for name in ('INITIAL_RATE', 'MAX_RATE', 'BACKOFF_BASE')}
+        fleethandler.INITIAL_RATE = fleethandler.MAX_RATE = 1000.0
+        fleethandler.BACKOFF_BASE = 0.001
+
+    def tearDown(self):
+        for name, value in self.constants.items():
+            setattr(fleethandler, name, value)
+
+    def update(self, errors, stop_in=60.0):
+        client = FakeFleetWiseClient(errors)
+        results = fleethandler.update_vehicles(client, 'fleet', sorted(errors), [], time.monotonic() + stop_in)
+        return results, client.calls
+
+    def test_retried_errors(self):
+        results, calls = self.update({
+            'throttled': [client_error('ThrottlingException')] * 2,
+            'internal': [client_error('InternalServerException'), client_error('ServiceUnavailableException')],
+            'connection': [EndpointConnectionError(endpoint_url='https://iotfleetwise'),
+                           ReadTimeoutError(endpoint_url='https://iotfleetwise')],
+            'vehicle': [],
+        })
+        self.assertEqual(set(results.values()), {DONE})
+        self.assertEqual(calls, {'throttled': 3, 'internal': 3, 'connection': 3, 'vehicle': 1})
+
+    def test_retries_running_out(self):
+        errors = [client_error('InternalServerException')] * fleethandler.MAX_ATTEMPTS
+        results, calls = self.update({'internal': errors, 'vehicle': []})
+        self.assertEqual(results, {'internal': PENDING, 'vehicle': DONE})
+        self.assertEqual(calls['internal'], fleethandler.MAX_ATTEMPTS)
+
+    def test_deadline(self):
+        results, calls = self.update({'vehicle': []}, stop_in=0.0)
+        self.assertEqual(results, {'vehicle': PENDING})
+        self.assertEqual(calls, {})
+
+    def test_failed_vehicle(self):
+        for error in (client_error('ValidationException'), ParamValidationError(report='vehicleName')):
+            with self.subTest(error=error.__class__.__name__):
+                with self.assertRaisesRegex(Exception, 'has failed'):
+                    self.update({'failed': [error], 'vehicle': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
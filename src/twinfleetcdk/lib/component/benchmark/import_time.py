@@ -0,0 +1,134 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+# ---------------------------------------------------------------------------
+#   Import-time report of the connector Lambdas, the init phase of a cold start
+#
+#   Every module is imported in a fresh interpreter with `python -X importtime`, with the environment of its Lambda,
+#   from a copy of the connector sources compiled as in the deployment package, and the report gives per module
+#   the median total import time and the imports that take the most of it.
+#   No AWS access is needed: the timestream-query client is created on first use, unless --eager is set.
+#
+#   Usage, from this directory:
+#     python import_time.py                                    # data_reader and schema_init
+#     python import_time.py --cold                             # no bytecode shipped with the connector sources
+#     python import_time.py --eager                            # QUERY_CLIENT_INIT=eager, includes boto3 and the client
+#     python import_time.py --output report.json --budget-ms 150
+#
+#   With --budget-ms, the run exits with status 1 when the median import time of a module exceeds the budget.
+#   Run with the Python version of the Lambda runtime, import times differ between versions.
+# ---------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+COMPONENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module name: (directory of the module, additional sys.path entries), as deployed by evtwindata.ts
+MODULES = {
+    'data_reader': ('data_reader', ['udq_helper_utils']),
+    'schema_init': ('schema_initializer', ['udq_helper_utils']),
+}
+
+LAMBDA_ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_EXECUTION_ENV': 'AWS_Lambda_python3.8',
+    'TIMESTREAM_DATABASE_NAME': 'import_time',
+    'TIMESTREAM_TABLE_NAME': 'import_time',
+}
+
+
+def import_times(module, cold=False, eager=False):
+    """
+    Imports module in a fresh interpreter
+    :return: {imported module: (self microseconds, cumulative microseconds)} of every module it imported
+    """
+    directory, path = MODULES[module]
+    env = dict(os.environ, **LAMBDA_ENVIRONMENT)
+    env['QUERY_CLIENT_INIT'] = 'eager' if eager else 'lazy'
+    with tempfile.TemporaryDirectory() as base_dir:
+        # copies of the connector sources, with the bytecode shipped in the deployment package unless cold:
+        # /var/task and /opt are read-only, without shipped bytecode the sources are compiled on every cold start
+        env['PYTHONDONTWRITEBYTECODE'] = '1'
+        for entry in [directory] + path:
+            shutil.copytree(os.path.join(COMPONENT_DIR, entry), os.path.join(base_dir, entry),
+                            ignore=shutil.ignore_patterns('__pycache__', '*.pyc', '*.zip'))
+            if not cold:
+                subprocess.run([sys.executable, '-m', 'compileall', '-q', '--invalidation-mode', 'unchecked-hash',
+                                os.path.join(base_dir, entry)], check=True)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.join(base_dir, entry) for entry in path] +
+                                            ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                cwd=os.path.join(base_dir, directory), env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise Exception(f"Import of {module} failed: {result.stderr.strip().splitlines()[-1:]}")
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue  # header line
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def report(module, runs, top, cold=False, eager=False):
+    totals = []
+    self_times = {}
+    for _ in range(runs):
+        times = import_times(module, cold, eager)
+        totals.append(sum(self_us for self_us, _ in times.values()) / 1000.0)
+        for name, (self_us, _) in times.items():
+            self_times.setdefault(name, []).append(self_us / 1000.0)
+    slowest = sorted(((statistics.median(values), name) for name, values in self_times.items()), reverse=True)
+    return {
+        'total_ms': round(statistics.median(totals), 2),
+        'modules': len(self_times),
+        'top': [{'module': name, 'self_ms': round(ms, 2)} for ms, name in slowest[:top]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time report of the connector Lambdas')
+    parser.add_argument('modules', nargs='*', default=sorted(MODULES),
+                        help=f"modules to import, all by default: {', '.join(sorted(MODULES))}")
+    parser.add_argument('--runs', type=int, default=5, help='imports per module, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports listed per module')
+    parser.add_argument('--cold', action='store_true', help='compile the connector sources on import, as on a read-only /var/task')
+    parser.add_argument('--eager', action='store_true', help='create the timestream-query client at import')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    parser.add_argument('--budget-ms', type=float, help='exit with status 1 when a module imports slower than this')
+    args = parser.parse_args()
+    unknown = [module for module in args.modules if module not in MODULES]
+    if unknown:
+        parser.error(f"unknown modules: {', '.join(unknown)}")
+
+    results = {}
+    for module in args.modules:
+        results[module] = report(module, args.runs, args.top, args.cold, args.eager)
+        print(f"{module}: {results[module]['total_ms']:.1f} ms, {results[module]['modules']} modules")
+        for entry in results[module]['top']:
+            print(f"  {entry['self_ms']:8.2f} ms  {entry['module']}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'python': sys.version.split()[0], 'cold': args.cold, 'eager': args.eager,
+                       'results': results}, output, indent=2)
+
+    if args.budget_ms is not None:
+        over = [module for module, result in results.items() if result['total_ms'] > args.budget_ms]
+        if over:
+            print(f"Over the {args.budget_ms} ms import budget: {', '.join(over)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,508 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+# ---------------------------------------------------------------------------
+#   In-process stand-in for the Amazon Timestream query client, backed by SQLite
+#
+#   LocalTimestreamClient implements the subset of `timestream-query` query() used by the connector lambdas, so their
+#   query and pagination behavior can be run and profiled offline against realistic data volumes:
+#   - ColumnInfo / Rows pages, NULL values as {'NullValue': True}, times as '2022-04-06 00:17:45.419000000'
+#   - MaxRows / NextToken pagination, NextTokens can be reused, and optional empty leading pages as returned by
+#     Timestream while a query is still running
+#   - optionally, with shuffle_ties, rows tying on the ORDER BY columns in a random order on every query, as
+#     Timestream does not order them
+#   - the Timestream functions used by the connectors: from_iso8601_timestamp, from_milliseconds, from_nanoseconds,
+#     ago, now and bin, and DESCRIBE of the table
+#   Queries are translated into SQLite and run against one table holding single-measure and multi-measure records.
+#
+#   Usage:
+#     client = LocalTimestreamClient('fleet', 'telemetry')
+#     populate(client, vehicles=10, measures=60, seconds=3600)   # or client.write_records(...) / client.insert_page(...)
+#     install(client, data_reader, schema_init)                  # replaces their QUERY_CLIENT
+#
+#   Or from this directory, to run a query against a generated table:
+#     python local_timestream.py --vehicles 2 --measures 6 --seconds 600 "SELECT count(*) FROM fleet.telemetry"
+# ---------------------------------------------------------------------------
+
+import argparse
+import calendar
+import itertools
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# value columns of single-measure records, per MeasureValueType
+MEASURE_VALUE_TYPES = {
+    'DOUBLE': 'double',
+    'BIGINT': 'bigint',
+    'BOOLEAN': 'boolean',
+    'VARCHAR': 'varchar',
+}
+
+# SQLite column declarations keep the Timestream type name, so the types are restored from an existing SQLite file
+SQLITE_TYPES = {
+    'double': 'DOUBLE',
+    'bigint': 'BIGINT',
+    'boolean': 'BOOLEAN',
+    'varchar': 'VARCHAR',
+    'timestamp': 'INTEGER',
+}
+
+TIME_UNITS = {
+    'NANOSECONDS': 1,
+    'MICROSECONDS': 1000,
+    'MILLISECONDS': 1000000,
+    'SECONDS': 1000000000,
+}
+
+# duration literals of ago() and bin(), e.g. 15m
+DURATION_UNITS = {
+    'ns': 1,
+    'us': 1000,
+    'ms': 1000000,
+    's': 1000000000,
+    'm': 60 * 1000000000,
+    'h': 3600 * 1000000000,
+    'd': 86400 * 1000000000,
+}
+
+DURATION = r'(\d+)(ns|us|ms|s|m|h|d)'
+
+# a trailing ORDER BY clause, the ties of its columns are shuffled by appending random() to it
+ORDER_BY_PATTERN = re.compile(r'\bORDER\s+BY\s+(?:(?!\bLIMIT\b)[^()])*$', re.IGNORECASE)
+
+# string literals and quoted identifiers are kept as is by the translation, only the SQL around them is rewritten
+QUOTED_PATTERN = re.compile(r"('(?:[^']|'')*')|(\"(?:[^\"]|\"\")*\")")
+
+
+def duration_nanoseconds(count, unit) -> int:
+    return int(count) * DURATION_UNITS[unit]
+
+
+def iso8601_to_nanoseconds(value: str) -> int:
+    """
+    e.g. '2022-04-06T00:17:45.419Z' -> 1649204265419000000
+    """
+    date_part, _, fraction = value.strip().rstrip('Z').replace(' ', 'T').partition('.')
+    seconds = calendar.timegm(time.strptime(date_part, '%Y-%m-%dT%H:%M:%S'))
+    return seconds * 1000000000 + int(fraction.ljust(9, '0')[:9])
+
+
+def nanoseconds_to_timestream_time(value: int) -> str:
+    """
+    e.g. 1649204265419000000 -> '2022-04-06 00:17:45.419000000'
+    """
+    seconds, nanoseconds = divmod(int(value), 1000000000)
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds)) + '.%09d' % nanoseconds
+
+
+class LocalTimestreamClient:
+    """
+    A timestream-query client answering queries on database_name.table_name from a SQLite database
+
+    path is ':memory:' or a SQLite file, page_rows the page size when MaxRows is not given and empty_pages the number
+    of empty pages (with a NextToken) returned before the first rows of every query. The results of the last
+    max_results queries are kept for their NextTokens. With shuffle_ties, the rows of a query that tie on its ORDER BY
+    columns come in a random order. The client can be shared by threads like a boto3 client
+    """
+
+    DIMENSIONS = ('vehicleName', 'campaignName')
+
+    def __init__(self, database_name, table_name, path=':memory:', page_rows=1000, empty_pages=0, max_results=64,
+                 shuffle_ties=False):
+        self.database_name = database_name
+        self.table_name = table_name
+        self.page_rows = page_rows
+        self.empty_pages = empty_pages
+        self.shuffle_ties = shuffle_ties
+        self.max_results = max_results
+        self.calls = 0
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._query_ids = itertools.count(1)
+
+        # Timestream type and attribute type of every column, see describe()
+        self.column_types = {name: 'varchar' for name in self.DIMENSIONS}
+        self.column_types.update({'measure_name': 'varchar', 'time': 'timestamp'})
+        self.attribute_types = {name: 'DIMENSION' for name in self.DIMENSIONS}
+        self.attribute_types.update({'measure_name': 'MEASURE_NAME', 'time': 'TIMESTAMP'})
+
+        columns = [f'"{name}" VARCHAR' for name in self.DIMENSIONS] + ['measure_name VARCHAR', 'time INTEGER NOT NULL']
+        columns += [f'"measure_value::{value_type}" {SQLITE_TYPES[value_type]}' for value_type in MEASURE_VALUE_TYPES.values()]
+        with self._lock:
+            existing = self._connection.execute('SELECT name FROM sqlite_master WHERE type = ? AND name = ?',
+                                                ('table', self._sqlite_table)).fetchone()
+            if existing is None:
+                self._connection.execute(f'CREATE TABLE "{self._sqlite_table}" ({", ".join(columns)})')
+                self._connection.execute(f'CREATE INDEX "{self._sqlite_table}_vehicle_time" ON "{self._sqlite_table}" (vehicleName, time)')
+                self._connection.execute(f'CREATE INDEX "{self._sqlite_table}_measure_time" ON "{self._sqlite_table}" (measure_name, time)')
+            else:
+                self._load_schema()
+
+    @property
+    def _sqlite_table(self):
+        return f'{self.database_name}.{self.table_name}'
+
+    def _load_schema(self):
+        """
+        Restores the column types of an existing SQLite file, measure columns of multi-measure records included
+        """
+        for _, name, declared, *_ in self._connection.execute(f'PRAGMA table_info("{self._sqlite_table}")'):
+            if name.startswith('measure_value::'):
+                # only written value types are described, like Timestream does
+                if self._connection.execute(f'SELECT 1 FROM "{self._sqlite_table}" WHERE "{name}" IS NOT NULL LIMIT 1').fetchone():
+                    self.column_types[name] = name.partition('::')[2]
+                    self.attribute_types[name] = 'MEASURE_VALUE'
+            elif name not in self.column_types:
+                self.column_types[name] = declared.lower()
+                self.attribute_types[name] = 'MULTI'
+
+    # ---------------------------------------------------------------------------
+    #   writes
+    # ---------------------------------------------------------------------------
+
+    def write_records(self, records, common_attributes=None):
+        """
+        Writes records in the shape of the timestream-write WriteRecords API, single-measure and MULTI records
+        see https://docs.aws.amazon.com/timestream/latest/developerguide/API_WriteRecords.html
+        """
+        rows = []
+        for record in records:
+            if common_attributes:
+                record = dict(common_attributes, **record)
+            row = {dimension['Name']: dimension['Value'] for dimension in record.get('Dimensions', [])}
+            row['measure_name'] = record['MeasureName']
+            row['time'] = int(record['Time']) * TIME_UNITS[record.get('TimeUnit', 'MILLISECONDS')]
+            if record['MeasureValueType'] == 'MULTI':
+                for measure in record['MeasureValues']:
+                    value_type = MEASURE_VALUE_TYPES[measure['Type']]
+                    self._add_column(measure['Name'], value_type, 'MULTI')
+                    row[measure['Name']] = self._sqlite_value(measure['Value'], value_type)
+            else:
+                value_type = MEASURE_VALUE_TYPES[record['MeasureValueType']]
+                name = f'measure_value::{value_type}'
+                self._add_column(name, value_type, 'MEASURE_VALUE')
+                row[name] = self._sqlite_value(record['MeasureValue'], value_type)
+            rows.append(row)
+        self._insert(rows)
+
+    def insert_page(self, query_result_page):
+        """
+        Inserts the rows of a query page, e.g. the recorded output of `aws timestream-query query`
+        Columns other than the dimensions, measure_name, time and the measure_value columns are multi-measure columns
+        """
+        names = [info['Name'] for info in query_result_page['ColumnInfo']]
+        for info in query_result_page['ColumnInfo']:
+            name = info['Name']
+            value_type = info['Type'].get('ScalarType', 'VARCHAR').lower()
+            if name.startswith('measure_value::'):
+                self._add_column(name, value_type, 'MEASURE_VALUE')
+            elif name not in self.column_types:
+                self._add_column(name, value_type, 'MULTI')
+
+        rows = []
+        for query_row in query_result_page['Rows']:
+            row = {}
+            for name, datum in zip(names, query_row['Data']):
+                value = datum.get('ScalarValue')
+                if value is not None:
+                    row[name] = iso8601_to_nanoseconds(value) if name == 'time' else \
+                        self._sqlite_value(value, self.column_types[name])
+            rows.append(row)
+        self._insert(rows)
+
+    def _add_column(self, name, value_type, attribute_type):
+        if name in self.column_types:
+            if self.column_types[name] != value_type and attribute_type == 'MULTI':
+                raise Exception(f"Measure column[{name}] is {self.column_types[name]}, not {value_type}")
+            return
+        with self._lock:
+            if not name.startswith('measure_value::'):
+                self._connection.execute(f'ALTER TABLE "{self._sqlite_table}" ADD COLUMN {self._identifier(name)} '
+                                         f'{SQLITE_TYPES[value_type]}')
+            self.column_types[name] = value_type
+            self.attribute_types[name] = attribute_type
+
+    def _insert(self, rows):
+        # rows are grouped by their set of columns, one executemany per group
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row), []).append(tuple(row.values()))
+        with self._lock:
+            for names, values in groups.items():
+                columns = ', '.join(self._identifier(name) for name in names)
+                self._connection.executemany(
+                    f'INSERT INTO "{self._sqlite_table}" ({columns}) VALUES ({", ".join("?" * len(names))})', values)
+            self._connection.commit()
+
+    @staticmethod
+    def _sqlite_value(value, value_type):
+        if value_type == 'double':
+            return float(value)
+        if value_type == 'bigint':
+            return int(value)
+        if value_type == 'boolean':
+            return 1 if str(value).lower() == 'true' else 0
+        return str(value)
+
+    @staticmethod
+    def _identifier(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    # ---------------------------------------------------------------------------
+    #   queries
+    # ---------------------------------------------------------------------------
+
+    def query(self, QueryString, NextToken=None, MaxRows=None, ClientToken=None):
+        """
+        Runs a query, or continues it from a NextToken, and returns one page of its results
+        see https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/timestream-query.html#TimestreamQuery.Client.query
+        """
+        self.calls += 1
+        if NextToken:
+            query_id, offset, empty_pages = self._parse_token(NextToken)
+            with self._lock:
+                result = self._results.get(query_id)
+            if result is None or result[0] != QueryString:
+                raise Exception(f"Invalid or expired NextToken[{NextToken}] for this QueryString")
+        else:
+            query_id, offset, empty_pages = f'local-{next(self._query_ids)}', 0, self.empty_pages
+            result = (QueryString,) + self._execute(QueryString)
+            with self._lock:
+                self._results[query_id] = result
+                while len(self._results) > self.max_results:
+                    self._results.popitem(last=False)
+
+        _, column_info, rows, renderers = result
+        page = {'QueryId': query_id, 'ColumnInfo': column_info}
+        if empty_pages:
+            page['Rows'] = []
+            page['NextToken'] = f'{query_id}:{offset}:{empty_pages - 1}'
+            page['QueryStatus'] = self._query_status(0, len(rows))
+            return page
+
+        end = offset + (MaxRows or self.page_rows)
+        page['Rows'] = [
+            {'Data': [{'NullValue': True} if value is None else {'ScalarValue': render(value)}
+                      for value, render in zip(row, renderers)]}
+            for row in rows[offset:end]
+        ]
+        if end < len(rows):
+            page['NextToken'] = f'{query_id}:{end}:0'
+        page['QueryStatus'] = self._query_status(min(end, len(rows)), len(rows))
+        return page
+
+    @staticmethod
+    def _parse_token(next_token):
+        try:
+            query_id, offset, empty_pages = next_token.rsplit(':', 2)
+            return query_id, int(offset), int(empty_pages)
+        except ValueError:
+            raise Exception(f"Invalid NextToken[{next_token}]")
+
+    @staticmethod
+    def _query_status(returned, total):
+        return {
+            'ProgressPercentage': 100.0 * returned / total if total else 100.0,
+            'CumulativeBytesScanned': 0,
+            'CumulativeBytesMetered': 0,
+        }
+
+    def _execute(self, query_string):
+        """
+        Returns the ColumnInfo, the rows and a value renderer per column of a query
+        """
+        describe = re.match(r'^\s*DESCRIBE\s+(.+?)\s*;?\s*$', query_string, re.IGNORECASE)
+        if describe:
+            return self.describe(describe.group(1))
+
+        sql = self.translate(query_string)
+        if self.shuffle_ties and ORDER_BY_PATTERN.search(sql):
+            sql += ', random()'
+        with self._lock:
+            try:
+                cursor = self._connection.execute(sql)
+            except sqlite3.Error as err:
+                raise Exception(f"Query failed: {err} in [{sql}]")
+            rows = cursor.fetchall()
+            names = [column[0] for column in cursor.description]
+
+        column_info = []
+        renderers = []
+        for index, name in enumerate(names):
+            value_type = self._result_type(name, [row[index] for row in rows])
+            column_info.append({'Name': name, 'Type': {'ScalarType': value_type.upper()}})
+            renderers.append(self._renderer(value_type))
+        return column_info, rows, renderers
+
+    def _result_type(self, name, values):
+        """
+        The Timestream type of a result column: the type of the table column it selects, or of its values for
+        expressions. Aggregates of booleans and bigints, e.g. avg() or the bin() aggregates, are doubles
+        """
+        value_type = self.column_types.get(name)
+        if value_type == 'timestamp':
+            return value_type
+        kinds = {type(value) for value in values if value is not None}
+        if value_type in ('boolean', 'bigint') and float in kinds:
+            return 'double'
+        if value_type is not None:
+            return value_type
+        if str in kinds:
+            return 'varchar'
+        if float in kinds:
+            return 'double'
+        return 'bigint' if int in kinds else 'varchar'
+
+    @staticmethod
+    def _renderer(value_type):
+        if value_type == 'timestamp':
+            return nanoseconds_to_timestream_time
+        if value_type == 'boolean':
+            return lambda value: 'true' if value else 'false'
+        if value_type == 'double':
+            return lambda value: repr(float(value))
+        if value_type == 'bigint':
+            return lambda value: str(int(value))
+        return str
+
+    def describe(self, table):
+        """
+        DESCRIBE database.table: the Column, Type and Timestream Attribute Type of every column
+        """
+        if table.replace('"', '') != self._sqlite_table:
+            raise Exception(f"Table {table} does not exist")
+        column_info = [{'Name': name, 'Type': {'ScalarType': 'VARCHAR'}}
+                       for name in ('Column', 'Type', 'Timestream Attribute Type')]
+        rows = [(name, self.column_types[name], self.attribute_types[name]) for name in self.column_types]
+        return column_info, rows, [str, str, str]
+
+    def translate(self, query_string) -> str:
+        """
+        Translates a Timestream query into SQLite, times are integer nanoseconds in the SQLite table
+        e.g. "SELECT measure_value::double FROM db.tb WHERE time > ago(15m)"
+          -> 'SELECT "measure_value::double" FROM "db.tb" WHERE time > 1649204265419000000'
+        """
+        now = time.time_ns()
+        sql = re.sub(r"from_iso8601_(?:timestamp|date)\(\s*'([^']*)'\s*\)",
+                     lambda match: str(iso8601_to_nanoseconds(match.group(1))), query_string)
+        table = re.escape(self.database_name) + r'"?\s*\.\s*"?' + re.escape(self.table_name)
+        sql = re.sub(r'"?' + table + r'"?', f'"{self._sqlite_table}"', sql)
+
+        parts = []
+        position = 0
+        for match in QUOTED_PATTERN.finditer(sql):
+            parts.append(self._translate_unquoted(sql[position:match.start()], now))
+            parts.append(match.group(0))
+            position = match.end()
+        parts.append(self._translate_unquoted(sql[position:], now))
+        return ''.join(parts)
+
+    @staticmethod
+    def _translate_unquoted(sql, now):
+        sql = re.sub(r'\bmeasure_value::(double|bigint|boolean|varchar)\b', r'"measure_value::\1"', sql)
+        sql = re.sub(r'\bfrom_milliseconds\(\s*(-?\d+)\s*\)', lambda match: str(int(match.group(1)) * 1000000), sql)
+        sql = re.sub(r'\bfrom_nanoseconds\(\s*(-?\d+)\s*\)', r'\1', sql)
+        sql = re.sub(r'\bago\(\s*' + DURATION + r'\s*\)',
+                     lambda match: str(now - duration_nanoseconds(*match.groups())), sql)
+        sql = re.sub(r'\bnow\(\s*\)', str(now), sql)
+        sql = re.sub(r'\bbin\(\s*(\w+)\s*,\s*' + DURATION + r'\s*\)',
+                     lambda match: f'({match.group(1)} - {match.group(1)} % {duration_nanoseconds(*match.groups()[1:])})',
+                     sql)
+        # SQLite older than 3.23 has no boolean literals
+        sql = re.sub(r'\btrue\b', '1', sql, flags=re.IGNORECASE)
+        return re.sub(r'\bfalse\b', '0', sql, flags=re.IGNORECASE)
+
+
+def populate(client, vehicles=10, measures=60, seconds=3600, interval=1.0, start='2022-04-06T00:00:00Z',
+             multi_measure=False, boolean_every=8, seed=0, batch_records=10000):
+    """
+    Writes synthetic fleet telemetry: `measures` signals Vehicle.Synthetic.Signal<n> of `vehicles` vehicles
+    vehicle<n>, sampled every `interval` seconds for `seconds` seconds from start. Every boolean_every-th signal is a
+    boolean, the others doubles. With multi_measure, each sample is one MULTI record named 'telemetry'
+    """
+    rng = random.Random(seed)
+    start_ms = iso8601_to_nanoseconds(start) // 1000000
+    samples = int(seconds / interval)
+    names = [f'Vehicle.Synthetic.Signal{measure}' for measure in range(measures)]
+    booleans = [boolean_every and measure % boolean_every == boolean_every - 1 for measure in range(measures)]
+
+    def measure_value(measure):
+        if booleans[measure]:
+            return 'BOOLEAN', 'true' if rng.random() < 0.5 else 'false'
+        return 'DOUBLE', repr(round(rng.uniform(-40.0, 80.0), 3))
+
+    records = []
+    for vehicle in range(vehicles):
+        dimensions = [{'Name': 'vehicleName', 'Value': f'vehicle{vehicle}'},
+                      {'Name': 'campaignName', 'Value': 'synthetic-campaign'}]
+        for sample in range(samples):
+            sample_time = str(start_ms + int(sample * interval * 1000))
+            if multi_measure:
+                values = []
+                for measure, name in enumerate(names):
+                    value_type, value = measure_value(measure)
+                    values.append({'Name': name, 'Value': value, 'Type': value_type})
+                records.append({'Dimensions': dimensions, 'MeasureName': 'telemetry', 'MeasureValueType': 'MULTI',
+                                'MeasureValues': values, 'Time': sample_time})
+            else:
+                for measure, name in enumerate(names):
+                    value_type, value = measure_value(measure)
+                    records.append({'Dimensions': dimensions, 'MeasureName': name, 'MeasureValueType': value_type,
+                                    'MeasureValue': value, 'Time': sample_time})
+            if len(records) >= batch_records:
+                client.write_records(records)
+                records = []
+    if records:
+        client.write_records(records)
+
+
+def install(client, *modules):
+    """
+    Replaces the timestream-query client of connector modules, e.g. install(client, data_reader, schema_init)
+    """
+    for module in modules:
+        module.QUERY_CLIENT = client
+        reader = getattr(module, 'TIMESTREAM_UDQ_READER', None)
+        if reader is not None:
+            reader.query_client = client
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Timestream queries against a local SQLite stand-in')
+    parser.add_argument('query', help='Timestream query string')
+    parser.add_argument('--db', default=':memory:', help='SQLite file, generated data is added to it')
+    parser.add_argument('--database', default='fleet', help='Timestream database name')
+    parser.add_argument('--table', default='telemetry', help='Timestream table name')
+    parser.add_argument('--vehicles', type=int, default=0, help='vehicles of synthetic data to generate first')
+    parser.add_argument('--measures', type=int, default=60)
+    parser.add_argument('--seconds', type=int, default=600)
+    parser.add_argument('--multi-measure', action='store_true', help='generate multi-measure records')
+    parser.add_argument('--max-rows', type=int, help='MaxRows of every page')
+    args = parser.parse_args()
+
+    client = LocalTimestreamClient(args.database, args.table, args.db)
+    if args.vehicles:
+        populate(client, args.vehicles, args.measures, args.seconds, multi_measure=args.multi_measure)
+
+    next_token = None
+    while True:
+        kwargs = {'QueryString': args.query}
+        if next_token:
+            kwargs['NextToken'] = next_token
+        if args.max_rows:
+            kwargs['MaxRows'] = args.max_rows
+        page = client.query(**kwargs)
+        print(json.dumps(page))
+        next_token = page.get('NextToken')
+        if not next_token:
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+# ---------------------------------------------------------------------------
+#   Micro-benchmark of the SQL injection check run by the data reader on every query
+#
+#   Queries of typical UDQ requests are built with query_builder and checked by SQLDetector, the report gives the
+#   median cost per call of:
+#   - fast path: the literals of the query are validated, the query is not parsed
+#   - fallback:  the query is parsed and compared to the cached token context of its sample query
+#   - legacy:    the sample query and the query are both parsed on every call, the detector before the cache
+#
+#   Usage, from this directory:
+#     python sql_detector_benchmark.py
+#     python sql_detector_benchmark.py --calls 2000 --output report.json
+#
+#   The fallback and legacy rows need sqlparse, they are skipped when it is not installed.
+# ---------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+COMPONENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(COMPONENT_DIR, 'data_reader'), os.path.join(COMPONENT_DIR, 'udq_helper_utils')]
+
+from udq_utils.query_builder import MeasuresQuery, PropertyFilter, TimeBound  # noqa: E402
+from udq_utils.sql_detector import SQLDetector  # noqa: E402
+
+LOWER = TimeBound('>=', 'from_iso8601_timestamp', '2022-04-06T00:00:00Z')
+UPPER = TimeBound('<', 'from_iso8601_timestamp', '2022-04-06T01:00:00Z')
+
+# scenario name: query of a typical request
+SCENARIOS = {
+    'single_vehicle': lambda: MeasuresQuery('db', 'table', ['Vehicle.Speed'], LOWER, UPPER, 'car-001'),
+    'ten_measures': lambda: MeasuresQuery('db', 'table', [f'Vehicle.Signal{i}' for i in range(10)], LOWER, UPPER, 'car-001'),
+    'filtered': lambda: MeasuresQuery('db', 'table', ['Vehicle.Speed', 'Vehicle.Gear'], LOWER, UPPER, 'car-001', [
+        PropertyFilter.parse({'operator': '>', 'value': {'doubleValue': 50}}, 'Vehicle.Speed'),
+        PropertyFilter.parse({'operator': '=', 'value': {'stringValue': "it's D"}}, 'Vehicle.Gear'),
+    ]),
+    'binned_fleet': lambda: MeasuresQuery('db', 'table', ['Vehicle.Speed'], LOWER, UPPER, None, bin_seconds=60),
+}
+
+
+def time_calls(check, calls):
+    """
+    :return: the median microseconds per call of check, over 5 batches of calls
+    """
+    batches = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(calls):
+            check()
+        batches.append((time.perf_counter() - start) * 1e6 / calls)
+    return statistics.median(batches)
+
+
+def legacy_check(detector, sample_query, query):
+    if detector.getQueryContext(sample_query) != detector.getQueryContext(query):
+        raise Exception(f"Detected potential injection from query: {query}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the SQL injection check')
+    parser.add_argument('--calls', type=int, default=1000, help='calls per batch, the median of 5 batches is reported')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args()
+
+    try:
+        import sqlparse  # noqa: F401
+        parse_calls = max(1, args.calls // 10)
+    except ImportError:
+        print('sqlparse not installed, fallback and legacy not measured')
+        parse_calls = None
+
+    results = {}
+    for name, build in SCENARIOS.items():
+        query = build()
+        detector = SQLDetector()
+        result = {'fast_path_us': time_calls(
+            lambda: detector.detectInjection(query.sample_query, query.query_string, query.literals), args.calls)}
+        if parse_calls is not None:
+            result['fallback_us'] = time_calls(
+                lambda: detector.detectInjection(query.sample_query, query.query_string), parse_calls)
+            result['legacy_us'] = time_calls(
+                lambda: legacy_check(detector, query.sample_query, query.query_string), parse_calls)
+        results[name] = {key: round(value, 2) for key, value in result.items()}
+        print(f"{name:16s} " + '  '.join(f"{key[:-3]} {value:10.2f} us" for key, value in results[name].items()))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'python': sys.version.split()[0], 'calls': args.calls, 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+# ---------------------------------------------------------------------------
+#   Offline benchmark of the UDQ read path, from the UDQ lambda event to the response JSON
+#
+#   A fake timestream-query client replays synthetic or recorded Timestream pages through
+#   TimestreamReader.process_query, no AWS access is needed. Every scenario follows the nextToken of the responses
+#   until the whole window is read, as IoT TwinMaker does, and reports per phase the median time and the peak
+#   traced memory:
+#   - parse:      lambda event -> IoTTwinMakerUdqRequest
+#   - query:      TimestreamReader.entity_query, query building and page fetch
+#   - conversion: reading the reference, timestamp and value of every data row
+#   - marshal:    process_query marshalling of the converted rows and json.dumps of the response
+#
+#   Usage, from this directory:
+#     python udq_benchmark.py                                  # synthetic scenarios
+#     python udq_benchmark.py --pages recorded_page_*.json     # recorded `aws timestream-query query` outputs
+#     python udq_benchmark.py --output new.json --baseline old.json --threshold 0.1
+#     python udq_benchmark.py --local                          # run the queries on a local SQLite stand-in
+#
+#   Synthetic pages are generated from a fixed seed, so results of two commits on the same machine are comparable.
+#   With --baseline, the run exits with status 1 when a phase is slower than the baseline by more than --threshold.
+#   With --local, the rows of the scenario are loaded into a LocalTimestreamClient and the queries issued by the reader
+#   are executed by it, the query phase then includes query execution and pagination.
+# ---------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+COMPONENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(COMPONENT_DIR, 'data_reader'), os.path.join(COMPONENT_DIR, 'udq_helper_utils')]
+
+# data_reader creates its boto3 client on first use, the benchmark never calls it so boto3 is not needed
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('TIMESTREAM_DATABASE_NAME', 'benchmark')
+os.environ.setdefault('TIMESTREAM_TABLE_NAME', 'benchmark')
+# the synthetic signals are not in the signal catalog, the benchmark runs without its allowlist
+os.environ.setdefault('SIGNAL_INDEX_TABLE', 'none')
+
+from data_reader import TimestreamReader  # noqa: E402
+from local_timestream import LocalTimestreamClient  # noqa: E402
+from udq_utils.property_names import PROPERTY_NAMES  # noqa: E402
+from udq_utils.udq import IoTTwinMakerUdqResponse  # noqa: E402
+from udq_utils.udq_models import IoTTwinMakerUdqRequest  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+PHASES = ('parse', 'query', 'conversion', 'marshal')
+
+COLUMN_INFO = [
+    {'Name': 'vehicleName', 'Type': {'ScalarType': 'VARCHAR'}},
+    {'Name': 'campaignName', 'Type': {'ScalarType': 'VARCHAR'}},
+    {'Name': 'measure_name', 'Type': {'ScalarType': 'VARCHAR'}},
+    {'Name': 'time', 'Type': {'ScalarType': 'TIMESTAMP'}},
+    {'Name': 'measure_value::boolean', 'Type': {'ScalarType': 'BOOLEAN'}},
+    {'Name': 'measure_value::double', 'Type': {'ScalarType': 'DOUBLE'}},
+]
+
+# name: (rows, properties, rows per page, value pattern)
+# value pattern: 'double' every measure is a double, 'boolean' every measure is a boolean,
+#                'mixed' every other measure is a boolean, the null column alternates between rows of a page
+SCENARIOS = {
+    'single-page-1-property': (1000, 1, 1000, 'double'),
+    'single-page-6-properties': (1000, 6, 1000, 'mixed'),
+    'paged-6-properties': (20000, 6, 1000, 'mixed'),
+    'paged-24-properties': (20000, 24, 1000, 'double'),
+    'large-pages-6-properties': (50000, 6, 10000, 'mixed'),
+    'booleans-6-properties': (10000, 6, 1000, 'boolean'),
+}
+
+VEHICLE_NAME = 'benchmark-vehicle'
+START_TIME = '2022-04-06T00:00:00Z'
+END_TIME = '2022-04-07T00:00:00Z'
+START_DATE_TIME = int(datetime(2022, 4, 6, tzinfo=timezone.utc).timestamp())
+END_DATE_TIME = int(datetime(2022, 4, 7, tzinfo=timezone.utc).timestamp())
+
+
+def synthetic_pages(rows, properties, page_rows, pattern, seed=0):
+    """
+    Generates the Timestream pages of a query over `properties` measures, `rows` rows in total
+    """
+    rng = random.Random(seed)
+    pages = []
+    for page_start in range(0, rows, page_rows):
+        page = []
+        for i in range(page_start, min(page_start + page_rows, rows)):
+            measure = i % properties
+            boolean = pattern == 'boolean' or (pattern == 'mixed' and measure % 2 == 1)
+            timestamp = START_DATE_TIME + (i // properties) * 0.1
+            time_string = datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f') + '000'
+            if boolean:
+                values = [{'ScalarValue': 'true' if rng.random() < 0.5 else 'false'}, {'NullValue': True}]
+            else:
+                values = [{'NullValue': True}, {'ScalarValue': repr(round(rng.uniform(-40.0, 80.0), 3))}]
+            page.append({'Data': [
+                {'ScalarValue': VEHICLE_NAME},
+                {'ScalarValue': 'benchmark-campaign'},
+                {'ScalarValue': f'Vehicle.Benchmark.Signal{measure}'},
+                {'ScalarValue': time_string},
+            ] + values})
+        pages.append({'QueryId': 'benchmark', 'ColumnInfo': COLUMN_INFO, 'Rows': page})
+    return pages
+
+
+def recorded_pages(path):
+    """
+    Loads a recorded page file: the JSON output of `aws timestream-query query`, or a list of them
+    """
+    with open(path) as f:
+        pages = json.load(f)
+    return pages if isinstance(pages, list) else [pages]
+
+
+class ReplayQueryClient:
+    """
+    Fake timestream-query client replaying a fixed list of pages, whatever the query string
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = 0
+
+    def query(self, QueryString, NextToken=None, MaxRows=None):
+        self.calls += 1
+        index = int(NextToken[len('page-'):]) if NextToken else 0
+        page = dict(self.pages[index])
+        page.pop('NextToken', None)
+        if index + 1 < len(self.pages):
+            page['NextToken'] = f'page-{index + 1}'
+        return page
+
+
+def local_client(pages):
+    """
+    A LocalTimestreamClient holding the rows of the pages, paginated like them
+    """
+    client = LocalTimestreamClient('benchmark', 'benchmark', page_rows=max(len(page['Rows']) for page in pages))
+    for page in pages:
+        client.insert_page(page)
+    return client
+
+
+class PreparedResponseReader(TimestreamReader):
+    """
+    Reader returning an already fetched and converted response, so process_query only marshals it
+    """
+
+    def __init__(self, response):
+        super().__init__(None, 'benchmark', 'benchmark')
+        self.response = response
+
+    def entity_query(self, request):
+        return self.response
+
+
+def measure_names(pages):
+    names = set()
+    for page in pages:
+        index = [column['Name'] for column in page['ColumnInfo']].index('measure_name')
+        names.update(row['Data'][index]['ScalarValue'] for row in page['Rows'])
+    return sorted(names)
+
+
+def entity_event(properties, next_token=None):
+    return {
+        'workspaceId': 'benchmark',
+        'entityId': 'benchmark-entity',
+        'componentName': 'benchmark-component',
+        'selectedProperties': properties,
+        'properties': dict({p: {} for p in properties},
+                           vehicleName={'value': {'stringValue': VEHICLE_NAME}}),
+        'startTime': START_TIME,
+        'endTime': END_TIME,
+        'startDateTime': START_DATE_TIME,
+        'endDateTime': END_DATE_TIME,
+        'orderByTime': 'ASCENDING',
+        'nextToken': next_token,
+    }
+
+
+def run_invocation(client, properties, next_token, timed):
+    """
+    Runs one UDQ invocation phase by phase, returns the {phase: seconds or peak bytes} and the response nextToken
+    """
+    results = {}
+
+    def phase(name, fn):
+        gc.collect()
+        if timed:
+            start = time.perf_counter()
+            value = fn()
+            results[name] = time.perf_counter() - start
+        else:
+            tracemalloc.start()
+            value = fn()
+            results[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return value
+
+    # the reader converts the selected properties of the request in place, every parse gets a fresh event
+    reader = TimestreamReader(client, 'benchmark', 'benchmark')
+    request = phase('parse', lambda: IoTTwinMakerUdqRequest.parse(entity_event(properties, next_token)))
+    response = phase('query', lambda: reader.entity_query(request))
+    phase('conversion', lambda: [(row.get_iottwinmaker_reference(), row.get_iso8601_timestamp(), row.get_value())
+                                 for row in response.rows])
+    prepared = PreparedResponseReader(IoTTwinMakerUdqResponse(response.rows, response.next_token))
+    event = entity_event(properties, next_token)
+    payload = phase('marshal', lambda: json.dumps(prepared.process_query(event)))
+    # process_query parses the event again, that time belongs to the parse phase
+    if timed:
+        results['marshal'] = max(results['marshal'] - results['parse'], 0.0)
+    return results, json.loads(payload)['nextToken']
+
+
+def run_scenario(pages, repeat, local=False):
+    """
+    Reads the whole window of the scenario `repeat` times, returns the per phase median time and peak memory
+    """
+    properties = [PROPERTY_NAMES.to_property(name) for name in measure_names(pages)]
+    rows = sum(len(page['Rows']) for page in pages)
+    shared_client = local_client(pages) if local else None
+
+    def read_window(timed):
+        totals = dict.fromkeys(PHASES, 0)
+        client = shared_client or ReplayQueryClient(pages)
+        next_token = None
+        invocations = 0
+        while True:
+            results, next_token = run_invocation(client, properties, next_token, timed)
+            invocations += 1
+            for name in PHASES:
+                totals[name] = totals[name] + results[name] if timed else max(totals[name], results[name])
+            if not next_token:
+                return totals, invocations
+
+    samples = [read_window(True)[0] for _ in range(repeat)]
+    peaks, invocations = read_window(False)
+    times = {name: statistics.median(sample[name] for sample in samples) for name in PHASES}
+    total = sum(times.values())
+    return {
+        'rows': rows,
+        'pages': len(pages),
+        'properties': len(properties),
+        'invocations': invocations,
+        'seconds': times,
+        'total_seconds': total,
+        'rows_per_second': rows / total if total else None,
+        'peak_bytes': peaks,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=COMPONENT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print(f"{'scenario':<28} {'phase':<11} {'ms':>10} {'peak KiB':>10} {'vs base':>8}")
+    for name, result in results.items():
+        base = (baseline or {}).get(name)
+        for phase_name in PHASES + ('total',):
+            seconds = result['total_seconds'] if phase_name == 'total' else result['seconds'][phase_name]
+            peak = '' if phase_name == 'total' else f"{result['peak_bytes'][phase_name] / 1024:.0f}"
+            delta = ''
+            if base:
+                base_seconds = base['total_seconds'] if phase_name == 'total' else base['seconds'][phase_name]
+                if base_seconds:
+                    delta = f"{(seconds - base_seconds) / base_seconds:+.0%}"
+            print(f"{name:<28} {phase_name:<11} {seconds * 1000:>10.2f} {peak:>10} {delta:>8}")
+        print(f"{name:<28} {result['rows']} rows, {result['invocations']} invocations, "
+              f"{result['rows_per_second']:,.0f} rows/s")
+
+
+def regressions(results, baseline, threshold):
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for phase_name in PHASES:
+            base_seconds = base['seconds'][phase_name]
+            if base_seconds and result['seconds'][phase_name] > base_seconds * (1 + threshold):
+                found.append(f"{name}/{phase_name}: {base_seconds * 1000:.2f}ms -> "
+                             f"{result['seconds'][phase_name] * 1000:.2f}ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the UDQ read path')
+    parser.add_argument('--pages', nargs='*', default=[], help='recorded Timestream page files, replaces the synthetic scenarios')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='synthetic scenarios to run, default all')
+    parser.add_argument('--repeat', type=int, default=5, help='timed reads per scenario, the median is reported')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results JSON of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+    parser.add_argument('--local', action='store_true', help='execute the queries on a local SQLite stand-in')
+    args = parser.parse_args()
+
+    if args.pages:
+        scenarios = {os.path.basename(path): recorded_pages(path) for path in args.pages}
+    else:
+        scenarios = {name: synthetic_pages(*SCENARIOS[name]) for name in (args.scenario or SCENARIOS)}
+
+    # the reader logs every query to stdout, keep it out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = {name: run_scenario(pages, args.repeat, args.local) for name, pages in scenarios.items()}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['scenarios']
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'repeat': args.repeat,
+                'local': args.local,
+                'scenarios': results,
+            }, f, indent=2)
+
+    if baseline:
+        found = regressions(results, baseline, args.threshold)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
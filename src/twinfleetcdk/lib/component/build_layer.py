@@ -0,0 +1,113 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2022
+# SPDX-License-Identifier: Apache-2.0
+
+# ---------------------------------------------------------------------------
+#   Builds udq_layer.zip, the Lambda layer of the udq_utils package, from udq_helper_utils/udq_utils
+#
+#   The layer ships the sources with their bytecode for every Lambda runtime of the connectors, compiled with
+#   `compileall --invalidation-mode unchecked-hash`: /opt is read-only, without bytecode the sources are compiled on
+#   every cold start, and unchecked-hash bytecode is loaded without reading the source. The bytecode is only correct
+#   for the sources it was compiled from, so rebuild the layer after every change to udq_utils and commit the zip.
+#   The zip is reproducible: same sources and interpreters, same bytes.
+#
+#   Usage, from this directory:
+#     python build_layer.py                                    # python3.8 and python3.9 from the PATH
+#     python build_layer.py --python ~/.pyenv/versions/3.8.18/bin/python --python ~/.pyenv/versions/3.9.18/bin/python
+#     python build_layer.py --check                            # exits with status 1 if udq_layer.zip is stale
+#
+#   --check rebuilds the layer in a temporary directory and compares the zips, use the interpreters of the build.
+# ---------------------------------------------------------------------------
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+COMPONENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.join(COMPONENT_DIR, 'udq_helper_utils', 'udq_utils')
+LAYER_PATH = os.path.join(COMPONENT_DIR, 'udq_layer.zip')
+# where Lambda extracts the package of the layer
+LAMBDA_PACKAGE_DIR = '/opt/python/udq_utils'
+
+# the runtimes of the functions using the layer, see evtwindata.ts: data_reader on 3.8, schema_init on 3.9
+DEFAULT_INTERPRETERS = ['python3.8', 'python3.9']
+
+# files of the package shipped in the layer, besides the sources
+PACKAGE_DATA = ('.json',)
+
+# the date of every zip entry, the zip format does not go before 1980
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def package_files():
+    """
+    :return: the names of the files of PACKAGE_DIR shipped in the layer, sorted
+    """
+    return sorted(name for name in os.listdir(PACKAGE_DIR)
+                  if name.endswith('.py') or name.endswith(PACKAGE_DATA))
+
+
+def build(interpreters, layer_path=LAYER_PATH):
+    with tempfile.TemporaryDirectory() as base_dir:
+        layer_dir = os.path.join(base_dir, 'python', 'udq_utils')
+        os.makedirs(layer_dir)
+        for name in package_files():
+            shutil.copyfile(os.path.join(PACKAGE_DIR, name), os.path.join(layer_dir, name))
+        for interpreter in interpreters:
+            # tracebacks show the path of the sources in the function, not that of the build directory
+            subprocess.run([interpreter, '-m', 'compileall', '-q', '--invalidation-mode', 'unchecked-hash',
+                            '-d', LAMBDA_PACKAGE_DIR, layer_dir], check=True)
+
+        with zipfile.ZipFile(layer_path, 'w', zipfile.ZIP_DEFLATED) as layer:
+            for directory, directories, files in os.walk(os.path.join(base_dir, 'python')):
+                directories.sort()
+                for name in [''] + sorted(files):
+                    path = os.path.join(directory, name)
+                    entry = zipfile.ZipInfo(os.path.relpath(path, base_dir) + ('/' if not name else ''), ZIP_DATE_TIME)
+                    if name:
+                        entry.compress_type = zipfile.ZIP_DEFLATED
+                        entry.external_attr = 0o644 << 16
+                        with open(path, 'rb') as source:
+                            layer.writestr(entry, source.read())
+                    else:
+                        entry.external_attr = 0o755 << 16 | 0x10
+                        layer.writestr(entry, b'')
+    print(f"{layer_path}: {len(package_files())} files compiled for {', '.join(interpreters)}")
+
+
+def is_stale(interpreters, layer_path=LAYER_PATH):
+    """
+    :return: True if building the layer with interpreters gives another zip than the one at layer_path
+    """
+    with tempfile.TemporaryDirectory() as base_dir:
+        built_path = os.path.join(base_dir, 'udq_layer.zip')
+        build(interpreters, built_path)
+        with open(built_path, 'rb') as built, open(layer_path, 'rb') as layer:
+            return built.read() != layer.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the udq_utils Lambda layer, udq_layer.zip')
+    parser.add_argument('--python', action='append', dest='interpreters',
+                        help='interpreter of a Lambda runtime to compile the bytecode for, repeatable '
+                             f"(default: {' '.join(DEFAULT_INTERPRETERS)})")
+    parser.add_argument('--check', action='store_true',
+                        help='checks that the layer is the one built from the sources instead')
+    parser.add_argument('--output', default=LAYER_PATH)
+    args = parser.parse_args()
+    interpreters = args.interpreters or DEFAULT_INTERPRETERS
+
+    if args.check:
+        if is_stale(interpreters, args.output):
+            print(f"{args.output} is stale, rebuild it with build_layer.py")
+            sys.exit(1)
+        print(f"{args.output} is up to date")
+        return
+    build(interpreters, args.output)
+
+
+if __name__ == '__main__':
+    main()
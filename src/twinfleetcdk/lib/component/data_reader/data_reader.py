@@ -1,38 +1,97 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
 # SPDX-License-Identifier: Apache-2.0
 
+import heapq
+import json
 import logging
+import math
 import os
+import re
 import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import boto3
-
+from udq_utils import udq_metrics
+from udq_utils.property_names import PROPERTY_NAMES
+from udq_utils.query_builder import MEASURE_VALUE_COLUMNS, MeasuresQuery, PropertyFilter, TimeBound
+from udq_utils.signal_index import SIGNAL_INDEX
 from udq_utils.udq import SingleEntityReader, MultiEntityReader, IoTTwinMakerDataRow, IoTTwinMakerUdqResponse
 from udq_utils.udq_models import IoTTwinMakerUDQEntityRequest, IoTTwinMakerUDQComponentTypeRequest, OrderBy, IoTTwinMakerReference, \
-    EntityComponentPropertyRef, ExternalIdPropertyRef
+    EntityComponentPropertyRef, ExternalIdPropertyRef, UdqCursor
 
-#from udq_utils.sql_detector import SQLDetector
+from udq_utils.sql_detector import SQLDetector
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
+# value type of the filter values compared to each measure value column, see SignalIndex.accepts_filter
+FILTER_VALUE_TYPES = {
+    'measure_value::double': 'DOUBLE',
+    'measure_value::boolean': 'BOOLEAN',
+    'measure_value::varchar': 'STRING',
+}
+
+# downsampling modes, selected per entity through its 'entityDownsampling' component property: every request for the
+# properties of the entity is downsampled the same way, whatever the chart
+DOWNSAMPLING_PROPERTY = 'entityDownsampling'
+DOWNSAMPLING_RAW = 'raw'        # every sample, the default
+DOWNSAMPLING_BIN = 'bin'        # Timestream bin() with avg per bin, computed by Timestream
+DOWNSAMPLING_LTTB = 'lttb'      # largest-triangle-three-buckets applied to the pre-aggregated rows
+DOWNSAMPLING_MINMAX = 'minmax'  # min and max point per bucket applied to the pre-aggregated rows
+DOWNSAMPLING_MODES = (DOWNSAMPLING_RAW, DOWNSAMPLING_BIN, DOWNSAMPLING_LTTB, DOWNSAMPLING_MINMAX)
+
+# lttb and minmax reduce bin() averages at this many times the requested points, not the raw rows of the window:
+# a week of a 1 Hz signal is 600k raw rows, far more than the Lambda memory
+PRE_AGGREGATION_FACTOR = 4
+
+# record formats of the Timestream table, see TimestreamReader.multi_measure
+MEASURE_FORMAT_SINGLE = 'single'  # one row per (time, measure_name), the value in a measure_value::<type> column
+MEASURE_FORMAT_MULTI = 'multi'    # one row per time, every measure in its own typed column
+
 # ---------------------------------------------------------------------------
 #   Implementation of the AWS IoT TwinMaker UDQ Connector for Amazon Timestream
 #   consists of the EntityReader and IoTTwinMakerDataRow implementations
 # ---------------------------------------------------------------------------
 
-class TimestreamReader(SingleEntityReader):
+class TimestreamReader(SingleEntityReader, MultiEntityReader):
     """
     The UDQ Connector implementation for our Timestream table
     It supports both single-entity queries and multi-entity queries and contains 2 utility functions to read from Timestream
     and convert the results into a IoTTwinMakerUdqResponse object
     """
-    def __init__(self, query_client, database_name, table_name):
+    def __init__(self, query_client, database_name, table_name, result_cache=None, bucket_cache=None,
+                 bucket_seconds=60, max_buckets=60, executor=None, measure_shards=0, time_shards=1, shard_page_rows=10000,
+                 max_downsampled_points=2000, prefetcher=None, max_response_bytes=None, metrics_sink=None,
+                 multi_measure=False, sql_detector=None, signal_index=None):
         self.query_client = query_client
         self.database_name = database_name
         self.table_name = table_name
-        #self.sqlDetector = SQLDetector()
+        self.result_cache = result_cache
+        self.bucket_cache = bucket_cache
+        self.bucket_seconds = bucket_seconds
+        self.max_buckets = max_buckets
+        self.executor = executor
+        self.measure_shards = measure_shards
+        self.time_shards = time_shards
+        self.shard_page_rows = shard_page_rows
+        self.max_downsampled_points = max_downsampled_points
+        self.prefetcher = prefetcher
+        # responses larger than this are cut and resumed by the UDQ framework, see IoTTwinMakerUnifiedDataQuery
+        self.max_response_bytes = max_response_bytes
+        # per-phase metrics of every invocation, see udq_metrics
+        self.metrics_sink = metrics_sink
+        # multi-measure tables are queried as columns and their rows fanned out, see TimestreamMultiMeasureFanOut
+        self.multi_measure = multi_measure
+        self._measure_columns = None
+        # every query is checked for SQL injection before it is run, None to skip the check
+        self.sql_detector = sql_detector
+        # the signals that can be queried, see udq_utils.signal_index, None to accept every signal
+        self.signal_index = signal_index
 
     # overrides SingleEntityReader.entity_query abstractmethod
     def entity_query(self, request: IoTTwinMakerUDQEntityRequest) -> IoTTwinMakerUdqResponse:
@@ -43,248 +102,1475 @@ class TimestreamReader(SingleEntityReader):
         """
         LOGGER.info("TimestreamReader entity_query")
 
-        requestd = vars(request)
-        
+        # the same request is re-issued on every scene/panel refresh, serve it from the warm container if we can
+        cache_key = self._result_cache_key(request) if self.result_cache is not None else None
+        if cache_key is not None:
+            cached_response = self.result_cache.get(cache_key)
+            if cached_response is not None:
+                LOGGER.info("TimestreamReader result cache hit %s", self.result_cache.stats())
+                return cached_response
+
         selected_properties = request.selected_properties
      
         property_filter = request.property_filters if request.property_filters else None
-        if property_filter:
-            print(f"\nProperty Filter  = {property_filter}")
-            #
-            # Workaround for twinmaker restriction - in name, replace '_' with '.' to map back to fleetwise names
-            #
-            filter_property_name = property_filter[0]['propertyName'].replace('_', '.')
-            filter_property_operator = property_filter[0]['operator']
-            if 'doubleValue' in property_filter[0]['value']:
-                filter_property_value = property_filter[0]['value']['doubleValue']
-            elif 'booleanValue' in property_filter[0]['value']:
-                filter_property_value = property_filter[0]['value']['booleanValue']
-            else:
-                print(f"\nUnhandled filter value type")
-            filter_clause = f"AND measure_name = '{filter_property_name}' AND measure_value::double {filter_property_operator} {filter_property_value}"
+        filters = self._property_filters(property_filter)
 
-            #print(f"\nFilter clause  = {filter_clause}")
-        else:
-            filter_clause = ""
+        vehicleName = request.udq_context['properties']['vehicleName']['value']['stringValue']
+
+        #
+        # Workaround for '.' in property/measure name.  Map the property names back to the FleetWise measure names
+        # so the query to Timestream works, see udq_utils.property_names
+        #
+        for index, item in enumerate(selected_properties):
+            newitem  = PROPERTY_NAMES.to_signal(item)
+            selected_properties[index] = newitem
+        self._check_signals(selected_properties, filters)
+        selected_properties = self._filtered_measures(selected_properties, filters)
+        if not selected_properties:
+            return IoTTwinMakerUdqResponse([], None)
+        selected_properties, filters = self._resolve_measures(selected_properties, filters)
 
+        cursor = self._decode_cursor(request.next_token)
 
-        vehicleName = request.udq_context['properties']['vehicleName']['value']['stringValue']
+        # long windows can be reduced to what a chart can draw instead of paging through every raw sample
+        downsampling = self._downsampling_mode(request)
+        if downsampling != DOWNSAMPLING_RAW:
+            response = self._downsampled_entity_query(request, vehicleName, selected_properties, filters, downsampling,
+                                                      cursor)
+            if response is not None:
+                self._cache_response(cache_key, request, response)
+                return response
+
+        # polling requests for a short recent window only need the buckets not seen by a previous refresh
+        if self.bucket_cache is not None and not property_filter and cursor is None:
+            response = self._bucketed_entity_query(request, vehicleName, selected_properties)
+            if response is not None:
+                self._cache_response(cache_key, request, response)
+                return response
+
+        # opt-in: wide selections are split into shards queried concurrently and merged on time
+        if self.executor is not None and (self.measure_shards > 1 or self.time_shards > 1) \
+                and (cursor is None or cursor.kind == 'shards'):
+            response = self._sharded_entity_query(request, vehicleName, selected_properties, filters, cursor)
+            self._cache_response(cache_key, request, response)
+            return response
+
+        response = self._timestream_page_query(request, vehicleName, selected_properties, filters, cursor)
+        self._cache_response(cache_key, request, response)
+        return response
+
+    # overrides MultiEntityReader.component_type_query abstractmethod
+    def component_type_query(self, request: IoTTwinMakerUDQComponentTypeRequest) -> IoTTwinMakerUdqResponse:
+        """
+        This is a componentTypeId.propertyId type query across all entities of the component type.
+        A single query selects the matching rows of every vehicle, each row is mapped to an ExternalIdPropertyRef keyed by its
+        vehicleName, so the fleet overview is one invocation and one query instead of one per vehicle
+        """
+        LOGGER.info("TimestreamReader component_type_query")
+
+        cache_key = self._result_cache_key(request) if self.result_cache is not None else None
+        if cache_key is not None:
+            cached_response = self.result_cache.get(cache_key)
+            if cached_response is not None:
+                LOGGER.info("TimestreamReader result cache hit %s", self.result_cache.stats())
+                return cached_response
 
-        sample_sel_properties = [f"p{x}" for x in range(0, len(selected_properties))] # e.g. "p0", "p1", ...
+        # Workaround for '.' in property/measure name, see entity_query
+        measure_names = [PROPERTY_NAMES.to_signal(item) for item in request.selected_properties]
+        filters = self._property_filters(request.property_filters)
+        self._check_signals(measure_names, filters)
+        measure_names = self._filtered_measures(measure_names, filters)
+        if not measure_names:
+            return IoTTwinMakerUdqResponse([], None)
+        measure_names, filters = self._resolve_measures(measure_names, filters)
 
-        sample_measure_name_clause = " OR ".join([f"measure_name = '{x}'" for x in sample_sel_properties])
+        # no entity context: rows are referenced through their vehicleName externalIdProperty
+        response = self._timestream_page_query(request, None, measure_names, filters, self._decode_cursor(request.next_token))
+        self._cache_response(cache_key, request, response)
+        return response
+
+    @staticmethod
+    def _decode_cursor(next_token):
+        """
+        Utility function: decodes the UdqCursor of the request nextToken, None for the first page
+        A plain token, from before the cursor format, is a Timestream NextToken
+        """
+        if not next_token:
+            return None
+        if UdqCursor.is_cursor(next_token):
+            return UdqCursor.decode(next_token)
+        return UdqCursor('timestream', {'t': next_token})
+
+    def _timestream_page_query(self, request, vehicle_name, measure_names, filters, cursor, bin_seconds=None):
+        """
+        Utility function: serves one page of a single Timestream query over the request window
+
+        The nextToken is a 'timestream' UdqCursor: 't' the Timestream NextToken of the query, 'p' the position reached at
+        the end of the previous page, the key of its last row, see TimestreamQueryShard.row_key. A response cut by the
+        UDQ framework resumes with a new query restarting at the position of its last returned row, 'r', instead of
+        re-reading its page: the rows at that time up to that key are skipped. The queries order rows on their full
+        key, so the rows skipped are exactly the rows already returned
+        """
+        state = cursor.state if cursor is not None else {}
+        if cursor is not None and cursor.kind != 'timestream':
+            raise Exception(f"Unexpected nextToken kind[{cursor.kind}]")
+
+        lower, upper = self._window_bounds(request)
+        restart = state.get('r')
+        if restart is not None:
+            TimestreamQueryShard.check_position(restart)
+            restart_ns = timestream_time_to_epoch_nanoseconds(restart[0])
+            if request.order_by == OrderBy.DESCENDING:
+                upper = TimeBound('<=', 'from_nanoseconds', restart_ns)
+            elif timestream_time_to_epoch_nanoseconds(iso8601_to_timestream_time(request.start_time)) < restart_ns:
+                # the bin() label of the first bin can be before the window start
+                lower = TimeBound('>=', 'from_nanoseconds', restart_ns)
+        query = self._measures_query(vehicle_name, measure_names, lower, upper, filters, request.order_by, bin_seconds)
+        query_string = query.query_string
+
+        max_rows = request.max_rows
+        if max_rows and self.multi_measure:
+            # every multi-measure row fans out to up to one row per measure
+            max_rows = max(1, max_rows // len(measure_names))
+        page = self._run_timestream_query(query_string, state.get('t'), max_rows)
+
+        layout = TimestreamColumnLayout.for_schema(page['ColumnInfo'])
+        keys = [TimestreamQueryShard.row_key(row['Data'], layout) for row in page['Rows']]
+        if restart is not None:
+            # rows already returned can only show up at the start of a page of the restarted query
+            skipped = 0
+            while skipped < len(keys) and TimestreamQueryShard.is_emitted(keys[skipped], restart):
+                skipped += 1
+            if skipped:
+                page = dict(page, Rows=page['Rows'][skipped:])
+                del keys[:skipped]
+
+        position = state.get('p', restart)
+        next_token = None
+        if 'NextToken' in page:
+            next_token = UdqCursor('timestream', {
+                't': page['NextToken'],
+                'p': keys[-1] if keys else position,
+                'r': restart,
+            }).encode()
+
+        def resume(rows):
+            restart_position = keys[rows - 1] if rows else position
+            return UdqCursor('timestream', {'r': restart_position}).encode()
+
+        if bin_seconds is not None:
+            # after the cursor positions, which restart on bin() labels
+            data = self._bin_upper_edges([row['Data'] for row in page['Rows']], layout, bin_seconds,
+                                         iso8601_to_timestream_time(request.end_time))
+            page = dict(page, Rows=[{'Data': datum} for datum in data])
+        response = self._convert_timestream_query_page_to_udq_response(page, request.entity_id, request.component_name)
+        return IoTTwinMakerUdqResponse(response.rows, next_token, resume)
+
+    @staticmethod
+    def _bin_upper_edges(data, layout, bin_seconds, window_end):
+        """
+        Utility function: reports the bin() rows at the upper edge of their bin, clamped to window_end, a Timestream time.
+        bin() labels a bin with its start, which for the first bin is at or before the window start the (start, end]
+        window excludes
+        """
+        time_index = layout.time_index
+        bin_nanoseconds = bin_seconds * 1000000000
+        edges = []
+        for datum in data:
+            edge = epoch_nanoseconds_to_timestream_time(
+                timestream_time_to_epoch_nanoseconds(datum[time_index]['ScalarValue']) + bin_nanoseconds)
+            datum = list(datum)
+            datum[time_index] = {'ScalarValue': min(edge, window_end)}
+            edges.append(datum)
+        return edges
+
+    @staticmethod
+    def _property_filters(property_filter):
+        """
+        Utility function: parses the request propertyFilters, every filter restricts the rows of its own property,
+        see _filtered_measures
+        """
+        if not property_filter:
+            return []
 
         #
-        # Workaround for '.' in property/measure name.  Restore all occurrences of _ in the measure name
-        # with '.' so the query to Timestream works.
+        # Workaround for twinmaker restriction - in name, map the property names back to fleetwise names
         #
-        for index, item in enumerate(selected_properties):
-            newitem  = item.replace('_', '.')
-            selected_properties[index] = newitem
+        return [PropertyFilter.parse(f, PROPERTY_NAMES.to_signal(f['propertyName'])) for f in property_filter]
+
+    @staticmethod
+    def _filtered_measures(measure_names, filters):
+        """
+        Utility function: with propertyFilters, only the selected measures that are filtered are queried, e.g.
+        selecting A and B with the filter A > 5 returns the rows of A above 5, and no rows of B.
+        Several filters on different measures return the rows of each filtered measure that pass its own filters
+        """
+        if not filters:
+            return measure_names
+        filtered = {f.measure_name for f in filters}
+        return [measure_name for measure_name in measure_names if measure_name in filtered]
+
+    def _check_signals(self, measure_names, filters):
+        """
+        Utility function: rejects the measures and filters the signal catalog cannot produce before any query runs,
+        a query for them would scan the window and return nothing
+        """
+        signal_index = self.signal_index
+        if signal_index is None:
+            return
+        for measure_name in measure_names:
+            if not signal_index.accepts_measure(measure_name):
+                raise Exception(f"Unknown signal[{measure_name}]")
+        for f in filters:
+            if not signal_index.accepts_filter(f.measure_name, FILTER_VALUE_TYPES[f.value_column]):
+                raise Exception(f"Unsupported filter on signal[{f.measure_name}]: "
+                                f"{FILTER_VALUE_TYPES[f.value_column]} value for {signal_index.signals.get(f.measure_name)} signal")
+
+    @staticmethod
+    def _window_bounds(request):
+        """
+        Utility function: the (start, end] time bounds of the request window
+        """
+        return TimeBound('>', 'from_iso8601_timestamp', request.start_time), \
+            TimeBound('<=', 'from_iso8601_timestamp', request.end_time)
+
+    def _measures_query(self, vehicle_name, measure_names, lower, upper, filters, order_by, bin_seconds=None) -> MeasuresQuery:
+        """
+        Utility function: builds the query selecting the given Timestream measure names between the lower and upper
+        time bounds, for a single vehicle or, if vehicle_name is None, for all vehicles
+        """
+        measure_types = None
+        if self.multi_measure:
+            measure_columns = self._multi_measure_columns()
+            measure_types = {name: measure_columns[name] for name in measure_names}
+        query = MeasuresQuery(self.database_name, self.table_name, measure_names, lower, upper, vehicle_name, filters,
+                              order_by == OrderBy.DESCENDING, bin_seconds, measure_types)
+        if self.sql_detector is not None:
+            # the escaped literals the query was rendered with are checked first, the query is only parsed when one of
+            # them looks suspicious. This guards the query builder's escaping, the request values are not checked here
+            self.sql_detector.detectInjection(query.sample_query, query.query_string, query.literals)
+        return query
+
+    def _resolve_measures(self, measure_names, filters):
+        """
+        Utility function: for a multi-measure table, maps the requested measure names and the measures of the filters
+        to the measure columns of the table. A measure name matches the column with the same property name, see
+        udq_utils.property_names. Measures without a column have no data and are left out
+
+        Single-measure records are queried by measure name, measure names and filters are returned unchanged
+        """
+        if not self.multi_measure:
+            return measure_names, filters
 
-        measure_name_clause = " OR ".join([f"measure_name = '{x}'" for x in selected_properties])
+        columns_by_measure = {PROPERTY_NAMES.to_property(column): column for column in self._multi_measure_columns()}
+        columns = []
+        for measure_name in measure_names:
+            column = columns_by_measure.get(PROPERTY_NAMES.to_property(measure_name))
+            if column is None:
+                LOGGER.warning("No multi-measure column for measure %s", measure_name)
+            elif column not in columns:
+                columns.append(column)
+        if not columns:
+            raise Exception(f"No multi-measure column for measures[{measure_names}]")
+
+        resolved_filters = []
+        for f in filters:
+            column = columns_by_measure.get(PROPERTY_NAMES.to_property(f.measure_name))
+            if column is not None:
+                resolved_filters.append(PropertyFilter(column, f.operator, f.value_column, f.literal))
+        return columns, resolved_filters
+
+    def _multi_measure_columns(self) -> dict:
+        """
+        Utility function: the measure columns of the multi-measure table and their Timestream type, e.g.
+        {'Vehicle.Speed': 'double'}, described once per container
+        see https://docs.aws.amazon.com/timestream/latest/developerguide/supported-sql-constructs.DESCRIBE.html
+        """
+        if self._measure_columns is None:
+            self._measure_columns = describe_multi_measure_columns(self.query_client, self.database_name, self.table_name)
+        return self._measure_columns
+
+    def _bucketed_entity_query(self, request, vehicle_name, measure_names):
+        """
+        Utility function: serves an entity query from time buckets cached per (vehicle, measure)
+
+        The requested window is split into buckets of bucket_seconds aligned on the epoch, each covering (start, end]
+        like the query window does. Completed buckets are cached, so a polling refresh of "the last 15 minutes" only
+        queries Timestream from the earliest bucket it has not seen up to the open bucket at the head, and the cached
+        and fetched rows are stitched back together in the requested order.
+
+        Returns None when the request is not a good fit, in which case the regular paginated query is used: a long
+        window, or a maxResults request the cached buckets cannot answer. The buckets are fetched without a row limit,
+        so a maxResults request, e.g. the latest value of a property, is only served when every bucket is cached and
+        the window holds at most maxResults rows; otherwise no query is spent on buckets
+        """
+        bucket_seconds = self.bucket_seconds
+        try:
+            window_start = iso8601_to_epoch_seconds(request.start_time)
+            window_end = iso8601_to_epoch_seconds(request.end_time)
+        except ValueError:
+            return None
+        first_bucket = int(window_start // bucket_seconds) * bucket_seconds
+        last_bucket = int(math.ceil(window_end / bucket_seconds)) * bucket_seconds - bucket_seconds
+        bucket_starts = range(first_bucket, last_bucket + bucket_seconds, bucket_seconds)
+        if not 0 < len(bucket_starts) <= self.max_buckets:
+            return None
+
+        layout = None
+        buckets = {}
+        missing_measures = []
+        first_missing_bucket = None
+        for measure_name in measure_names:
+            for bucket_start in bucket_starts:
+                entry = self.bucket_cache.get(self._bucket_cache_key(vehicle_name, measure_name, bucket_start))
+                if entry is None:
+                    if measure_name not in missing_measures:
+                        missing_measures.append(measure_name)
+                    if first_missing_bucket is None or bucket_start < first_missing_bucket:
+                        first_missing_bucket = bucket_start
+                else:
+                    layout, buckets[(measure_name, bucket_start)] = entry
+
+        if missing_measures and request.max_rows:
+            return None
+        if missing_measures:
+            fetched_starts = range(first_missing_bucket, last_bucket + bucket_seconds, bucket_seconds)
+            bucket_ends = [epoch_seconds_to_timestream_time(start + bucket_seconds) for start in fetched_starts]
+            fetched = {(measure_name, start): [] for measure_name in missing_measures for start in fetched_starts}
+
+            lower = TimeBound('>', 'from_milliseconds', first_missing_bucket * 1000)
+            upper = TimeBound('<=', 'from_milliseconds', (last_bucket + bucket_seconds) * 1000)
+            query_string = self._measures_query(vehicle_name, missing_measures, lower, upper, [], OrderBy.ASCENDING).query_string
+            for page in self._run_timestream_query_pages(query_string):
+                layout = TimestreamColumnLayout.for_schema(page['ColumnInfo'])
+                for row in page['Rows']:
+                    datum = row['Data']
+                    bucket_index = bisect_left(bucket_ends, datum[layout.time_index]['ScalarValue'])
+                    if bucket_index < len(fetched_starts):
+                        key = (datum[layout.measure_name_index]['ScalarValue'], fetched_starts[bucket_index])
+                        if key in fetched:
+                            fetched[key].append(datum)
+
+            # only buckets that no longer receive data are cached, the open bucket at the head is re-read next time
+            settled_before = time.time() - self.bucket_cache.settle_seconds
+            for (measure_name, bucket_start), data in fetched.items():
+                if bucket_start + bucket_seconds <= settled_before:
+                    self.bucket_cache.put(self._bucket_cache_key(vehicle_name, measure_name, bucket_start), (layout, data),
+                                          self.bucket_cache.historical_ttl_seconds, timestream_data_size(data))
+            buckets.update(fetched)
+
+        # stitch the buckets back together, trimmed to the requested (start, end] window
+        window_start_time = iso8601_to_timestream_time(request.start_time)
+        window_end_time = iso8601_to_timestream_time(request.end_time)
+        time_index = layout.time_index
+        data = [datum for rows in buckets.values() for datum in rows
+                if window_start_time < datum[time_index]['ScalarValue'] <= window_end_time]
+        if request.max_rows and len(data) > request.max_rows:
+            return None
+        # in the order of the paginated query, see TimestreamQueryShard
+        data.sort(key=lambda datum: TimestreamQueryShard.row_key(datum, layout)[1:])
+        data.sort(key=lambda datum: datum[time_index]['ScalarValue'], reverse=request.order_by == OrderBy.DESCENDING)
+
+        columns = TimestreamPageColumns(data, layout, request.entity_id, request.component_name)
+        return IoTTwinMakerUdqResponse(TimestreamPageRows(columns), None)
+
+    def _sharded_entity_query(self, request, vehicle_name, measure_names, filters, cursor):
+        """
+        Utility function: serves an entity query by splitting it into shards run concurrently on the executor
+
+        The selected measures are split round-robin into measure_shards groups and the (start, end] window into
+        time_shards equal ranges. Every shard is an ordinary query sorted on time, the first page of all shards is
+        requested at once and each shard prefetches its next page while the current one is consumed. The shards are
+        combined with a streaming k-way merge on time until maxResults rows (or shard_page_rows) are emitted.
+
+        The returned nextToken is a 'shards' UdqCursor holding the position of every shard, so the next request resumes
+        each shard exactly where the merge stopped, also when the UDQ framework cuts the response
+        """
+        descending = request.order_by == OrderBy.DESCENDING
+        page_rows = request.max_rows or self.shard_page_rows
 
-        #if property_filter:
-          #  sample_query = f"SELECT vehicleName, campaignName, measure_name, time, measure_value::bigint FROM {self.database_name}.{self.table_name} WHERE vehicleName = vehicleName AND measure_value::varchar {property_filter['operator']} 'abc' ORDER BY time ASC LIMIT 18"
-        #else:
-         #   sample_query = f"SELECT vehicleName, campaignName, measure_name, time, measure_value::bigint FROM {self.database_name}.{self.table_name} WHERE vehicleName = vehicleName ORDER BY time ASC LIMIT 18"
+        group_count = max(1, min(self.measure_shards, len(measure_names)))
+        groups = [measure_names[i::group_count] for i in range(group_count)]
+        window_start = timestream_time_to_epoch_nanoseconds(iso8601_to_timestream_time(request.start_time))
+        window_end = timestream_time_to_epoch_nanoseconds(iso8601_to_timestream_time(request.end_time))
+        time_count = max(1, self.time_shards)
+        bounds = [window_start + (window_end - window_start) * i // time_count for i in range(time_count + 1)]
 
-        query_string = f"SELECT vehicleName, campaignName, measure_name, time, measure_value::boolean, measure_value::double" \
-                       f" FROM {self.database_name}.{self.table_name}" \
-                       f""" WHERE time > from_iso8601_timestamp('{request.start_time}')""" \
-                       f""" AND time <= from_iso8601_timestamp('{request.end_time}')""" \
-                       f" AND vehicleName = '{vehicleName}'" \
-                       f" AND ({measure_name_clause})" \
-                       f" {filter_clause}" \
-                       f" ORDER BY time {'ASC' if request.order_by == OrderBy.ASCENDING else 'DESC'}" 
-        # ignore sql injection checks for now
-        # self.sqlDetector.detectInjection(sample_query, query_string)
+        shards = []
+        for group in groups:
+            for i in range(time_count):
+                shard = TimestreamQueryShard(bounds[i], bounds[i + 1])
+                if cursor is not None:
+                    shard.resume_from(cursor.state['p'][len(shards)])
+                if not shard.done:
+                    lower, upper = shard.time_bounds(descending)
+                    query_string = self._measures_query(vehicle_name, group, lower, upper, filters, request.order_by).query_string
+                    shard.start(self.executor, self.query_client, query_string, page_rows)
+                shards.append(shard)
 
-        page = self._run_timestream_query(query_string, request.next_token, request.max_rows)
+        # streaming k-way merge, the heap holds the head row of every shard that still has rows
+        start_positions = [shard.position() for shard in shards]
+        heap = []
+        for index, shard in enumerate(shards):
+            self._push_shard_head(heap, shard, index, descending)
+        data = []
+        origins = []
+        while heap and len(data) < page_rows:
+            index, datum = heapq.heappop(heap)[3:]
+            shards[index].emit(datum)
+            data.append(datum)
+            origins.append(index)
+            self._push_shard_head(heap, shards[index], index, descending)
+        for shard in shards:
+            shard.close()
 
-        return self._convert_timestream_query_page_to_udq_response(page, request.entity_id, request.component_name)
+        next_token = UdqCursor('shards', {'p': [shard.position() for shard in shards]}).encode() if heap else None
+        layouts = [shard.layout for shard in shards if shard.layout is not None]
+        if not layouts:
+            return IoTTwinMakerUdqResponse([], next_token)
 
+        def resume(rows):
+            # the shard positions after the first rows of the merge
+            positions = list(start_positions)
+            for datum, index in zip(data[:rows], origins):
+                positions[index] = TimestreamQueryShard.row_key(datum, shards[index].layout)
+            return UdqCursor('shards', {'p': positions}).encode()
+
+        columns = TimestreamPageColumns(data, layouts[0], request.entity_id, request.component_name)
+        return IoTTwinMakerUdqResponse(TimestreamPageRows(columns), next_token, resume)
+
+    @staticmethod
+    def _push_shard_head(heap, shard, index, descending):
+        # merged on the row key, so the rows come in the order of a single query, see TimestreamQueryShard
+        datum = shard.next_row()
+        if datum is not None:
+            row_time, vehicle_name, measure_name = TimestreamQueryShard.row_key(datum, shard.layout)
+            heapq.heappush(heap, (DescendingKey(row_time) if descending else row_time, vehicle_name, measure_name,
+                                  index, datum))
+
+    @staticmethod
+    def _downsampling_mode(request):
+        """
+        Utility function: reads the downsampling mode of the entity from its DOWNSAMPLING_PROPERTY, raw by default
+        """
+        mode = request.udq_context['properties'].get(DOWNSAMPLING_PROPERTY, {}).get('value', {}).get('stringValue')
+        if not mode:
+            return DOWNSAMPLING_RAW
+        mode = mode.lower()
+        if mode not in DOWNSAMPLING_MODES:
+            raise Exception(f"Unsupported downsampling mode[{mode}], expected one of {DOWNSAMPLING_MODES}")
+        return mode
+
+    def _downsampled_entity_query(self, request, vehicle_name, measure_names, filters, mode, cursor):
+        """
+        Utility function: serves an entity query at a resolution derived from the window length and maxResults
+
+        Each measure gets maxResults / len(measures) points (max_downsampled_points without maxResults), spread over the
+        window. In bin mode the aggregation is pushed to Timestream with bin() and paginates like a raw query; the lttb
+        and minmax modes read bin() averages at PRE_AGGREGATION_FACTOR times the points, so the rows held in memory are
+        bounded whatever the window, and reduce them with a shape-preserving reducer.
+        Every bin is reported at its upper edge, clamped to the window end, see _bin_upper_edges
+
+        Returns None when the window is already short enough to be served raw
+        """
+        try:
+            window_seconds = iso8601_to_epoch_seconds(request.end_time) - iso8601_to_epoch_seconds(request.start_time)
+        except ValueError:
+            return None
+        points_per_measure = max(2, (request.max_rows or self.max_downsampled_points) // len(measure_names))
+        bin_seconds = int(math.ceil(window_seconds / points_per_measure))
+        if bin_seconds <= 1:
+            return None
+
+        if mode == DOWNSAMPLING_BIN:
+            # booleans are aggregated to 1.0 if true anywhere in the bin, matching the float conversion of raw booleans
+            return self._timestream_page_query(request, vehicle_name, measure_names, filters, cursor, bin_seconds)
+
+        lower, upper = self._window_bounds(request)
+        pre_bin_seconds = int(math.ceil(window_seconds / (points_per_measure * PRE_AGGREGATION_FACTOR)))
+        query_string = self._measures_query(vehicle_name, measure_names, lower, upper, filters, OrderBy.ASCENDING,
+                                            pre_bin_seconds).query_string
+        window_end = iso8601_to_timestream_time(request.end_time)
+        layout = None
+        rows_by_measure = {}
+        for page in self._run_timestream_query_pages(query_string):
+            layout = TimestreamColumnLayout.for_schema(page['ColumnInfo'])
+            for datum in self._bin_upper_edges([row['Data'] for row in page['Rows']], layout, pre_bin_seconds, window_end):
+                rows_by_measure.setdefault(datum[layout.measure_name_index]['ScalarValue'], []).append(datum)
+
+        reducer = lttb_indices if mode == DOWNSAMPLING_LTTB else min_max_indices
+        data = []
+        for measure_data in rows_by_measure.values():
+            times = [timestream_time_to_epoch_nanoseconds(datum[layout.time_index]['ScalarValue']) for datum in measure_data]
+            values = TimestreamPageDecoder.decode_values(measure_data, layout)
+            data.extend(measure_data[index] for index in reducer(times, values, points_per_measure))
+        if request.order_by == OrderBy.DESCENDING:
+            data.sort(key=lambda datum: datum[layout.time_index]['ScalarValue'], reverse=True)
+        else:
+            data.sort(key=lambda datum: datum[layout.time_index]['ScalarValue'])
+
+        columns = TimestreamPageColumns(data, layout, request.entity_id, request.component_name)
+        return IoTTwinMakerUdqResponse(TimestreamPageRows(columns), None)
+
+    def _bucket_cache_key(self, vehicle_name, measure_name, bucket_start):
+        return (self.database_name, self.table_name, vehicle_name, measure_name, self.bucket_seconds, bucket_start)
+
+    def _cache_response(self, cache_key, request, response):
+        """
+        Utility function: keeps the response in the result cache, sized by the serialized size of its rows
+        A response whose nextToken holds a Timestream NextToken is not cached: the NextToken is only valid for an hour
+        and 5 uses, and the prefetcher already spends one
+        """
+        if cache_key is None:
+            return
+        if response.next_token and UdqCursor.decode(response.next_token).state.get('t') is not None:
+            return
+        size = response.rows.serialized_size() if isinstance(response.rows, TimestreamPageRows) else 0
+        self.result_cache.put(cache_key, response, self.result_cache.ttl_for_window(request.end_time), size)
+
+    @staticmethod
+    def _result_cache_key(request):
+        """
+        Utility function: normalizes an entity request into a hashable result cache key
+        The order of selectedProperties does not change the rows returned, so they are sorted
+        """
+        vehicle_value = request.udq_context['properties'].get('vehicleName', {}).get('value', {})
+        return (
+            request.entity_id,
+            request.component_name,
+            request.component_type_id,
+            vehicle_value.get('stringValue'),
+            tuple(sorted(request.selected_properties)),
+            request.start_time,
+            request.end_time,
+            json.dumps(request.property_filters, sort_keys=True),
+            request.order_by,
+            request.next_token,
+            request.max_rows,
+            TimestreamReader._downsampling_mode(request),
+        )
 
     def _run_timestream_query(self, query_string, next_token, max_rows) -> dict:
         """
         Utility function: handles executing the given query_string on AWS Timestream. Returns an AWS Timestream Query Page
         see https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/timestream-query.html#TimestreamQuery.Client.query
+
+        When a prefetcher is configured, the page following the returned one is requested in the background while this
+        page is marshalled, so the follow-up invocation with that NextToken is served from the warm container
         """
         #LOGGER.info("Query string is %s", query_string)
+        metrics = udq_metrics.current()
         try:
-            # Timestream SDK returns error if None is passed for NextToken and MaxRows
-            if next_token and max_rows:
-                page = self.query_client.query(QueryString=query_string, NextToken=next_token, MaxRows=max_rows)
-            elif next_token:
-                page = self.query_client.query(QueryString=query_string, NextToken=next_token)
-            elif max_rows:
-                page = self.query_client.query(QueryString=query_string, MaxRows=max_rows)
-                # skip empty pages returned by Timestream
-                # passing in MaxRows but no NextToken, if we have more than MaxRows available we get back a NextToken and no results, and reissue the query
-                while 'NextToken' in page and len(page['Rows']) == 0:
-                    page = self.query_client.query(QueryString=query_string, NextToken=page['NextToken'], MaxRows=max_rows)
-            else:
-                page = self.query_client.query(QueryString=query_string)
+            start = metrics.clock()
+            page = None
+            if self.prefetcher is not None and next_token:
+                page = self.prefetcher.take(query_string, next_token, max_rows)
+                if page is not None:
+                    metrics.add_count('prefetch_hits')
+            if page is None:
+                page = query_non_empty_timestream_page(self.query_client, query_string, next_token, max_rows)
+                metrics.add_count('timestream_queries')
+            metrics.add_duration('timestream', start)
+            metrics.add_count('pages')
+
+            if self.prefetcher is not None and 'NextToken' in page:
+                self.prefetcher.prefetch(self.query_client, query_string, page['NextToken'], max_rows)
 
-            #print(f"Result page = {page}")
-            return page
+            return TimestreamMultiMeasureFanOut.fan_out(page)
 
         except Exception as err:
             LOGGER.error("Exception while running query: %s", err)
             raise err
 
+    def _run_timestream_query_pages(self, query_string):
+        """
+        Utility function: yields every page of the given query_string, following NextToken until the result is exhausted
+        """
+        metrics = udq_metrics.current()
+        try:
+            start = metrics.clock()
+            page = self.query_client.query(QueryString=query_string)
+            metrics.add_duration('timestream', start)
+            metrics.add_count('timestream_queries')
+            metrics.add_count('pages')
+            yield TimestreamMultiMeasureFanOut.fan_out(page)
+            while 'NextToken' in page:
+                start = metrics.clock()
+                page = self.query_client.query(QueryString=query_string, NextToken=page['NextToken'])
+                metrics.add_duration('timestream', start)
+                metrics.add_count('pages')
+                yield TimestreamMultiMeasureFanOut.fan_out(page)
+        except Exception as err:
+            LOGGER.error("Exception while running query: %s", err)
+            raise err
+
     @staticmethod
     def _convert_timestream_query_page_to_udq_response(query_result_page, entity_id, component_name):
         """
         Utility function: handles converting an AWS Timestream Query Result Page into a IoTTwinMakerUdqResponse object
-        For each IoTTwinMakerDataRow, we include:
-        - the raw row data from Timestream after incorporating the workaround mentioned below
-        - the column schema from Timestream we can later use to interpret the row
-        - and the entity_id, component_name as context for constructing the entityPropertyReference
+        The page is decoded column-wise by the TimestreamPageDecoder on first access and each IoTTwinMakerDataRow is
+        a view on one position of the decoded columns, created while the rows are iterated, with the entity_id,
+        component_name kept once on the page as context for constructing the entityPropertyReference
         """
         #LOGGER.info("Query result is %s", query_page)
-        #
-        # Workaround for '.' in property/measure name.  Restore all occurrences of '.' in the measure name
-        # with '_' so the API issuer request and response are matched.  This is done only for measure names 
-        #
-        converted_rows = []
-        schema = query_result_page['ColumnInfo']
-        for row in query_result_page['Rows']:
-            raw_row = TimestreamDataRow(row, schema, entity_id, component_name)
-            
-            # replace '_' with '.'
-            converted_name = raw_row._row_as_dict['measure_name'].replace('.', '_')
-            raw_row._row_as_dict['measure_name'] = converted_name
-            converted_rows.append(raw_row)
+        columns = TimestreamPageDecoder.decode(query_result_page, entity_id, component_name)
 
         # return udq response
-        return IoTTwinMakerUdqResponse(converted_rows, query_result_page.get('NextToken'))
+        return IoTTwinMakerUdqResponse(TimestreamPageRows(columns), query_result_page.get('NextToken'))
+
+
+class TimestreamColumnLayout:
+    """
+    The resolved column positions for a Timestream ColumnInfo schema
+
+    Every page of a query shares the same ColumnInfo, so the column indexes are resolved once per distinct schema
+    and the layout is reused for all pages decoded against it
+    """
+
+    # columns holding the measure value, in the order they are checked for a non-null value
+    # booleans are converted to float to work around a twinmaker model shader 'limitation'
+    VALUE_COLUMNS = [
+        ('measure_value::varchar', str),
+        ('measure_value::double', float),
+        ('measure_value::bigint', float),
+        ('measure_value::boolean', lambda val: float(1) if val == 'true' else float(0)),
+    ]
+
+    _LAYOUTS = {}
+
+    def __init__(self, column_schema):
+        names = []
+        for info in column_schema:
+            if 'ScalarType' not in info['Type']:
+                raise Exception(f"Unsupported columnType[{info['Type']}]")
+            names.append(info['Name'])
+
+        self.names = names
+        self.time_index = self._index_of('time')
+        self.measure_name_index = self._index_of('measure_name')
+        self.vehicle_name_index = self._index_of('vehicleName')
+        self.value_columns = [(names.index(name), converter) for name, converter in self.VALUE_COLUMNS if name in names]
+
+    def _index_of(self, name):
+        return self.names.index(name) if name in self.names else None
+
+    @classmethod
+    def for_schema(cls, column_schema):
+        """
+        Returns the shared layout for the given ColumnInfo, resolving it on first use
+        """
+        key = tuple(info['Name'] for info in column_schema)
+        layout = cls._LAYOUTS.get(key)
+        if layout is None:
+            layout = cls._LAYOUTS[key] = cls(column_schema)
+        return layout
+
+
+class TimestreamMultiMeasureFanOut:
+    """
+    Fans the rows of a multi-measure query page out into single-measure rows
+
+    A multi-measure row carries every measure in its own typed column, e.g. vehicleName, time, "Vehicle.Speed",
+    "Vehicle.Powertrain.Battery.FanRunning". It becomes one row per non-null measure with the vehicleName,
+    measure_name, time and measure_value::<type> columns of single-measure records, so the fanned out page is decoded,
+    cached, merged and paged like any other page. The datums of the page are shared by the fanned out rows.
+    The fan out of each distinct ColumnInfo is resolved once, like TimestreamColumnLayout
+    """
+
+    # columns of a multi-measure query that are not measures
+    DIMENSION_COLUMNS = ('vehicleName', 'time')
+    NULL_DATUM = {'NullValue': True}
+
+    _FAN_OUTS = {}
+
+    # every fanned out page has the same columns, so pages of different measure groups can be merged and cached together
+    COLUMN_SCHEMA = [
+        {'Name': 'vehicleName', 'Type': {'ScalarType': 'VARCHAR'}},
+        {'Name': 'measure_name', 'Type': {'ScalarType': 'VARCHAR'}},
+        {'Name': 'time', 'Type': {'ScalarType': 'TIMESTAMP'}},
+    ] + [{'Name': name, 'Type': {'ScalarType': name.partition('::')[2].upper()}} for name in MEASURE_VALUE_COLUMNS.values()]
+
+    def __init__(self, column_schema):
+        value_columns = list(MEASURE_VALUE_COLUMNS.values())
+        measures = []
+        for index, info in enumerate(column_schema):
+            if info['Name'] in self.DIMENSION_COLUMNS:
+                continue
+            value_column = MEASURE_VALUE_COLUMNS.get(info['Type'].get('ScalarType', '').lower())
+            if value_column is None:
+                raise Exception(f"Unsupported multi-measure columnType[{info['Type']}]")
+            # (column index, measure_name datum, position of its value in the fanned out row)
+            measures.append((index, {'ScalarValue': info['Name']}, 3 + value_columns.index(value_column)))
+
+        names = [info['Name'] for info in column_schema]
+        self.vehicle_name_index = names.index('vehicleName') if 'vehicleName' in names else None
+        self.time_index = names.index('time')
+        self.measures = measures
+
+    @classmethod
+    def fan_out(cls, query_result_page) -> dict:
+        """
+        Returns the page with its multi-measure rows fanned out, pages of single-measure records are returned as is
+        """
+        column_schema = query_result_page['ColumnInfo']
+        key = tuple((info['Name'], info['Type'].get('ScalarType')) for info in column_schema)
+        fan_out = cls._FAN_OUTS.get(key)
+        if fan_out is None:
+            if any(info['Name'] == 'measure_name' for info in column_schema):
+                cls._FAN_OUTS[key] = False
+                return query_result_page
+            fan_out = cls._FAN_OUTS[key] = cls(column_schema)
+        elif fan_out is False:
+            return query_result_page
+
+        vehicle_name_index = fan_out.vehicle_name_index
+        time_index = fan_out.time_index
+        measures = fan_out.measures
+        null = cls.NULL_DATUM
+        empty_values = [null] * len(MEASURE_VALUE_COLUMNS)
+        rows = []
+        for row in query_result_page['Rows']:
+            datum = row['Data']
+            vehicle_name = datum[vehicle_name_index] if vehicle_name_index is not None else null
+            row_time = datum[time_index]
+            for index, measure_name, value_index in measures:
+                value = datum[index]
+                if 'ScalarValue' in value:
+                    data = [vehicle_name, measure_name, row_time] + empty_values
+                    data[value_index] = value
+                    rows.append({'Data': data})
+        return dict(query_result_page, ColumnInfo=cls.COLUMN_SCHEMA, Rows=rows)
+
+
+class TimestreamPageColumns:
+    """
+    A Timestream query page decoded into typed columns
+
+    - times: ISO8601 basic timestamps, e.g. '2022-04-06T00:17:45.419000000Z'
+    - measure_names: measure names with '.' replaced by '_' to match the IoT TwinMaker property names
+    - values: python-native values, see TimestreamColumnLayout.VALUE_COLUMNS
+    - vehicle_names: the vehicleName of each row if selected by the query, otherwise None
+
+    Each column is decoded from the raw Timestream rows on first access, so columns that are never read are never built
+    The IoTTwinMakerReference of the rows is built once per distinct property, rows of the same property share it
+    """
+
+    __slots__ = ('_data', '_layout', '_times', '_measure_names', '_values', '_vehicle_names', '_references',
+                 'entity_id', 'component_name')
+
+    def __init__(self, data, layout, entity_id=None, component_name=None):
+        self._data = data
+        self._layout = layout
+        self._times = None
+        self._measure_names = None
+        self._values = None
+        self._vehicle_names = None
+        self._references = {}
+        self.entity_id = entity_id
+        self.component_name = component_name
+
+    @property
+    def row_count(self):
+        return len(self._data)
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def times(self):
+        if self._times is None:
+            self._times = self._decode(TimestreamPageDecoder.decode_times)
+        return self._times
+
+    @property
+    def measure_names(self):
+        if self._measure_names is None:
+            self._measure_names = self._decode(TimestreamPageDecoder.decode_measure_names)
+        return self._measure_names
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = self._decode(TimestreamPageDecoder.decode_values)
+        return self._values
+
+    @property
+    def vehicle_names(self):
+        if self._vehicle_names is None and self._layout.vehicle_name_index is not None:
+            self._vehicle_names = self._decode(TimestreamPageDecoder.decode_vehicle_names)
+        return self._vehicle_names
+
+    def _decode(self, decoder):
+        metrics = udq_metrics.current()
+        start = metrics.clock()
+        column = decoder(self._data, self._layout)
+        metrics.add_duration('conversion', start)
+        return column
+
+    def reference(self, index) -> IoTTwinMakerReference:
+        """
+        For single-entity queries, the entity_id and component_name values are passed in, use those to construct the 'EntityComponentPropertyRef'
+        For component type queries, the vehicleName of the row is the externalIdProperty of its entity, use that to construct the 'ExternalIdPropertyRef'
+        """
+        property_name = self.measure_names[index]
+        key = property_name if self.entity_id is not None else (self.vehicle_names[index], property_name)
+        reference = self._references.get(key)
+        if reference is None:
+            if self.entity_id is None:
+                reference = IoTTwinMakerReference(eip=ExternalIdPropertyRef({'vehicleName': key[0]}, property_name))
+            else:
+                reference = IoTTwinMakerReference(ecp=EntityComponentPropertyRef(self.entity_id, self.component_name, property_name))
+            self._references[key] = reference
+        return reference
+
+
+class TimestreamPageRows(Sequence):
+    """
+    The IoTTwinMakerDataRow sequence for a decoded page
+
+    Row views are created while the sequence is iterated instead of being materialized for the whole page up front
+    """
+
+    __slots__ = ('_columns',)
+
+    def __init__(self, columns: TimestreamPageColumns):
+        self._columns = columns
+
+    def __len__(self):
+        return self._columns.row_count
+
+    def serialized_size(self) -> int:
+        return timestream_data_size(self._columns.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [TimestreamDataRow(self._columns, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return TimestreamDataRow(self._columns, index)
+
+    def __iter__(self):
+        columns = self._columns
+        for index in range(columns.row_count):
+            yield TimestreamDataRow(columns, index)
+
+
+class TimestreamPageDecoder:
+    """
+    Decodes a whole Timestream query page at once instead of parsing row by row
+
+    Example:
+    column=[
+        {'Name': 'vehicleName', 'Type': {'ScalarType': 'VARCHAR'}},
+        {'Name': 'measure_name', 'Type': {'ScalarType': 'VARCHAR'}},
+        {'Name': 'time', 'Type': {'ScalarType': 'TIMESTAMP'}},
+        {'Name': 'measure_value::double', 'Type': {'ScalarType': 'DOUBLE'}},
+        {'Name': 'measure_value::boolean', 'Type': {'ScalarType': 'BOOLEAN'}}
+    ]
+    rows=[
+        {'Data': [{'ScalarValue': 'vehicle1'}, {'ScalarValue': 'Vehicle.Speed'},
+                  {'ScalarValue': '2021-10-15 20:45:43.287000000'}, {'ScalarValue': '42.0'}, {'NullValue': True}]},
+        {'Data': [{'ScalarValue': 'vehicle1'}, {'ScalarValue': 'Vehicle.Powertrain.Battery.FanRunning'},
+                  {'ScalarValue': '2021-10-15 20:45:43.287000000'}, {'NullValue': True}, {'ScalarValue': 'true'}]}
+    ]
+
+    ->
+
+    times=['2021-10-15T20:45:43.287000000Z', '2021-10-15T20:45:43.287000000Z']
+    measure_names=['Vehicle_Speed', 'Vehicle_Powertrain_Battery_FanRunning']
+    values=[42.0, 1.0]
+    vehicle_names=['vehicle1', 'vehicle1']
+    """
+
+    @staticmethod
+    def decode(query_result_page, entity_id=None, component_name=None) -> TimestreamPageColumns:
+        layout = TimestreamColumnLayout.for_schema(query_result_page['ColumnInfo'])
+        data = [row['Data'] for row in query_result_page['Rows']]
+        return TimestreamPageColumns(data, layout, entity_id, component_name)
+
+    @staticmethod
+    def decode_times(data, layout):
+        time_index = layout.time_index
+        return [datum[time_index]['ScalarValue'].replace(' ', 'T') + 'Z' for datum in data]
+
+    @staticmethod
+    def decode_measure_names(data, layout):
+        # only a handful of distinct measure names show up in a page, convert each of them once
+        converted_names = {}
+        measure_names = []
+        name_index = layout.measure_name_index
+        for datum in data:
+            name = datum[name_index]['ScalarValue']
+            converted = converted_names.get(name)
+            if converted is None:
+                converted = converted_names[name] = PROPERTY_NAMES.to_property(name)
+            measure_names.append(converted)
+        return measure_names
+
+    @staticmethod
+    def decode_vehicle_names(data, layout):
+        vehicle_index = layout.vehicle_name_index
+        return [datum[vehicle_index].get('ScalarValue') for datum in data]
+
+    @staticmethod
+    def decode_values(data, layout):
+        """
+        Utility function: picks the first non-null value column of each row and converts it to a python-native type
+        """
+        value_columns = layout.value_columns
+        values = []
+        for datum in data:
+            for index, converter in value_columns:
+                # a NullValue datum has no ScalarValue, so get() reads it as None
+                val = datum[index].get('ScalarValue')
+                if val is not None:
+                    values.append(converter(val))
+                    break
+            else:
+                print("\nUnhandled type")
+                raise ValueError(f"Unhandled type in timestream row: {datum}")
+        return values
 
 
 class TimestreamDataRow(IoTTwinMakerDataRow):
     """
     The AWS IoT TwinMaker data row implementation for our Timestream data
 
+    Each row is a slotted view on one position of a TimestreamPageColumns, the schema layout and the
+    entity_id, component_name context are shared by all rows of the page.
     It supports the IoTTwinMakerDataRow interface to:
     - calculate the IoTTwinMakerReference ("entityPropertyReference") for a Timestream row
     - extract the timestamp from a Timestream row
     - extract the value from a Timestream row
     """
 
-    def __init__(self, timestream_row, timestream_column_schema, entity_id=None, component_name=None, _vehicle_name=None):
-        self._timestream_row = timestream_row
-        self._timestream_column_schema = timestream_column_schema
-        self._row_as_dict = self._parse_row(timestream_column_schema, timestream_row)
-        self._entity_id = entity_id
-        self._component_name = component_name
-        self._vehicle_name = _vehicle_name
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns: TimestreamPageColumns, index: int):
+        self._columns = columns
+        self._index = index
 
     # overrides IoTTwinMakerDataRow.get_iottwinmaker_reference abstractmethod
     def get_iottwinmaker_reference(self) -> IoTTwinMakerReference:
         """
-        This function calculates the IoTTwinMakerReference ("entityPropertyReference") for a Timestream row
-
-        For single-entity queries, the entity_id and component_name values are passed in, use those to construct the 'EntityComponentPropertyRef'
+        This function returns the IoTTwinMakerReference ("entityPropertyReference") for a Timestream row,
+        see TimestreamPageColumns.reference
         """
-        property_name = self._row_as_dict['measure_name']
-        return IoTTwinMakerReference(ecp=EntityComponentPropertyRef(self._entity_id, self._component_name, property_name))
+        return self._columns.reference(self._index)
 
     # overrides IoTTwinMakerDataRow.get_iso8601_timestamp abstractmethod
     def get_iso8601_timestamp(self) -> str:
         """
-        This function extracts the timestamp from a Timestream row and returns in ISO8601 basic format
+        This function returns the timestamp of the row in ISO8601 basic format
         e.g. '2022-04-06 00:17:45.419000000' -> '2022-04-06T00:17:45.419000000Z'
         """
-        return self._row_as_dict['time'].replace(' ', 'T') + 'Z'
+        return self._columns.times[self._index]
 
     # overrides IoTTwinMakerDataRow.get_value abstractmethod
     def get_value(self):
         """
-        This function extracts the value from a Timestream row
+        This function returns the value of the row as a native python type
+        """
+        return self._columns.values[self._index]
+
+    def __str__(self):
+        return str({
+            'measure_name': self._columns.measure_names[self._index],
+            'time': self.get_iso8601_timestamp(),
+            'value': self.get_value(),
+        })
+
+
+def query_timestream_page(query_client, query_string, next_token=None, max_rows=None) -> dict:
+    """
+    Utility function: requests a single Timestream query page
+    """
+    # Timestream SDK returns error if None is passed for NextToken and MaxRows
+    if next_token and max_rows:
+        return query_client.query(QueryString=query_string, NextToken=next_token, MaxRows=max_rows)
+    elif next_token:
+        return query_client.query(QueryString=query_string, NextToken=next_token)
+    elif max_rows:
+        return query_client.query(QueryString=query_string, MaxRows=max_rows)
+    else:
+        return query_client.query(QueryString=query_string)
+
+
+def query_non_empty_timestream_page(query_client, query_string, next_token=None, max_rows=None) -> dict:
+    """
+    Utility function: requests a Timestream query page, skipping the empty pages returned by Timestream
+    While a query is still running, Timestream can return a NextToken and no results. Those pages are followed here in
+    the same invocation instead of handing an empty page back to IoT TwinMaker, which would cost a full round trip
+    """
+    page = query_timestream_page(query_client, query_string, next_token, max_rows)
+    while 'NextToken' in page and len(page['Rows']) == 0:
+        page = query_timestream_page(query_client, query_string, page['NextToken'], max_rows)
+    return page
+
+
+# serialized size of a datum without its value, with its separator
+DATUM_SIZE = len(json.dumps({'ScalarValue': ''})) + len(', ')
+# rows measured by timestream_data_size, the size of longer data is extrapolated from evenly spaced rows
+DATA_SIZE_SAMPLE_ROWS = 256
+
+
+def timestream_data_size(data) -> int:
+    """
+    Utility function: size in bytes of the data of Timestream rows serialized as JSON, an estimate of the memory they
+    hold. The datums shared by the rows of a fanned out multi-measure page are counted for every row
+    """
+    step = max(1, len(data) // DATA_SIZE_SAMPLE_ROWS)
+    sample = data[::step]
+    size = sum(len(datum) * DATUM_SIZE + sum(len(value.get('ScalarValue', '')) for value in datum) for datum in sample)
+    return size * len(data) // len(sample) if sample else 0
 
-        Check for supported types. We return the value back as a native python type
+
+class TimestreamPagePrefetcher:
+    """
+    Fetches the next page of a query in the background and keeps it for the follow-up invocation
+
+    Prefetched pages are kept in a bounded cache keyed by (query_string, next_token, max_rows), the oldest entry is
+    dropped once max_pages is reached. A prefetch that failed is dropped as well and the page is simply requested again
+    """
+
+    def __init__(self, executor, max_pages):
+        self.executor = executor
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, query_client, query_string, next_token, max_rows):
+        key = (query_string, next_token, max_rows)
+        with self._lock:
+            if key in self._pages:
+                return
+            self._pages[key] = self.executor.submit(query_non_empty_timestream_page, query_client, query_string,
+                                                    next_token, max_rows)
+            while len(self._pages) > self.max_pages:
+                _, future = self._pages.popitem(last=False)
+                future.cancel()
+
+    def take(self, query_string, next_token, max_rows):
+        """
+        Returns the prefetched page for the given token, or None if it was not prefetched (or the prefetch failed)
         """
-        if 'measure_value::varchar' in self._row_as_dict and self._row_as_dict['measure_value::varchar'] is not None:
-            return self._row_as_dict['measure_value::varchar']
-        elif 'measure_value::double' in self._row_as_dict and self._row_as_dict['measure_value::double'] is not None:
-            return float(self._row_as_dict['measure_value::double'])
-        elif 'measure_value::bigint' in self._row_as_dict and self._row_as_dict['measure_value::bigint'] is not None:
-            return float(self._row_as_dict['measure_value::bigint'])
-        elif 'measure_value::boolean' in self._row_as_dict and self._row_as_dict['measure_value::boolean'] is not None:
-            boolval = self._row_as_dict['measure_value::boolean']
+        with self._lock:
+            future = self._pages.pop((query_string, next_token, max_rows), None)
+            if future is None:
+                self.misses += 1
+                return None
+        try:
+            page = future.result()
+        except Exception as err:
+            LOGGER.warning("Discarding failed page prefetch: %s", err)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return page
 
-            # convert the boolean to float to work around a twinmaker model shader 'limitation'
-            if (boolval == 'true'):
-                return float(1)
-            else:
-                return float(0)
+
+def describe_multi_measure_columns(query_client, database_name, table_name) -> dict:
+    """
+    Utility function: describes the measure columns of a multi-measure table with their Timestream type
+    e.g. {'Vehicle.Speed': 'double', 'Vehicle.Powertrain.Battery.FanRunning': 'boolean'}
+    """
+    query_string = f"DESCRIBE {database_name}.{table_name}"
+    columns = {}
+    next_token = None
+    while True:
+        page = query_timestream_page(query_client, query_string, next_token)
+        names = [info['Name'] for info in page['ColumnInfo']]
+        column_index = names.index('Column')
+        type_index = names.index('Type')
+        attribute_index = names.index('Timestream Attribute Type')
+        for row in page['Rows']:
+            datum = row['Data']
+            if datum[attribute_index].get('ScalarValue') == 'MULTI':
+                columns[datum[column_index]['ScalarValue']] = datum[type_index]['ScalarValue']
+        next_token = page.get('NextToken')
+        if not next_token:
+            return columns
+
+
+# date and time of day of ISO8601 ('T' separator) and Timestream (' ' separator) timestamps, parsed without strptime
+# which imports calendar, locale and _strptime on first use, a measurable share of a Lambda cold start
+DATE_TIME_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})$')
+EPOCH = datetime(1970, 1, 1)
+
+
+def date_time_to_epoch_seconds(date_part: str) -> int:
+    """
+    Utility function: converts a UTC 'YYYY-MM-DD HH:MM:SS' (or 'YYYY-MM-DDTHH:MM:SS') string into whole seconds since epoch
+    """
+    match = DATE_TIME_PATTERN.match(date_part)
+    if match is None:
+        raise ValueError(f"Unsupported timestamp[{date_part}]")
+    delta = datetime(*map(int, match.groups())) - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def iso8601_to_epoch_seconds(value: str) -> float:
+    """
+    Utility function: converts an ISO8601 basic UTC timestamp into seconds since epoch
+    e.g. '2022-04-06T00:17:45.419000000Z' -> 1649204265.419
+    Fractional seconds of any precision are accepted, which datetime.fromisoformat does not do on our runtime
+    """
+    date_part, _, fraction = value.rstrip('Z').partition('.')
+    seconds = float(date_time_to_epoch_seconds(date_part))
+    return seconds + float('0.' + fraction) if fraction else seconds
+
+
+def iso8601_to_timestream_time(value: str) -> str:
+    """
+    Utility function: converts an ISO8601 basic UTC timestamp into the text format of Timestream time values,
+    so the two can be compared as strings
+    e.g. '2022-04-06T00:17:45.419Z' -> '2022-04-06 00:17:45.419000000'
+    """
+    date_part, _, fraction = value.rstrip('Z').partition('.')
+    return date_part.replace('T', ' ') + '.' + fraction.ljust(9, '0')[:9]
+
+
+def epoch_seconds_to_timestream_time(seconds: int) -> str:
+    """
+    Utility function: converts whole seconds since epoch into the text format of Timestream time values
+    e.g. 1649204265 -> '2022-04-06 00:17:45.000000000'
+    """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds)) + '.000000000'
+
+
+def epoch_nanoseconds_to_timestream_time(nanoseconds: int) -> str:
+    """
+    Utility function: converts nanoseconds since epoch into the text format of Timestream time values
+    e.g. 1649204265419000000 -> '2022-04-06 00:17:45.419000000'
+    """
+    seconds, fraction = divmod(nanoseconds, 1000000000)
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds)) + '.%09d' % fraction
+
+
+def timestream_time_to_epoch_nanoseconds(value: str) -> int:
+    """
+    Utility function: converts a Timestream time value into nanoseconds since epoch, without losing precision
+    e.g. '2022-04-06 00:17:45.419000000' -> 1649204265419000000
+    """
+    date_part, _, fraction = value.partition('.')
+    seconds = date_time_to_epoch_seconds(date_part)
+    return seconds * 1000000000 + int(fraction.ljust(9, '0')[:9])
+
+
+def lttb_indices(times, values, threshold):
+    """
+    Utility function: Largest-Triangle-Three-Buckets downsampling, returns the indexes of at most threshold points
+    that preserve the visual shape of the (times, values) series. times must be ascending.
+    See Steinarsson, "Downsampling Time Series for Visual Representation"
+    """
+    count = len(times)
+    if threshold >= count or threshold < 3:
+        return range(count)
+
+    origin = times[0]
+    xs = [(t - origin) / 1e9 for t in times]
+    every = (count - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # average point of the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, count)
+        avg_x = sum(xs[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_y = sum(values[avg_start:avg_end]) / (avg_end - avg_start)
+
+        # point of the current bucket forming the largest triangle with the previously selected point and that average
+        ax, ay = xs[a], values[a]
+        max_area = -1.0
+        next_a = int(i * every) + 1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (values[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        selected.append(next_a)
+        a = next_a
+    selected.append(count - 1)
+    return selected
+
+
+def min_max_indices(times, values, threshold):
+    """
+    Utility function: min/max downsampling, splits the time range in threshold / 2 buckets and returns the indexes of
+    the smallest and largest value of each bucket in time order. times must be ascending.
+    """
+    count = len(times)
+    if threshold >= count or threshold < 2:
+        return range(count)
+
+    bucket_count = threshold // 2
+    width = (times[-1] - times[0]) / bucket_count or 1
+    buckets = {}
+    for index in range(count):
+        bucket = min(int((times[index] - times[0]) / width), bucket_count - 1)
+        low_high = buckets.get(bucket)
+        if low_high is None:
+            buckets[bucket] = [index, index]
         else:
-            print("\nUnhandled type")
-            raise ValueError(f"Unhandled type in timestream row: {self._row_as_dict}")
-
-    def _parse_row(self, column_schema, timestream_row):
-        """
-        Utility function: parses a timestream row into a python dict for more convenient field access
-
-        Example:
-        column=[
-            {'Name': 'vehicleName', 'Type': {'ScalarType': 'VARCHAR'}},
-            {'Name': 'measure_name', 'Type': {'ScalarType': 'VARCHAR'}},
-            {'Name': 'time', 'Type': {'ScalarType': 'TIMESTAMP'}},
-            {'Name': 'measure_value::double', 'Type': {'ScalarType': 'DOUBLE'}},
-            {'Name': 'measure_value::varchar', 'Type': {'ScalarType': 'VARCHAR'}}
-        ]
-        row={'Data': [
-            {'ScalarValue': 'Mixer_15_7e3c0bdf-3b1c-46b9-886b-14f9d0b9df4d'},
-            {'ScalarValue': 'alarm_status'},
-            {'ScalarValue': '2021-10-15 20:45:43.287000000'},
-            {'NullValue': True},
-            {'ScalarValue': 'ACTIVE'}
-        ]}
-
-        ->
-
-        {
-            'vehicleName': 'Mixer_15_7e3c0bdf-3b1c-46b9-886b-14f9d0b9df4d',
-            'measure_name': 'alarm_status',
-            'time': '2021-10-15 20:45:43.287000000',
-            'measure_value::double': None,
-            'measure_value::varchar': 'ACTIVE'
-        }
+            if values[index] < values[low_high[0]]:
+                low_high[0] = index
+            if values[index] > values[low_high[1]]:
+                low_high[1] = index
+    return sorted({index for low_high in buckets.values() for index in low_high})
+
+
+class DescendingKey:
+    """
+    Inverts the ordering of a heap key, so heapq can merge streams sorted in descending order
+    """
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class TimestreamQueryShard:
+    """
+    One shard of a sharded entity query: a (start, end] time range of a group of measures
+
+    The shard reads its pages from the executor, requesting the next page as soon as the current one arrives, and
+    tracks the key of the last row it emitted into the merge so it can be resumed, see row_key
+
+    Timestream does not order rows that tie on the ORDER BY columns, so the queries order on the full row key:
+    time in the requested direction, then vehicleName and measure_name ascending. The ties are ascending in both
+    directions because a fanned out multi-measure row always lists its measures in column order
+    """
+
+    def __init__(self, start_ns, end_ns):
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.layout = None
+        self.last_key = None
+        self.done = False
+        self._skip = False
+        self._rows = iter(())
+        self._future = None
+        self._fetch = None
+
+    def resume_from(self, position):
         """
-        data = timestream_row['Data']
-        result = {}
-        for i in range(len(data)):
-            info = column_schema[i]
-            datum = data[i]
-            key, val = self._parse_datum(info, datum)
-            result[key] = val
-        return result
+        Restores the shard from a position: None (not started), True (done) or the key of its last emitted row
+        """
+        if position is True:
+            self.done = True
+        elif position is not None:
+            self.last_key = self.check_position(position)
+            self._skip = True
 
-    @staticmethod
-    def _parse_datum(info, datum):
+    def time_bounds(self, descending):
+        # a resumed shard restarts at its last emitted time, the rows already emitted at that time are skipped
+        lower = TimeBound('>', 'from_nanoseconds', self.start_ns)
+        upper = TimeBound('<=', 'from_nanoseconds', self.end_ns)
+        if self.last_key is not None:
+            resume_ns = timestream_time_to_epoch_nanoseconds(self.last_key[0])
+            if descending:
+                upper = TimeBound('<=', 'from_nanoseconds', resume_ns)
+            else:
+                lower = TimeBound('>=', 'from_nanoseconds', resume_ns)
+        return lower, upper
+
+    def start(self, executor, query_client, query_string, page_rows):
+        def fetch(next_token=None):
+            if next_token:
+                return executor.submit(query_client.query, QueryString=query_string, NextToken=next_token, MaxRows=page_rows)
+            return executor.submit(query_client.query, QueryString=query_string, MaxRows=page_rows)
+
+        udq_metrics.current().add_count('timestream_queries')
+        self._fetch = fetch
+        self._future = fetch()
+
+    def next_row(self):
+        """
+        Returns the next row of the shard, or None once the shard is exhausted
         """
-        Utility function: parses timestream datum entries into (key,value) tuples. Only ScalarTypes currently supported.
+        while True:
+            for datum in self._rows:
+                if self._skip and self.is_emitted(self.row_key(datum, self.layout), self.last_key):
+                    continue
+                self._skip = False
+                return datum
+            if self._future is None:
+                self.done = True
+                return None
+            # only the time spent waiting for a page delays the invocation, the fetch itself runs on the executor
+            metrics = udq_metrics.current()
+            start = metrics.clock()
+            page = self._future.result()
+            metrics.add_duration('timestream', start)
+            metrics.add_count('pages')
+            next_token = page.get('NextToken')
+            self._future = self._fetch(next_token) if next_token else None
+            page = TimestreamMultiMeasureFanOut.fan_out(page)
+            self.layout = TimestreamColumnLayout.for_schema(page['ColumnInfo'])
+            self._rows = iter([row['Data'] for row in page['Rows']])
 
-        Example:
-        info={'Name': 'time', 'Type': {'ScalarType': 'TIMESTAMP'}}
-        datum={'ScalarValue': '2021-10-15 20:45:25.793000000'}
+    def emit(self, datum):
+        self.last_key = self.row_key(datum, self.layout)
 
-        ->
+    @staticmethod
+    def row_key(datum, layout):
+        """
+        The [time, vehicleName, measure_name] key of a row, the position of a cursor that emitted it last
+        """
+        vehicle_index = layout.vehicle_name_index
+        vehicle_name = datum[vehicle_index].get('ScalarValue', '') if vehicle_index is not None else ''
+        return [datum[layout.time_index]['ScalarValue'], vehicle_name, datum[layout.measure_name_index]['ScalarValue']]
 
-        ('time', '2021-10-15 20:45:25.793000000')
+    @staticmethod
+    def is_emitted(key, position):
         """
-        if datum.get('NullValue', False):
-            return info['Name'], None
-        column_type = info['Type']
-        if 'ScalarType' in column_type:
-            return info['Name'], datum['ScalarValue']
-        else:
-            raise Exception(f"Unsupported columnType[{column_type}]")
+        True if the row of key comes at or before position, a row key, in a query restarted at the time of position
+        """
+        return key[0] == position[0] and key[1:] <= position[1:]
+
+    @staticmethod
+    def check_position(position):
+        if not isinstance(position, list) or len(position) != 3:
+            raise Exception(f"Unsupported nextToken position[{position}]")
+        return position
+
+    def position(self):
+        if self.done:
+            return True
+        return self.last_key
+
+    def close(self):
+        # a prefetched page nobody is going to read
+        if self._future is not None:
+            self._future.cancel()
+
+
+class TimestreamResultCache:
+    """
+    LRU cache of IoTTwinMakerUdqResponse objects kept in the warm Lambda container
+
+    Entries expire after a TTL that depends on the query window: a window that ended more than settle_seconds ago
+    no longer receives data and is kept for historical_ttl_seconds, a window touching "now" only for live_ttl_seconds
+
+    The cache holds at most max_entries entries and, if max_bytes is set, at most max_bytes of entries by the size given
+    to put, e.g. the serialized size of their Timestream rows (see timestream_data_size). The least recently used
+    entries are evicted first, an entry larger than max_bytes is not cached
+    """
+
+    def __init__(self, max_entries, live_ttl_seconds, historical_ttl_seconds, settle_seconds, max_bytes=None):
+        self.max_entries = max_entries
+        self.live_ttl_seconds = live_ttl_seconds
+        self.historical_ttl_seconds = historical_ttl_seconds
+        self.settle_seconds = settle_seconds
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl_for_window(self, end_time: str) -> float:
+        try:
+            window_end = iso8601_to_epoch_seconds(end_time)
+        except ValueError:
+            return self.live_ttl_seconds
+        if window_end <= time.time() - self.settle_seconds:
+            return self.historical_ttl_seconds
+        return self.live_ttl_seconds
 
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                    self._bytes -= entry[2]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
 
-SESSION = boto3.Session()
-QUERY_CLIENT = SESSION.client('timestream-query')
+    def put(self, key, value, ttl_seconds, size=0):
+        if self.max_entries <= 0 or ttl_seconds <= 0:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._entries[key] = (time.monotonic() + ttl_seconds, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries \
+                    or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                _, entry = self._entries.popitem(last=False)
+                self._bytes -= entry[2]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class LazyQueryClient:
+    """
+    Timestream query client created on first use: importing boto3 and creating a client are the largest part of
+    a cold start, and invocations served from the result cache, or rejected during validation, never need one.
+    The client is created once and then shared by every invocation of the container, keeping its connection pool
+    (and the TLS sessions in it) warm. Thread safe, the shard and prefetch pools call it concurrently
+    """
+
+    def __init__(self, max_pool_connections: int = 10):
+        self._max_pool_connections = max_pool_connections
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    from botocore.config import Config
+                    self._client = boto3.Session().client(
+                        'timestream-query', config=Config(max_pool_connections=self._max_pool_connections))
+        return self._client
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the proxy itself: query, describe_endpoints, meta...
+        return getattr(self.get_client(), name)
+
+
+# the shard and prefetch pools share the client, keep a pooled connection for each of their workers
+QUERY_MAX_WORKERS = int(os.environ.get('QUERY_MAX_WORKERS', '4'))
+QUERY_CLIENT = LazyQueryClient(max_pool_connections=max(10, QUERY_MAX_WORKERS + 3))
+
+# set QUERY_CLIENT_INIT to 'eager' to create the client during the init phase, e.g. with provisioned concurrency
+if os.environ.get('QUERY_CLIENT_INIT', 'lazy').lower() == 'eager':
+    QUERY_CLIENT.get_client()
 
 # retrieve database name and table name from Lambda environment variables
 # check if running on Lambda
@@ -296,7 +1582,67 @@ else:
     DATABASE_NAME = None
     TABLE_NAME = None
 
-TIMESTREAM_UDQ_READER = TimestreamReader(QUERY_CLIENT, DATABASE_NAME, TABLE_NAME)
+# result cache sizing, set RESULT_CACHE_MAX_ENTRIES to 0 to disable caching. RESULT_CACHE_MAX_BYTES bounds the
+# serialized size of the cached rows, keep it well under the Lambda memory size
+RESULT_CACHE = TimestreamResultCache(
+    max_entries=int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '128')),
+    live_ttl_seconds=float(os.environ.get('RESULT_CACHE_LIVE_TTL_SECONDS', '5')),
+    historical_ttl_seconds=float(os.environ.get('RESULT_CACHE_HISTORICAL_TTL_SECONDS', '3600')),
+    settle_seconds=float(os.environ.get('RESULT_CACHE_SETTLE_SECONDS', '300')),
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_BYTES', '33554432')),
+)
+
+# opt-in: completed time buckets per (vehicle, measure), set BUCKET_CACHE_MAX_ENTRIES (e.g. 4096) to enable
+# incremental queries. They only pay off for polling requests without maxResults
+BUCKET_CACHE_MAX_ENTRIES = int(os.environ.get('BUCKET_CACHE_MAX_ENTRIES', '0'))
+BUCKET_CACHE = TimestreamResultCache(
+    max_entries=BUCKET_CACHE_MAX_ENTRIES,
+    live_ttl_seconds=0,
+    historical_ttl_seconds=float(os.environ.get('RESULT_CACHE_HISTORICAL_TTL_SECONDS', '3600')),
+    settle_seconds=float(os.environ.get('RESULT_CACHE_SETTLE_SECONDS', '300')),
+    max_bytes=int(os.environ.get('BUCKET_CACHE_MAX_BYTES', '33554432')),
+) if BUCKET_CACHE_MAX_ENTRIES > 0 else None
+
+# opt-in sharded queries: QUERY_MEASURE_SHARDS measure groups x QUERY_TIME_SHARDS time ranges, run on a bounded pool
+# sharing the QUERY_CLIENT (boto3 clients are thread safe)
+QUERY_MEASURE_SHARDS = int(os.environ.get('QUERY_MEASURE_SHARDS', '0'))
+QUERY_TIME_SHARDS = int(os.environ.get('QUERY_TIME_SHARDS', '1'))
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=QUERY_MAX_WORKERS) \
+    if QUERY_MEASURE_SHARDS > 1 or QUERY_TIME_SHARDS > 1 else None
+
+# background prefetch of the next page of paginated queries, set PREFETCH_MAX_PAGES to 0 to disable
+PREFETCH_MAX_PAGES = int(os.environ.get('PREFETCH_MAX_PAGES', '8'))
+PAGE_PREFETCHER = TimestreamPagePrefetcher(ThreadPoolExecutor(max_workers=2), PREFETCH_MAX_PAGES) \
+    if PREFETCH_MAX_PAGES > 0 else None
+
+# encoded size budget of a response, below the 6MB Lambda response payload limit, set to 0 to disable
+RESPONSE_MAX_BYTES = int(os.environ.get('RESPONSE_MAX_BYTES', '5000000')) or None
+
+# SQL injection check of every query, set SQL_INJECTION_CHECK to 'off' to disable
+SQL_DETECTOR = SQLDetector() if os.environ.get('SQL_INJECTION_CHECK', 'on').lower() != 'off' else None
+
+# per-phase metrics as CloudWatch Embedded Metric Format log lines, set UDQ_METRICS to 'emf' to enable
+METRICS_SINK = udq_metrics.EmfMetricsSink(os.environ.get('METRICS_NAMESPACE', 'TwinFleet/UDQ')) \
+    if os.environ.get('UDQ_METRICS', '').lower() == 'emf' else None
+
+# record format of the Timestream table, 'single' (single-measure records) or 'multi' (multi-measure records)
+MEASURE_FORMAT = os.environ.get('TIMESTREAM_MEASURE_FORMAT', MEASURE_FORMAT_SINGLE).lower()
+if MEASURE_FORMAT not in (MEASURE_FORMAT_SINGLE, MEASURE_FORMAT_MULTI):
+    raise Exception(f"Unsupported TIMESTREAM_MEASURE_FORMAT[{MEASURE_FORMAT}]")
+
+TIMESTREAM_UDQ_READER = TimestreamReader(QUERY_CLIENT, DATABASE_NAME, TABLE_NAME, RESULT_CACHE, BUCKET_CACHE,
+                                         bucket_seconds=int(os.environ.get('BUCKET_CACHE_SECONDS', '60')),
+                                         max_buckets=int(os.environ.get('BUCKET_CACHE_MAX_BUCKETS', '60')),
+                                         executor=QUERY_EXECUTOR,
+                                         measure_shards=QUERY_MEASURE_SHARDS,
+                                         time_shards=QUERY_TIME_SHARDS,
+                                         max_downsampled_points=int(os.environ.get('DOWNSAMPLING_MAX_POINTS', '2000')),
+                                         prefetcher=PAGE_PREFETCHER,
+                                         max_response_bytes=RESPONSE_MAX_BYTES,
+                                         metrics_sink=METRICS_SINK,
+                                         multi_measure=MEASURE_FORMAT == MEASURE_FORMAT_MULTI,
+                                         sql_detector=SQL_DETECTOR,
+                                         signal_index=SIGNAL_INDEX)
 
 #
 # Main Lambda invocation entry point, use the TimestreamReader to process events
@@ -12,7 +12,7 @@ import {
 import { Construct } from 'constructs';
 
 export class EVDataComponent extends Construct {
-  constructor(scope: Construct, id: string, workspace_id: string, dbname: string, dbtable: string) {
+  constructor(scope: Construct, id: string, workspace_id: string, dbname: string, dbtable: string, measureFormat: string = 'single') {
     super(scope, id);
 
     const TYPE = 'com.user.evtwindata';
@@ -58,6 +58,12 @@ export class EVDataComponent extends Construct {
     lambda_role.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName('AmazonTimestreamReadOnlyAccess'));
     lambda_role.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName('service-role/AWSLambdaBasicExecutionRole'));
     lambda_role.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName('AWSLambda_ReadOnlyAccess'));
+    // model manifest lookups of the schema initializer, vehicles of a model share one schema
+    lambda_role.addToPolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: ['iotfleetwise:GetVehicle'],
+      resources: ['*'],
+    }));
 
 
     // Set Env properties for Timestream database
@@ -71,6 +77,12 @@ export class EVDataComponent extends Construct {
             },
         };
         */
+    // udq_utils layer of both lambdas, shared property name mapping of the data reader and the schema initializer
+    const udq_utils_layer = new lambda.LayerVersion(this, 'udq_utils_layer', {
+      code: lambda.Code.fromAsset(path.join(__dirname, 'udq_layer.zip')),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_8, lambda.Runtime.PYTHON_3_9],
+    });
+
     //
     // Create the data reader lambda
     //
@@ -86,13 +98,10 @@ export class EVDataComponent extends Construct {
       environment: {
         TIMESTREAM_DATABASE_NAME: DB_NAME,
         TIMESTREAM_TABLE_NAME: TABLE_NAME,
+        // 'single' for single-measure records, 'multi' for multi-measure records
+        TIMESTREAM_MEASURE_FORMAT: measureFormat,
       },
-      layers: [
-        new lambda.LayerVersion(this, 'udq_utils_layer', {
-          code: lambda.Code.fromAsset(path.join(__dirname, 'udq_layer.zip')),
-          compatibleRuntimes: [lambda.Runtime.PYTHON_3_8],
-        }),
-      ],
+      layers: [udq_utils_layer],
     });
 
     //
@@ -110,7 +119,12 @@ export class EVDataComponent extends Construct {
       environment: {
         TIMESTREAM_DATABASE_NAME: DB_NAME,
         TIMESTREAM_TABLE_NAME: TABLE_NAME,
+        TIMESTREAM_MEASURE_FORMAT: measureFormat,
+        SCHEMA_MODEL_LOOKUP: 'fleetwise',
+        // one discovery query for all the vehicle entities of the fleet
+        SCHEMA_DISCOVERY_MODE: 'batch',
       },
+      layers: [udq_utils_layer],
     });
 
 
@@ -144,8 +158,24 @@ export class EVDataComponent extends Construct {
             dataType: { type: 'STRING' },
             isTimeSeries: false,
             isRequiredInEntity: true,
+            isExternalId: true,
+            isStoredExternally: false,
+          },
+          modelManifest: {
+            dataType: { type: 'STRING' },
+            isTimeSeries: false,
+            isRequiredInEntity: false,
+            isExternalId: false,
+            isStoredExternally: false,
+          },
+          // per entity: every chart of the entity's properties is downsampled with this mode, see data_reader.py
+          entityDownsampling: {
+            dataType: { type: 'STRING' },
+            isTimeSeries: false,
+            isRequiredInEntity: false,
             isExternalId: false,
             isStoredExternally: false,
+            defaultValue: { stringValue: 'raw' },
           },
         },
       });
@@ -0,0 +1,134 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+# ---------------------------------------------------------------------------
+#   Build-time generation of the precomputed vehicle schema served by schema_init
+#
+#   Reads the FleetWise signal catalog nodes and decoder manifest signals deployed by the fleetwise stack and writes
+#   the time series signals a vehicle can report, fully qualified name -> FleetWise data type, as a compact JSON
+#   artifact shipped with the schema initializer Lambda, and, for every signal of the catalog, the property name table
+#   and the signal allowlist of the queries (udq_utils/property_names.json and udq_utils/signal_index.json, in the
+#   udq_utils layer). The allowlist also holds the properties of the default schema of schema_init, some of which
+#   are not in the catalog. Run it when the catalog, the decoder manifest or the default schema changes:
+#
+#     python build_schema.py                     # regenerate vehicle_schema.json, property_names.json, signal_index.json
+#     python build_schema.py --check             # exit with status 1 when they are out of date
+#     python build_schema.py --catalog nodes.json --decoder signals.json --output schema.json
+# ---------------------------------------------------------------------------
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+COMPONENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(COMPONENT_DIR, 'udq_helper_utils'))
+
+from udq_utils.property_names import PropertyNames  # noqa: E402
+from udq_utils.signal_index import FLEETWISE_DATA_TYPES  # noqa: E402
+from schema_init import create_default_schema  # noqa: E402
+
+SCHEMA_VERSION = 1
+
+FLEETWISE_BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..', 'fleetwisecdk', 'bin')
+DEFAULT_CATALOG = os.path.join(FLEETWISE_BIN_DIR, 'signal-catalog-nodes.json')
+DEFAULT_DECODER = os.path.join(FLEETWISE_BIN_DIR, 'decoder-manifest-signals.json')
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vehicle_schema.json')
+DEFAULT_NAMES_OUTPUT = os.path.join(COMPONENT_DIR, 'udq_helper_utils', 'udq_utils', 'property_names.json')
+DEFAULT_INDEX_OUTPUT = os.path.join(COMPONENT_DIR, 'udq_helper_utils', 'udq_utils', 'signal_index.json')
+
+# signal catalog node types with time series values, attributes are static and branches have no value
+TIME_SERIES_NODE_TYPES = ('sensor', 'actuator')
+
+
+def read_json(path):
+    with open(path, 'rb') as source:
+        content = source.read()
+    return json.loads(content), hashlib.sha256(content).hexdigest()
+
+
+def build_schema(catalog_nodes, decoder_signals=None):
+    """
+    :param catalog_nodes: the signal catalog nodes, e.g. [{"sensor": {"fullyQualifiedName": ..., "dataType": ...}}]
+    :param decoder_signals: the decoder manifest signals, only the signals they decode are kept. None keeps all
+    :return: {fully qualified name: FleetWise data type} of the time series signals, sorted by name
+    """
+    decoded = None if decoder_signals is None else {signal['fullyQualifiedName'] for signal in decoder_signals}
+    signals = {}
+    for node in catalog_nodes:
+        for node_type, definition in node.items():
+            if node_type not in TIME_SERIES_NODE_TYPES:
+                continue
+            name = definition['fullyQualifiedName']
+            if decoded is not None and name not in decoded:
+                continue
+            signals[name] = definition['dataType']
+    return dict(sorted(signals.items()))
+
+
+def default_schema_signals(property_names: PropertyNames):
+    """
+    :return: {signal name: value type} of the properties of the default schema of schema_init, the entities declare
+    them and the dashboards select them whether the catalog has them or not
+    """
+    properties = create_default_schema(None)['properties']
+    return {property_names.to_signal(name): entry['definition']['dataType']['type'] for name, entry in properties.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the precomputed vehicle schema of schema_init')
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help='signal catalog nodes JSON file')
+    parser.add_argument('--decoder', default=DEFAULT_DECODER, help="decoder manifest signals JSON file, 'none' to keep every signal")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='schema artifact to write')
+    parser.add_argument('--names-output', default=DEFAULT_NAMES_OUTPUT, help='property name table to write')
+    parser.add_argument('--index-output', default=DEFAULT_INDEX_OUTPUT, help='signal allowlist to write')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 when the output is out of date')
+    args = parser.parse_args()
+
+    catalog_nodes, catalog_hash = read_json(args.catalog)
+    decoder_signals, decoder_hash = read_json(args.decoder) if args.decoder != 'none' else (None, None)
+    artifact = {
+        'version': SCHEMA_VERSION,
+        'sources': {'catalog': catalog_hash, 'decoder': decoder_hash},
+        'signals': build_schema(catalog_nodes, decoder_signals),
+    }
+    # every time series signal of the catalog, decoded or not, gets its property name and can be queried
+    catalog_signals = build_schema(catalog_nodes)
+    names = {
+        'version': 1,
+        'sources': {'catalog': catalog_hash},
+        'properties': PropertyNames.build_table(catalog_signals),
+    }
+    index_signals = default_schema_signals(PropertyNames(names['properties']))
+    index_signals.update((name, FLEETWISE_DATA_TYPES[data_type]) for name, data_type in catalog_signals.items()
+                         if data_type in FLEETWISE_DATA_TYPES)
+    index = {
+        'version': 1,
+        'sources': {'catalog': catalog_hash},
+        'signals': dict(sorted(index_signals.items())),
+    }
+    outputs = {
+        args.output: json.dumps(artifact, indent=1) + '\n',
+        args.names_output: json.dumps(names, indent=1) + '\n',
+        args.index_output: json.dumps(index, indent=1) + '\n',
+    }
+
+    if args.check:
+        stale = [path for path, content in outputs.items()
+                 if not os.path.exists(path) or open(path).read() != content]
+        if stale:
+            print(f"{', '.join(stale)} out of date, run build_schema.py")
+            sys.exit(1)
+        return
+
+    for path, content in outputs.items():
+        with open(path, 'w') as output:
+            output.write(content)
+    print(f"{len(artifact['signals'])} signals written to {args.output}, "
+          f"{len(names['properties'])} property names to {args.names_output}, "
+          f"{len(index['signals'])} signals to {args.index_output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import os
+import time
+
+# ---------------------------------------------------------------------------
+#   Cache of the schemas derived by schema_init, shared by the vehicles of a model
+#
+#   Schemas are looked up by key: 'model:<manifest>' for the vehicles of a known model, every vehicle of the model
+#   shares the schema derived for the first one, or 'vehicle:<name>' otherwise. A schema is stored once per measure
+#   set, the sha256 of its property names and types, so keys with identical measures share one entry.
+#   The cache lives in the warm container and, optionally, in a persistent store shared by every container:
+#   a store is any object with get(name) -> dict or None and put(name, dict)
+# ---------------------------------------------------------------------------
+
+
+def measure_set_hash(schema: dict) -> str:
+    """
+    :return: the sha256 of the sorted (property name, data type) pairs of schema
+    """
+    measures = sorted((name, entry['definition']['dataType']['type']) for name, entry in schema['properties'].items())
+    return hashlib.sha256(json.dumps(measures, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class SchemaCache:
+    """
+    Schemas by key, for ttl_seconds after they were derived
+    """
+
+    def __init__(self, store=None, ttl_seconds: float = 3600):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self._keys = {}  # key -> (measure set hash, expiry)
+        self._schemas = {}  # measure set hash -> schema
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        """
+        :return: the schema cached for key, None when it is not cached or has expired
+        """
+        now = time.time()
+        entry = self._keys.get(key)
+        if entry is None and self.store is not None:
+            entry = self._load(key)
+        if entry is None or entry[1] <= now:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._schemas[entry[0]]
+
+    def put(self, key: str, schema: dict):
+        digest = measure_set_hash(schema)
+        expiry = time.time() + self.ttl_seconds
+        self._keys[key] = (digest, expiry)
+        self._schemas.setdefault(digest, schema)
+        if self.store is not None:
+            try:
+                self.store.put(f'schema/{digest}', schema)
+                self.store.put(f'key/{key}', {'schema': digest, 'expiry': expiry})
+            except Exception as e:
+                print(f"Schema store exception: {e} -- schema cached in this container only")
+
+    def _load(self, key):
+        try:
+            record = self.store.get(f'key/{key}')
+            if record is None or record['expiry'] <= time.time():
+                return None
+            schema = self._schemas.get(record['schema']) or self.store.get(f"schema/{record['schema']}")
+        except Exception as e:
+            print(f"Schema store exception: {e} -- deriving the schema")
+            return None
+        if schema is None:
+            return None
+        entry = (record['schema'], record['expiry'])
+        self._keys[key] = entry
+        self._schemas.setdefault(record['schema'], schema)
+        return entry
+
+    def stats(self) -> dict:
+        return {
+            'keys': len(self._keys),
+            'schemas': len(self._schemas),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class FileSchemaStore:
+    """
+    Schema store in a local directory, one JSON file per name.
+    On Lambda, a directory under /tmp is kept by the warm container only; use it to run the store locally
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, hashlib.sha256(name.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, name: str):
+        try:
+            with open(self._path(name)) as record_file:
+                return json.load(record_file)
+        except FileNotFoundError:
+            return None
+
+    def put(self, name: str, value: dict):
+        # write then rename, concurrent readers never see a partial file
+        path = self._path(name)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as record_file:
+            json.dump(value, record_file)
+        os.replace(temporary_path, path)
+
+
+class S3SchemaStore:
+    """
+    Schema store in an S3 bucket, shared by every container of the function.
+    The function role needs s3:GetObject and s3:PutObject on the prefix
+    """
+
+    def __init__(self, bucket: str, prefix: str = ''):
+        import boto3
+        self.client = boto3.Session().client('s3')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def get(self, name: str):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + name)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+    def put(self, name: str, value: dict):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=json.dumps(value).encode('utf-8'),
+                               ContentType='application/json')
+
+
+def create_store(location: str):
+    """
+    :param location: 'file:<directory>' or 's3://<bucket>/<prefix>', empty for no store
+    """
+    if not location:
+        return None
+    if location.startswith('file:'):
+        return FileSchemaStore(location[len('file:'):])
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3SchemaStore(bucket, prefix)
+    raise Exception(f"Unsupported SCHEMA_CACHE_STORE[{location}]")
@@ -2,27 +2,59 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import logging
-import boto3
 import os
+import sys
+import time
 import json 
 
+from schema_cache import SchemaCache, create_store
+from udq_utils.property_names import PROPERTY_NAMES
+from udq_utils.query_builder import string_literal
+from udq_utils.signal_index import FLEETWISE_DATA_TYPES
+
 REQUEST_KEY_PROPERTIES = 'properties'
 REQUEST_KEY_VEHICLE_NAME = 'vehicleName'
 #REQUEST_KEY_VALUE = 'value'
 REQUEST_KEY_VALUE_STRING = 'stringValue'
 
-#
-# Fleetwise measure names have '.' in them, which is currently not supported by Twinmaker rules.
-# So replace them, along with other illegal characters.
-#
-ILLEGAL_CHARACTERS = ['#', '(', ')', ' ', '.']
+# IoT TwinMaker data type of the measure columns of a multi-measure table, per Timestream type
+MULTI_MEASURE_DATA_TYPES = {
+    'double': 'DOUBLE',
+    'bigint': 'DOUBLE',
+    'boolean': 'BOOLEAN',
+    'varchar': 'STRING',
+}
 
 # Configure logger
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
-SESSION = boto3.Session()
-QUERY_CLIENT = SESSION.client('timestream-query')
+# timestream-query client, created on first use: importing boto3 and creating the client dominate the cold start,
+# set QUERY_CLIENT_INIT to 'eager' to create it during the init phase instead
+QUERY_CLIENT = None
+
+
+def query_client():
+    global QUERY_CLIENT
+    if QUERY_CLIENT is None:
+        import boto3
+        QUERY_CLIENT = boto3.Session().client('timestream-query')
+    return QUERY_CLIENT
+
+
+if os.environ.get('QUERY_CLIENT_INIT', 'lazy').lower() == 'eager':
+    query_client()
+
+# iotfleetwise client of the model manifest lookups, created on first use
+FLEETWISE_CLIENT = None
+
+
+def fleetwise_client():
+    global FLEETWISE_CLIENT
+    if FLEETWISE_CLIENT is None:
+        import boto3
+        FLEETWISE_CLIENT = boto3.Session().client('iotfleetwise')
+    return FLEETWISE_CLIENT
 
 # retrieve database name and table name from Lambda environment variables
 # check if running on Lambda
@@ -34,6 +66,38 @@ else:
     DATABASE_NAME = None
     TABLE_NAME = None
 
+# record format of the Timestream table, 'single' (single-measure records) or 'multi' (multi-measure records)
+MEASURE_FORMAT = os.environ.get('TIMESTREAM_MEASURE_FORMAT', 'single').lower()
+
+# signals of the vehicles, generated from the signal catalog by build_schema.py, set SCHEMA_ARTIFACT to 'none' to
+# sample Timestream instead. The schema is answered from the artifact only, set SCHEMA_DISCOVERY to 'on' to add the
+# measures missing from it, discovered in the last SCHEMA_DISCOVERY_WINDOW of data: a GROUP BY scan of that window
+# for every schema request not served from the SCHEMA_CACHE, or once per SCHEMA_DISCOVERY_TTL_SECONDS in batch mode
+SCHEMA_ARTIFACT = os.environ.get('SCHEMA_ARTIFACT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vehicle_schema.json'))
+SCHEMA_DISCOVERY = os.environ.get('SCHEMA_DISCOVERY', 'off').lower() == 'on'
+SCHEMA_DISCOVERY_WINDOW = os.environ.get('SCHEMA_DISCOVERY_WINDOW', '1d')
+
+# set SCHEMA_DISCOVERY_MODE to 'batch' to discover the measures of every vehicle in one query, memoized per vehicle
+# for SCHEMA_DISCOVERY_TTL_SECONDS: the schema requests of the other entities of a scene are answered from memory.
+# 'vehicle' (default) queries the measures of each vehicle on its own
+SCHEMA_DISCOVERY_BATCH = os.environ.get('SCHEMA_DISCOVERY_MODE', 'vehicle').lower() == 'batch'
+SCHEMA_DISCOVERY_TTL_SECONDS = float(os.environ.get('SCHEMA_DISCOVERY_TTL_SECONDS', '300'))
+
+# batch discovery results: 'fleet' or 'describe' -> (expiry, result)
+DISCOVERY_RESULTS = {}
+
+# derived schemas, shared by the vehicles of a model manifest: the optional modelManifest property of the component,
+# or the manifests of the FleetWise vehicle with SCHEMA_MODEL_LOOKUP set to 'fleetwise'. Vehicles of unknown models
+# are cached one by one. SCHEMA_CACHE_STORE, 'file:<directory>' or 's3://<bucket>/<prefix>', shares them between
+# containers. Set SCHEMA_CACHE_TTL_SECONDS to 0 to disable caching
+SCHEMA_CACHE_TTL_SECONDS = float(os.environ.get('SCHEMA_CACHE_TTL_SECONDS', '3600'))
+SCHEMA_CACHE = SchemaCache(create_store(os.environ.get('SCHEMA_CACHE_STORE', '')), SCHEMA_CACHE_TTL_SECONDS) \
+    if SCHEMA_CACHE_TTL_SECONDS > 0 else None
+SCHEMA_MODEL_LOOKUP = os.environ.get('SCHEMA_MODEL_LOOKUP', 'off').lower() == 'fleetwise'
+
+# vehicle name -> cache key of its model manifest, vehicles do not change model
+VEHICLE_MODEL_KEYS = {}
+
 # ---------------------------------------------------------------------------
 #   Sample implementation of an AWS IoT TwinMaker control plane Connector against TimeStream
 #   queries property schema of a component
@@ -41,22 +105,74 @@ else:
 
 
 def schema_init_handler(event, context):
-    properties = {}
-    
-    # Prepare and execute query statement to TimeStream
     vehicleName = event['properties']['vehicleName']['value']['stringValue']
-    
+
+    cache_key = schema_cache_key(event, vehicleName) if SCHEMA_CACHE is not None else None
+    if cache_key is not None:
+        schema = SCHEMA_CACHE.get(cache_key)
+        if schema is not None:
+            return schema
+
+    schema = derive_schema(vehicleName)
+    if schema is None:
+        # not cached, the next request for the vehicle derives its schema again
+        if PRECOMPUTED_PROPERTIES is not None:
+            return {'properties': dict(PRECOMPUTED_PROPERTIES)}
+        return create_default_schema(vehicleName)
+
+    if cache_key is not None:
+        SCHEMA_CACHE.put(cache_key, schema)
+    return schema
+
+#
+# The key of the schema of a vehicle in the SCHEMA_CACHE: its model manifest when known, else the vehicle itself
+#
+def schema_cache_key(event, vehicleName):
+    model_manifest = event['properties'].get('modelManifest', {}).get('value', {}).get('stringValue')
+    if model_manifest:
+        return f"model:{model_manifest}"
+
+    if SCHEMA_MODEL_LOOKUP:
+        if vehicleName not in VEHICLE_MODEL_KEYS:
+            try:
+                vehicle = fleetwise_client().get_vehicle(vehicleName=vehicleName)
+                VEHICLE_MODEL_KEYS[vehicleName] = f"model:{vehicle['modelManifestArn']}|{vehicle['decoderManifestArn']}"
+            except Exception as e:
+                print(f"Vehicle lookup exception: {e} -- caching the schema of the vehicle only")
+                return f"vehicle:{vehicleName}"
+        return VEHICLE_MODEL_KEYS[vehicleName]
+
+    return f"vehicle:{vehicleName}"
+
+#
+# The schema of a vehicle, None when it could not be derived: the precomputed or the default schema then applies
+#
+def derive_schema(vehicleName):
+    properties = {}
+
+    if PRECOMPUTED_PROPERTIES is not None:
+        return precomputed_schema(vehicleName)
+
+    if MEASURE_FORMAT == 'multi':
+        return multi_measure_schema(vehicleName)
+
+    if SCHEMA_DISCOVERY_BATCH:
+        return batch_schema(vehicleName)
+
     try:
         query_string = f"SELECT  distinct vehicleName, measure_name, measure_value::double, measure_value::boolean, time" \
                        f" FROM {DATABASE_NAME}.{TABLE_NAME} " \
-                       f" WHERE vehicleName = '{vehicleName}' " \
+                       f" WHERE vehicleName = {string_literal(vehicleName)} " \
                        f" ORDER by time DESC" \
                        f" LIMIT 100"
 
         LOGGER.info('vehicleName: %s', vehicleName)
         
 
-        query_result = QUERY_CLIENT.query(QueryString=query_string)
+        query_result = query_client().query(QueryString=query_string)
+        # Timestream can return a page without rows and a NextToken while the query is still running
+        while 'NextToken' in query_result and len(query_result['Rows']) == 0:
+            query_result = query_client().query(QueryString=query_string, NextToken=query_result['NextToken'])
         #print(f"Query result={query_result}")
 
         column_info = query_result['ColumnInfo']
@@ -80,27 +196,180 @@ def schema_init_handler(event, context):
  
                 current_property['definition']['isTimeSeries'] = True
             
-                # Some characters are not allowed to be present in property name
-                attr_name = replace_illegal_character(attr_name)
+                # Some characters are not allowed to be present in property name, see udq_utils.property_names
+                attr_name = PROPERTY_NAMES.to_property(attr_name)
                 properties[attr_name] = current_property
             
                 # Add other properties that have static metadata (if applicable)
         else:
             # no rows - use default schema
             print(f"No rows -- using default schema")
-            default_schema = create_default_schema(vehicleName)
-            return default_schema
+            return None
            
     except Exception as e:
         print(f"Query exception: {e} -- using default schema")
-        default_schema = create_default_schema(vehicleName)
-        return default_schema
+        return None
 
     # normal case
     return {
         'properties': properties
     }
 
+#
+# Precomputed schema: the signals of the artifact generated from the signal catalog, answered from memory.
+# Timestream is only queried for measures the artifact does not know about, e.g. signals added to the decoder
+# manifest after the artifact was generated
+#
+def precomputed_schema(vehicleName):
+    properties = dict(PRECOMPUTED_PROPERTIES)
+    if SCHEMA_DISCOVERY:
+        try:
+            discovered = measure_properties(vehicleName)
+        except Exception as e:
+            print(f"Discovery exception: {e} -- using precomputed schema")
+            return None
+        for attr_name, entry in discovered.items():
+            if attr_name not in properties:
+                LOGGER.info('discovered measure %s not in the precomputed schema', attr_name)
+                properties[attr_name] = entry
+
+    return {
+        'properties': properties
+    }
+
+#
+# The measure properties of a vehicle: the measure columns of a multi-measure table, or the measures the vehicle
+# reported in the last SCHEMA_DISCOVERY_WINDOW. In batch mode, from one discovery pass for the whole fleet
+#
+def measure_properties(vehicleName):
+    if MEASURE_FORMAT == 'multi':
+        if SCHEMA_DISCOVERY_BATCH:
+            return batch_discovery('describe', describe_measure_properties)
+        return describe_measure_properties()
+
+    if SCHEMA_DISCOVERY_BATCH:
+        return batch_discovery('fleet', discover_measure_properties).get(vehicleName, {})
+    return discover_measure_properties(vehicleName).get(vehicleName, {})
+
+def batch_discovery(name, discover):
+    now = time.time()
+    result = DISCOVERY_RESULTS.get(name)
+    if result is None or result[0] <= now:
+        result = (now + SCHEMA_DISCOVERY_TTL_SECONDS, discover())
+        DISCOVERY_RESULTS[name] = result
+    return result[1]
+
+#
+# Batch mode schema of a single-measure table without precomputed schema: the discovered measures of the vehicle
+#
+def batch_schema(vehicleName):
+    try:
+        properties = measure_properties(vehicleName)
+    except Exception as e:
+        print(f"Discovery exception: {e} -- using default schema")
+        return None
+
+    if not properties:
+        print(f"No measures -- using default schema")
+        return None
+
+    return {
+        'properties': properties
+    }
+
+#
+# The measures reported in the last SCHEMA_DISCOVERY_WINDOW by vehicleName, or by every vehicle when None,
+# one row per vehicle and measure instead of the latest rows: {vehicle name: {property name: property}}
+#
+def discover_measure_properties(vehicleName=None):
+    vehicles = {}
+    vehicle_filter = f"vehicleName = {string_literal(vehicleName)} AND " if vehicleName is not None else ""
+    query_string = f"SELECT vehicleName, measure_name, count(measure_value::double) AS doubles, count(measure_value::boolean) AS booleans" \
+                   f" FROM {DATABASE_NAME}.{TABLE_NAME} " \
+                   f" WHERE {vehicle_filter}time > ago({SCHEMA_DISCOVERY_WINDOW}) " \
+                   f" GROUP BY vehicleName, measure_name"
+    query_result = query_client().query(QueryString=query_string)
+    while True:
+        column_info = query_result['ColumnInfo']
+        for row in query_result['Rows']:
+            values = __parse_row(column_info, row)
+            if int(values['doubles']) > 0:
+                data_type = 'DOUBLE'
+            elif int(values['booleans']) > 0:
+                data_type = 'BOOLEAN'
+            else:
+                LOGGER.error("Wrong measure_value type ")
+                continue
+            attr_name = PROPERTY_NAMES.to_property(values['measure_name'])
+            properties = vehicles.setdefault(values['vehicleName'], {})
+            properties[attr_name] = create_default_schema_entry(attr_name, None, True, data_type, True)
+
+        if 'NextToken' not in query_result:
+            return vehicles
+        query_result = query_client().query(QueryString=query_string, NextToken=query_result['NextToken'])
+
+#
+# Multi-measure records carry every measure in its own typed column, so the schema is the set of measure columns of
+# the table, read with DESCRIBE instead of sampling the latest rows of the vehicle
+#
+def multi_measure_schema(vehicleName):
+    try:
+        properties = measure_properties(vehicleName)
+    except Exception as e:
+        print(f"Describe exception: {e} -- using default schema")
+        return None
+
+    if not properties:
+        print(f"No measure columns -- using default schema")
+        return None
+
+    return {
+        'properties': properties
+    }
+
+def describe_measure_properties():
+    properties = {}
+    query_string = f"DESCRIBE {DATABASE_NAME}.{TABLE_NAME}"
+    query_result = query_client().query(QueryString=query_string)
+    while True:
+        column_info = query_result['ColumnInfo']
+        for row in query_result['Rows']:
+            values = __parse_row(column_info, row)
+            if values['Timestream Attribute Type'] != 'MULTI':
+                continue
+
+            data_type = MULTI_MEASURE_DATA_TYPES.get(values['Type'])
+            if data_type is None:
+                LOGGER.error("Unsupported multi-measure column type %s", values['Type'])
+                continue
+            attr_name = PROPERTY_NAMES.to_property(values['Column'])
+            properties[attr_name] = create_default_schema_entry(attr_name, None, True, data_type, True)
+
+        if 'NextToken' not in query_result:
+            return properties
+        query_result = query_client().query(QueryString=query_string, NextToken=query_result['NextToken'])
+
+#
+# Load the precomputed schema artifact: {'version': 1, 'signals': {fully qualified name: FleetWise data type}}
+#
+def load_precomputed_properties(path):
+    if path.lower() == 'none' or not os.path.exists(path):
+        return None
+    with open(path) as artifact_file:
+        artifact = json.load(artifact_file)
+    if artifact.get('version') != 1:
+        raise Exception(f"Unsupported schema artifact version[{artifact.get('version')}] in {path}")
+
+    properties = {}
+    for signal_name, fleetwise_type in artifact['signals'].items():
+        data_type = FLEETWISE_DATA_TYPES.get(fleetwise_type)
+        if data_type is None:
+            LOGGER.error("Unsupported signal data type %s of %s", fleetwise_type, signal_name)
+            continue
+        attr_name = PROPERTY_NAMES.to_property(signal_name)
+        properties[attr_name] = create_default_schema_entry(attr_name, None, True, data_type, True)
+    return properties
+
 def __parse_row(column_info, row):
         data = row['Data']
         row_output = {}
@@ -141,11 +410,6 @@ def __parse_array(array_column_info, array_values):
 
     return "[%s]" % str(array_output)
 
-def replace_illegal_character(attr_name):
-    for illegal_char in ILLEGAL_CHARACTERS:
-        attr_name = attr_name.replace(illegal_char, '_')
-    return attr_name.replace('__', '_')
-
 #
 # Create a default schema for our use case to handle the condition where the 
 # database has not been populated yet.
@@ -252,3 +516,5 @@ def create_default_schema_entry(measureName, measureValue, isTs, mType, isImport
 
     return entry
 
+
+PRECOMPUTED_PROPERTIES = load_precomputed_properties(SCHEMA_ARTIFACT)
@@ -0,0 +1,113 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+# ---------------------------------------------------------------------------
+#   Shared setup of the connector tests
+#
+#   The tests run the data reader and the schema initializer against a LocalTimestreamClient
+#   (benchmark/local_timestream.py) and compare the rows of a feature (bucket cache, sharding, downsampling, payload
+#   budget, ...) with those of the plain reader on the same table. No AWS access is needed. From the component directory:
+#     python -m unittest discover -s tests
+# ---------------------------------------------------------------------------
+
+import json
+import os
+import sys
+import time
+
+COMPONENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(COMPONENT_DIR, 'data_reader'), os.path.join(COMPONENT_DIR, 'schema_initializer'),
+                os.path.join(COMPONENT_DIR, 'udq_helper_utils'), os.path.join(COMPONENT_DIR, 'benchmark')]
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('TIMESTREAM_DATABASE_NAME', 'fleet')
+os.environ.setdefault('TIMESTREAM_TABLE_NAME', 'telemetry')
+
+import data_reader  # noqa: E402
+from local_timestream import LocalTimestreamClient, populate  # noqa: E402
+
+DATABASE_NAME = 'fleet'
+TABLE_NAME = 'telemetry'
+WINDOW_START = '2022-04-06T00:00:00Z'
+
+
+def iso8601(seconds: float) -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(int(seconds))) + '.%03dZ' % int(round(seconds % 1 * 1000))
+
+
+def property_names(measures: int):
+    return [f'Vehicle_Synthetic_Signal{measure}' for measure in range(measures)]
+
+
+def local_client(measures=6, vehicles=2, seconds=600, start=WINDOW_START, multi_measure=False, page_rows=700,
+                 empty_pages=0, interval=1.0):
+    # like Timestream, rows tying on the ORDER BY columns come in any order
+    client = LocalTimestreamClient(DATABASE_NAME, TABLE_NAME, page_rows=page_rows, empty_pages=empty_pages,
+                                   shuffle_ties=True)
+    populate(client, vehicles=vehicles, measures=measures, seconds=seconds, interval=interval, start=start,
+             multi_measure=multi_measure)
+    return client
+
+
+def reader(client, **kwargs):
+    return data_reader.TimestreamReader(client, DATABASE_NAME, TABLE_NAME, **kwargs)
+
+
+def entity_event(properties, start=WINDOW_START, end='2022-04-06T00:10:00Z', vehicle='vehicle1', next_token=None,
+                 order='ASCENDING', max_results=None, filters=None, downsampling=None, component_type=False):
+    """
+    :return: a UDQ lambda event, of an entity query or, with component_type, of a component type query
+    """
+    event = {
+        'workspaceId': 'workspace',
+        'selectedProperties': list(properties),
+        'properties': {name: {} for name in properties},
+        'startTime': start,
+        'endTime': end,
+        'startDateTime': 0,
+        'endDateTime': 0,
+        'orderByTime': order,
+    }
+    if component_type:
+        event['componentTypeId'] = 'component-type'
+    else:
+        event.update(entityId='entity', componentName='component')
+        event['properties']['vehicleName'] = {'value': {'stringValue': vehicle}}
+    if downsampling:
+        event['properties'][data_reader.DOWNSAMPLING_PROPERTY] = {'value': {'stringValue': downsampling}}
+    if next_token:
+        event['nextToken'] = next_token
+    if max_results:
+        event['maxResults'] = max_results
+    if filters:
+        event['propertyFilters'] = filters
+    return event
+
+
+def response_rows(response):
+    """
+    :return: (reference, time, value) of every value of a UDQ response, in response order
+    """
+    rows = []
+    for property_values in response['propertyValues']:
+        reference = json.dumps(property_values['entityPropertyReference'], sort_keys=True)
+        rows.extend((reference, value['time'], json.dumps(value['value'], sort_keys=True))
+                    for value in property_values['values'])
+    return rows
+
+
+def read_all(udq_reader, **event_kwargs):
+    """
+    Follows the nextToken of the responses until the query is exhausted, as IoT TwinMaker does
+    :return: (sorted rows of every response, number of responses)
+    """
+    rows = []
+    responses = 0
+    next_token = None
+    while True:
+        response = udq_reader.process_query(entity_event(next_token=next_token, **event_kwargs))
+        responses += 1
+        rows.extend(response_rows(response))
+        next_token = response.get('nextToken')
+        if not next_token:
+            return sorted(rows), responses
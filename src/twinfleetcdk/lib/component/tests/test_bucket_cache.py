@@ -0,0 +1,108 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+import unittest
+
+import connector_fixture as fixture
+from data_reader import TimestreamResultCache
+
+
+class BucketCacheTest(unittest.TestCase):
+    """
+    Polling "the last 15 minutes" through the bucket cache returns the rows of the plain reader, with no more queries
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.now = int(time.time())
+        cls.properties = fixture.property_names(3)
+        cls.client = fixture.local_client(measures=3, vehicles=1, seconds=1800, start=fixture.iso8601(cls.now - 1800))
+
+    def poll(self, udq_reader, polls=5, **event_kwargs):
+        """
+        :return: the rows of every poll and the number of queries they ran
+        """
+        calls = self.client.calls
+        rows = []
+        for poll in range(polls):
+            end = self.now - 30 + poll * 5
+            rows.append(fixture.read_all(udq_reader, properties=self.properties, vehicle='vehicle0',
+                                         start=fixture.iso8601(end - 900), end=fixture.iso8601(end), **event_kwargs)[0])
+        return rows, self.client.calls - calls
+
+    def bucketed_reader(self):
+        bucket_cache = TimestreamResultCache(max_entries=4096, live_ttl_seconds=0, historical_ttl_seconds=3600,
+                                             settle_seconds=60)
+        return fixture.reader(self.client, bucket_cache=bucket_cache)
+
+    def test_polling_without_max_results(self):
+        plain_rows, plain_queries = self.poll(fixture.reader(self.client))
+        bucketed_rows, bucketed_queries = self.poll(self.bucketed_reader())
+        self.assertEqual(plain_rows, bucketed_rows)
+        self.assertLessEqual(bucketed_queries, plain_queries)
+
+    def test_polling_latest_value(self):
+        plain_rows, plain_queries = self.poll(fixture.reader(self.client), order='DESCENDING', max_results=1)
+        bucketed_rows, bucketed_queries = self.poll(self.bucketed_reader(), order='DESCENDING', max_results=1)
+        self.assertEqual(plain_rows, bucketed_rows)
+        self.assertEqual(bucketed_queries, plain_queries)
+
+    def test_polling_with_max_results(self):
+        udq_reader = self.bucketed_reader()
+        # a first poll without maxResults caches the settled buckets
+        self.poll(udq_reader, polls=1)
+        plain_rows, plain_queries = self.poll(fixture.reader(self.client), max_results=100)
+        bucketed_rows, bucketed_queries = self.poll(udq_reader, max_results=100)
+        self.assertEqual(plain_rows, bucketed_rows)
+        self.assertLessEqual(bucketed_queries, plain_queries)
+
+
+class BucketStitchingTest(unittest.TestCase):
+    """
+    Settled windows read through the bucket cache are stitched from cached and fetched buckets, in either order,
+    into the rows of the plain reader
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.properties = fixture.property_names(3)
+        cls.client = fixture.local_client(measures=3, vehicles=1, seconds=600)
+
+    def read(self, udq_reader, start, end, order='ASCENDING'):
+        calls = self.client.calls
+        rows, _ = fixture.read_all(udq_reader, properties=self.properties, vehicle='vehicle0', start=start, end=end,
+                                   order=order)
+        return rows, self.client.calls - calls
+
+    def assertStitchedInOrder(self, udq_reader, start, end, order):
+        response = udq_reader.process_query(fixture.entity_event(self.properties, start=start, end=end,
+                                                                 vehicle='vehicle0', order=order))
+        times = {}
+        for reference, value_time, _ in fixture.response_rows(response):
+            times.setdefault(reference, []).append(value_time)
+        for reference_times in times.values():
+            self.assertEqual(reference_times, sorted(reference_times, reverse=order == 'DESCENDING'))
+
+    def test_overlapping_windows(self):
+        bucket_cache = TimestreamResultCache(max_entries=4096, live_ttl_seconds=0, historical_ttl_seconds=3600,
+                                             settle_seconds=60)
+        udq_reader = fixture.reader(self.client, bucket_cache=bucket_cache)
+        windows = [('2022-04-06T00:00:00Z', '2022-04-06T00:05:00Z'),
+                   ('2022-04-06T00:02:30.500Z', '2022-04-06T00:07:30.500Z'),
+                   ('2022-04-06T00:01:00Z', '2022-04-06T00:04:00Z')]
+        for order in ('ASCENDING', 'DESCENDING'):
+            for start, end in windows:
+                with self.subTest(order=order, start=start, end=end):
+                    plain_rows, plain_queries = self.read(fixture.reader(self.client), start, end, order)
+                    bucketed_rows, bucketed_queries = self.read(udq_reader, start, end, order)
+                    self.assertTrue(plain_rows)
+                    self.assertEqual(plain_rows, bucketed_rows)
+                    self.assertLessEqual(bucketed_queries, plain_queries)
+                    self.assertStitchedInOrder(udq_reader, start, end, order)
+        # every bucket of the last window was cached by the first one
+        self.assertEqual(self.read(udq_reader, *windows[2])[1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import unittest
+
+import connector_fixture as fixture
+from data_reader import PRE_AGGREGATION_FACTOR, iso8601_to_epoch_seconds, lttb_indices, min_max_indices
+
+# a window whose start is not on a bin boundary
+START = '2022-04-06T00:00:07.500Z'
+END = '2022-04-06T01:00:00Z'
+
+
+class DownsamplingTest(unittest.TestCase):
+    """
+    The downsampling modes return points inside the (start, end] window, from a bounded number of rows
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.properties = fixture.property_names(2)
+        cls.client = fixture.local_client(measures=2, vehicles=1, seconds=3600, page_rows=500)
+
+    def read(self, udq_reader, mode, max_results=100):
+        return fixture.read_all(udq_reader, properties=self.properties, vehicle='vehicle0', start=START, end=END,
+                                max_results=max_results, downsampling=mode)
+
+    def test_points_inside_window(self):
+        window_start = START.replace('Z', '000000Z')
+        window_end = END.replace('Z', '.000000000Z')
+        for mode in ('bin', 'lttb', 'minmax'):
+            with self.subTest(mode=mode):
+                rows, _ = self.read(fixture.reader(self.client), mode)
+                self.assertTrue(rows)
+                self.assertLessEqual(len(rows), 100)
+                times = [row[1] for row in rows]
+                self.assertGreater(min(times), window_start)
+                self.assertLessEqual(max(times), window_end)
+
+    def test_reducers_read_pre_aggregated_rows(self):
+        # 7200 raw rows are 15 pages, 4 x 50 bins per measure fit in one
+        for mode in ('lttb', 'minmax'):
+            with self.subTest(mode=mode):
+                calls = self.client.calls
+                rows, responses = self.read(fixture.reader(self.client), mode)
+                self.assertEqual(responses, 1)
+                self.assertEqual(self.client.calls - calls, 1)
+                self.assertEqual(len({row[0] for row in rows}), 2)
+
+    def test_bin_paging_with_budget_cut(self):
+        plain_rows, _ = self.read(fixture.reader(self.client), 'bin', max_results=1000)
+        budget_rows, responses = self.read(fixture.reader(self.client, max_response_bytes=20000), 'bin',
+                                           max_results=1000)
+        self.assertGreater(responses, 1)
+        self.assertEqual(plain_rows, budget_rows)
+
+
+class ReducersTest(unittest.TestCase):
+    """
+    lttb and minmax return the points their reducer picks among the bins of the bin mode at PRE_AGGREGATION_FACTOR
+    times the points
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.properties = fixture.property_names(3)
+        cls.client = fixture.local_client(measures=3, vehicles=1, seconds=3600, page_rows=500)
+
+    def read(self, mode, max_results):
+        rows, _ = fixture.read_all(fixture.reader(self.client), properties=self.properties, vehicle='vehicle0',
+                                   start=START, end=END, max_results=max_results, downsampling=mode)
+        return rows
+
+    @staticmethod
+    def reduce(rows, reducer, threshold):
+        by_reference = {}
+        for row in rows:
+            by_reference.setdefault(row[0], []).append(row)
+        reduced = []
+        for reference_rows in by_reference.values():
+            times = [int(round(iso8601_to_epoch_seconds(row[1]) * 1e9)) for row in reference_rows]
+            values = [float(json.loads(row[2])['doubleValue']) for row in reference_rows]
+            reduced.extend(reference_rows[index] for index in reducer(times, values, threshold))
+        return sorted(reduced)
+
+    def test_reducers_match_bin_mode(self):
+        max_results = 90
+        points_per_measure = max_results // len(self.properties)
+        bins = self.read('bin', max_results * PRE_AGGREGATION_FACTOR)
+        for mode, reducer in (('lttb', lttb_indices), ('minmax', min_max_indices)):
+            with self.subTest(mode=mode):
+                rows = self.read(mode, max_results)
+                self.assertLessEqual(len(rows), max_results)
+                self.assertEqual(rows, self.reduce(bins, reducer, points_per_measure))
+
+    def test_reducer_indices(self):
+        times = [index * 1000000000 for index in range(1000)]
+        values = [float((index * 7919) % 101) for index in range(1000)]
+        for reducer in (lttb_indices, min_max_indices):
+            with self.subTest(reducer=reducer.__name__):
+                indices = list(reducer(times, values, 50))
+                self.assertLessEqual(len(indices), 50)
+                self.assertEqual(indices, sorted(set(indices)))
+        lttb = list(lttb_indices(times, values, 50))
+        self.assertEqual((lttb[0], lttb[-1]), (0, 999))
+        minmax = list(min_max_indices(times, values, 50))
+        self.assertIn(values.index(max(values)), minmax)
+        self.assertIn(values.index(min(values)), minmax)
+
+
+if __name__ == '__main__':
+    unittest.main()
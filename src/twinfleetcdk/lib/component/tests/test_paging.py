@@ -0,0 +1,145 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import connector_fixture as fixture
+from data_reader import TimestreamPagePrefetcher
+from udq_utils.udq_models import UdqCursor
+
+
+class PagingTest(unittest.TestCase):
+    """
+    Whatever cuts the responses (maxResults, the payload budget, shards merged on time) and whatever the table layout,
+    following the nextToken returns the rows of the plain reader on a single-measure table
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.properties = fixture.property_names(6)
+        cls.clients = {multi_measure: fixture.local_client(empty_pages=1, multi_measure=multi_measure)
+                       for multi_measure in (False, True)}
+        cls.executor = ThreadPoolExecutor(4)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def reader(self, multi_measure=False, **kwargs):
+        return fixture.reader(self.clients[multi_measure], multi_measure=multi_measure, **kwargs)
+
+    def read_all(self, udq_reader, **event_kwargs):
+        return fixture.read_all(udq_reader, properties=self.properties, **event_kwargs)
+
+    def assertSameRows(self, reader_kwargs, event_kwargs, min_responses=1):
+        expected, _ = self.read_all(self.reader(), **event_kwargs)
+        self.assertTrue(expected)
+        for multi_measure in (False, True):
+            with self.subTest(multi_measure=multi_measure, **reader_kwargs, **event_kwargs):
+                rows, responses = self.read_all(self.reader(multi_measure, **reader_kwargs), **event_kwargs)
+                self.assertEqual(expected, rows)
+                self.assertGreaterEqual(responses, min_responses)
+
+    def test_multi_measure(self):
+        for order in ('ASCENDING', 'DESCENDING'):
+            self.assertSameRows({}, dict(order=order))
+
+    def test_max_results(self):
+        for order in ('ASCENDING', 'DESCENDING'):
+            self.assertSameRows({}, dict(order=order, max_results=250), min_responses=10)
+
+    def test_budget_cut(self):
+        for order in ('ASCENDING', 'DESCENDING'):
+            self.assertSameRows(dict(max_response_bytes=30000), dict(order=order), min_responses=10)
+            self.assertSameRows(dict(max_response_bytes=30000), dict(order=order, max_results=500), min_responses=10)
+
+    def test_sharded_merge(self):
+        sharding = dict(executor=self.executor, measure_shards=3, time_shards=2)
+        for order in ('ASCENDING', 'DESCENDING'):
+            self.assertSameRows(sharding, dict(order=order))
+            self.assertSameRows(dict(sharding, shard_page_rows=100), dict(order=order), min_responses=2)
+            self.assertSameRows(dict(sharding, max_response_bytes=30000), dict(order=order), min_responses=10)
+
+    def test_component_type(self):
+        for order in ('ASCENDING', 'DESCENDING'):
+            self.assertSameRows({}, dict(order=order, component_type=True))
+            self.assertSameRows(dict(max_response_bytes=30000), dict(order=order, component_type=True),
+                                min_responses=10)
+            self.assertSameRows({}, dict(order=order, component_type=True, max_results=500), min_responses=10)
+
+
+class CursorTest(unittest.TestCase):
+    """
+    A nextToken is a signed UdqCursor that any container can resume from, and that is rejected once altered
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.properties = fixture.property_names(6)
+        cls.client = fixture.local_client()
+
+    def responses(self, udq_reader, next_token=None):
+        """
+        :return: the (rows, nextToken) of every response from next_token on
+        """
+        responses = []
+        while True:
+            response = udq_reader.process_query(fixture.entity_event(self.properties, next_token=next_token))
+            next_token = response.get('nextToken')
+            responses.append((fixture.response_rows(response), next_token))
+            if not next_token:
+                return responses
+
+    def test_resume_in_another_container(self):
+        responses = self.responses(fixture.reader(self.client, max_response_bytes=30000))
+        self.assertGreater(len(responses), 3)
+        for index in (0, len(responses) // 2, len(responses) - 2):
+            with self.subTest(response=index):
+                resumed = self.responses(fixture.reader(self.client, max_response_bytes=30000), responses[index][1])
+                self.assertEqual(resumed, responses[index + 1:])
+
+    def test_altered_cursor(self):
+        udq_reader = fixture.reader(self.client, max_response_bytes=30000)
+        next_token = self.responses(udq_reader)[0][1]
+        payload, _, signature = next_token.rpartition('.')
+        cursor = UdqCursor.decode(next_token)
+        altered_payload = UdqCursor(cursor.kind, dict(cursor.state, r=None)).encode().rpartition('.')[0]
+        altered_signature = ('A' if signature[0] != 'A' else 'B') + signature[1:]
+        for token in (altered_payload + '.' + signature, payload + '.' + altered_signature):
+            with self.subTest(token=token):
+                with self.assertRaisesRegex(Exception, 'Invalid nextToken signature'):
+                    udq_reader.process_query(fixture.entity_event(self.properties, next_token=token))
+
+
+class PrefetchTest(unittest.TestCase):
+    """
+    The follow-up invocation of a nextToken takes the page prefetched for it, and no page is requested twice
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.properties = fixture.property_names(6)
+        cls.client = fixture.local_client(empty_pages=1)
+        cls.executor = ThreadPoolExecutor(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def read_all(self, udq_reader):
+        calls = self.client.calls
+        rows, responses = fixture.read_all(udq_reader, properties=self.properties, max_results=250)
+        return rows, responses, self.client.calls - calls
+
+    def test_token_reuse(self):
+        expected, expected_responses, expected_calls = self.read_all(fixture.reader(self.client))
+        prefetcher = TimestreamPagePrefetcher(self.executor, 8)
+        rows, responses, calls = self.read_all(fixture.reader(self.client, prefetcher=prefetcher))
+        self.assertEqual((rows, responses), (expected, expected_responses))
+        self.assertEqual(calls, expected_calls)
+        self.assertEqual((prefetcher.hits, prefetcher.misses), (responses - 1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
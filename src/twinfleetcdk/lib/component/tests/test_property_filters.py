@@ -0,0 +1,59 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import unittest
+
+import connector_fixture as fixture
+
+
+def filter_on(property_name, operator, value):
+    return {'propertyName': property_name, 'operator': operator, 'value': {'doubleValue': value}}
+
+
+class PropertyFiltersTest(unittest.TestCase):
+    """
+    A propertyFilter narrows the response to its property, as `measure_name = X AND value op v` did,
+    on single-measure and multi-measure tables
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.properties = fixture.property_names(3)
+        cls.clients = {multi_measure: fixture.local_client(measures=3, vehicles=1, seconds=300,
+                                                           multi_measure=multi_measure)
+                       for multi_measure in (False, True)}
+
+    def read(self, filters, multi_measure=False):
+        udq_reader = fixture.reader(self.clients[multi_measure], multi_measure=multi_measure)
+        return fixture.read_all(udq_reader, properties=self.properties, vehicle='vehicle0', filters=filters)[0]
+
+    def test_single_filter(self):
+        threshold = 20.0
+        for multi_measure in (False, True):
+            with self.subTest(multi_measure=multi_measure):
+                rows = self.read([filter_on(self.properties[0], '>', threshold)], multi_measure)
+                self.assertTrue(rows)
+                self.assertEqual({json.loads(row[0])['propertyName'] for row in rows}, {self.properties[0]})
+                self.assertTrue(all(float(json.loads(row[2])['doubleValue']) > threshold for row in rows))
+                unfiltered = [row for row in self.read(None, multi_measure) if row[0] == rows[0][0]]
+                self.assertLess(len(rows), len(unfiltered))
+                self.assertEqual(rows, [row for row in unfiltered
+                                        if float(json.loads(row[2])['doubleValue']) > threshold])
+
+    def test_filters_on_several_properties(self):
+        rows = self.read([filter_on(self.properties[0], '>', 20.0), filter_on(self.properties[1], '<', 20.0)])
+        by_property = {}
+        for reference, _, value in rows:
+            by_property.setdefault(json.loads(reference)['propertyName'], []).append(
+                float(json.loads(value)['doubleValue']))
+        self.assertEqual(set(by_property), set(self.properties[:2]))
+        self.assertTrue(all(value > 20.0 for value in by_property[self.properties[0]]))
+        self.assertTrue(all(value < 20.0 for value in by_property[self.properties[1]]))
+
+    def test_filter_on_unselected_property(self):
+        self.assertEqual(self.read([filter_on('Vehicle_Synthetic_Signal9', '>', 0.0)]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+import unittest
+
+import connector_fixture as fixture
+from data_reader import TimestreamResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+    """
+    Entries expire after the TTL of their window and are evicted, least recently used first, by count and by bytes
+    """
+
+    @staticmethod
+    def cache(max_entries=8, max_bytes=None):
+        return TimestreamResultCache(max_entries=max_entries, live_ttl_seconds=0.05, historical_ttl_seconds=3600,
+                                     settle_seconds=300, max_bytes=max_bytes)
+
+    def test_ttl(self):
+        cache = self.cache()
+        self.assertEqual(cache.ttl_for_window(fixture.WINDOW_START), 3600)
+        self.assertEqual(cache.ttl_for_window(fixture.iso8601(time.time())), 0.05)
+        cache.put('live', 'response', cache.live_ttl_seconds)
+        cache.put('historical', 'response', cache.historical_ttl_seconds)
+        self.assertEqual(cache.get('live'), 'response')
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('live'))
+        self.assertEqual(cache.get('historical'), 'response')
+
+    def test_byte_budget(self):
+        cache = self.cache(max_bytes=100)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, key, 3600, 40)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 80)
+        # b is now the most recently used
+        self.assertEqual(cache.get('b'), 'b')
+        cache.put('d', 'd', 3600, 40)
+        self.assertEqual((cache.get('b'), cache.get('c'), cache.get('d')), ('b', None, 'd'))
+        # a replaced entry only counts once
+        cache.put('d', 'd', 3600, 20)
+        self.assertEqual(cache.stats()['bytes'], 60)
+        cache.put('too large', 'response', 3600, 101)
+        self.assertIsNone(cache.get('too large'))
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_entry_budget(self):
+        cache = self.cache(max_entries=2)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, key, 3600)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (None, 'b', 'c'))
+
+
+class ReaderResultCacheTest(unittest.TestCase):
+    """
+    The reader serves repeated requests from the result cache, except the responses holding a Timestream NextToken
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.properties = fixture.property_names(2)
+        cls.client = fixture.local_client(measures=2, vehicles=1, seconds=600)
+
+    def setUp(self):
+        self.result_cache = TimestreamResultCache(max_entries=8, live_ttl_seconds=5, historical_ttl_seconds=3600,
+                                                  settle_seconds=300, max_bytes=10 ** 6)
+        self.udq_reader = fixture.reader(self.client, result_cache=self.result_cache)
+
+    def process_query(self, **event_kwargs):
+        # 600 rows, a single Timestream page
+        calls = self.client.calls
+        response = self.udq_reader.process_query(fixture.entity_event(self.properties, vehicle='vehicle0',
+                                                                      end='2022-04-06T00:05:00Z', **event_kwargs))
+        return response, self.client.calls - calls
+
+    def test_repeated_request(self):
+        response, queries = self.process_query()
+        self.assertGreater(queries, 0)
+        self.assertIsNone(response['nextToken'])
+        self.assertEqual(self.process_query(), (response, 0))
+        self.assertGreater(self.result_cache.stats()['bytes'], 0)
+
+    def test_byte_budget(self):
+        self.result_cache.max_bytes = 1000
+        response, _ = self.process_query()
+        self.assertEqual(self.result_cache.stats()['entries'], 0)
+        self.assertEqual(self.process_query()[0], response)
+
+    def test_timestream_next_token_not_cached(self):
+        response, _ = self.process_query(max_results=100)
+        self.assertTrue(response['nextToken'])
+        self.assertEqual(self.result_cache.stats()['entries'], 0)
+        repeated, queries = self.process_query(max_results=100)
+        self.assertGreater(queries, 0)
+        self.assertEqual(fixture.response_rows(repeated), fixture.response_rows(response))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+import unittest
+
+import connector_fixture as fixture
+import schema_init
+from local_timestream import install
+from schema_cache import SchemaCache
+
+SYNTHETIC_PROPERTIES = set(fixture.property_names(3))
+
+
+class SchemaInitTest(unittest.TestCase):
+    """
+    The schema is answered from the precomputed artifact and the schema cache, Timestream is only scanned for the
+    measures missing from the artifact when discovery is turned on
+    """
+
+    SETTINGS = ('DATABASE_NAME', 'TABLE_NAME', 'SCHEMA_CACHE', 'SCHEMA_DISCOVERY', 'SCHEMA_DISCOVERY_BATCH',
+                'DISCOVERY_RESULTS', 'QUERY_CLIENT')
+
+    @classmethod
+    def setUpClass(cls):
+        now = time.time()
+        cls.client = fixture.local_client(measures=3, vehicles=2, seconds=60, start=fixture.iso8601(now - 120))
+
+    def setUp(self):
+        self.settings = {name: getattr(schema_init, name) for name in self.SETTINGS}
+        schema_init.DATABASE_NAME = fixture.DATABASE_NAME
+        schema_init.TABLE_NAME = fixture.TABLE_NAME
+        schema_init.SCHEMA_CACHE = SchemaCache(None, 3600)
+        schema_init.DISCOVERY_RESULTS = {}
+        install(self.client, schema_init)
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            setattr(schema_init, name, value)
+
+    def schema(self, vehicle):
+        """
+        :return: the property names of the schema of the vehicle and the number of queries it ran
+        """
+        calls = self.client.calls
+        schema = schema_init.schema_init_handler({'properties': {'vehicleName': {'value': {'stringValue': vehicle}}}},
+                                                 None)
+        return set(schema['properties']), self.client.calls - calls
+
+    def test_discovery_is_off_by_default(self):
+        self.assertFalse(self.settings['SCHEMA_DISCOVERY'])
+        schema_init.SCHEMA_DISCOVERY = False
+        properties, queries = self.schema('vehicle0')
+        self.assertEqual(properties, set(schema_init.PRECOMPUTED_PROPERTIES))
+        self.assertEqual(queries, 0)
+
+    def test_discovery(self):
+        schema_init.SCHEMA_DISCOVERY = True
+        properties, queries = self.schema('vehicle0')
+        self.assertEqual(properties, set(schema_init.PRECOMPUTED_PROPERTIES) | SYNTHETIC_PROPERTIES)
+        self.assertEqual(queries, 1)
+        # served from the schema cache
+        self.assertEqual(self.schema('vehicle0'), (properties, 0))
+        self.assertEqual(self.schema('vehicle1'), (properties, 1))
+
+    def test_batch_discovery(self):
+        schema_init.SCHEMA_DISCOVERY = True
+        schema_init.SCHEMA_DISCOVERY_BATCH = True
+        properties, queries = self.schema('vehicle0')
+        self.assertTrue(SYNTHETIC_PROPERTIES <= properties)
+        self.assertEqual(queries, 1)
+        # the other vehicles are answered from the batch discovery
+        self.assertEqual(self.schema('vehicle1'), (properties, 0))
+
+    def test_quoted_vehicle_name(self):
+        self.assertEqual(schema_init.discover_measure_properties("vehicle0' OR '1'='1"), {})
+        self.assertEqual(set(schema_init.discover_measure_properties('vehicle0')), {'vehicle0'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import unittest
+
+import connector_fixture as fixture
+import schema_init
+from udq_utils.signal_index import SignalIndex
+
+
+class SignalIndexTest(unittest.TestCase):
+    """
+    A reader given the signal index rejects the signals and filters the catalog cannot produce, and accepts every
+    property of the default schema
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.signal_index = SignalIndex.load()
+        cls.client = fixture.local_client(measures=2, vehicles=1, seconds=60)
+
+    def read(self, properties, signal_index=None, filters=None):
+        udq_reader = fixture.reader(self.client, signal_index=signal_index)
+        return fixture.read_all(udq_reader, properties=properties, vehicle='vehicle0', filters=filters)[0]
+
+    def test_default_schema_properties(self):
+        properties = sorted(schema_init.create_default_schema('vehicle0')['properties'])
+        self.assertEqual(self.read(properties, self.signal_index), [])
+
+    def test_unknown_signal(self):
+        properties = fixture.property_names(2)
+        self.assertTrue(self.read(properties))
+        with self.assertRaisesRegex(Exception, r'Unknown signal\[Vehicle.Synthetic.Signal0\]'):
+            self.read(properties, self.signal_index)
+
+    def test_filter_value_type(self):
+        filters = [{'propertyName': 'Vehicle_Powertrain_Battery_hasActiveDTC', 'operator': '>',
+                    'value': {'doubleValue': 1.0}}]
+        with self.assertRaisesRegex(Exception, 'Unsupported filter'):
+            self.read(['Vehicle_Powertrain_Battery_hasActiveDTC'], self.signal_index, filters)
+
+    def test_property_outside_definition(self):
+        event = fixture.entity_event(['Vehicle_Speed'])
+        del event['properties']['Vehicle_Speed']
+        with self.assertRaisesRegex(Exception, 'not found in entity/component definition'):
+            fixture.reader(self.client, signal_index=self.signal_index).process_query(event)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import importlib.util
+import unittest
+
+import connector_fixture as fixture
+from udq_utils.sql_detector import SQLDetector
+
+SQLPARSE_INSTALLED = importlib.util.find_spec('sqlparse') is not None
+
+SAMPLE_QUERY = "SELECT time FROM fleet.telemetry WHERE vehicleName = 'v'"
+
+
+class SqlDetectorTest(unittest.TestCase):
+    """
+    Request values are escaped into single-token literals, accepted without sqlparse, and queries that would need
+    parsing are rejected when sqlparse is not installed
+    """
+
+    def test_request_values_are_safe_literals(self):
+        sql_detector = SQLDetector()
+        udq_reader = fixture.reader(fixture.local_client(measures=2, vehicles=1, seconds=60),
+                                    sql_detector=sql_detector)
+        rows, _ = fixture.read_all(udq_reader, properties=fixture.property_names(2),
+                                   vehicle="vehicle0' OR '1'='1")
+        self.assertEqual(rows, [])
+        self.assertGreater(sql_detector.fastPathCount, 0)
+        self.assertEqual(sql_detector.fullParseCount, 0)
+
+    @unittest.skipIf(SQLPARSE_INSTALLED, 'sqlparse is installed')
+    def test_unverifiable_query_without_sqlparse(self):
+        query = "SELECT time FROM fleet.telemetry WHERE vehicleName = 'v' OR 1=1"
+        with self.assertRaisesRegex(Exception, 'Cannot verify query'):
+            SQLDetector().detectInjection(SAMPLE_QUERY, query, ["'v' OR 1=1"])
+
+    @unittest.skipIf(not SQLPARSE_INSTALLED, 'sqlparse is not installed')
+    def test_injection_with_sqlparse(self):
+        query = "SELECT time FROM fleet.telemetry WHERE vehicleName = 'v' OR 1=1"
+        with self.assertRaisesRegex(Exception, 'Detected potential injection'):
+            SQLDetector().detectInjection(SAMPLE_QUERY, query, ["'v' OR 1=1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import pickle
+import unittest
+
+import connector_fixture  # noqa: F401 sets up the import path
+from udq_utils.udq_models import EntityComponentPropertyRef, ExternalIdPropertyRef, IoTTwinMakerReference
+
+
+class InternedRefTest(unittest.TestCase):
+    """
+    Equal references are the same immutable instance, and what they hand out cannot change the interned instance
+    """
+
+    def test_interning(self):
+        ecp = EntityComponentPropertyRef('entity', 'component', 'Vehicle_Speed')
+        self.assertIs(EntityComponentPropertyRef('entity', 'component', 'Vehicle_Speed'), ecp)
+        self.assertIs(IoTTwinMakerReference(ecp=ecp), IoTTwinMakerReference(ecp=ecp))
+        self.assertIsNot(EntityComponentPropertyRef('entity', 'component', 'Vehicle_InCabinTemperature'), ecp)
+        self.assertIs(pickle.loads(pickle.dumps(ecp)), ecp)
+        eip = ExternalIdPropertyRef({'vehicleName': 'vehicle0', 'fleet': 'fleet0'}, 'Vehicle_Speed')
+        self.assertIs(ExternalIdPropertyRef({'fleet': 'fleet0', 'vehicleName': 'vehicle0'}, 'Vehicle_Speed'), eip)
+        self.assertIs(pickle.loads(pickle.dumps(eip)), eip)
+
+    def test_immutable(self):
+        ecp = EntityComponentPropertyRef('entity', 'component', 'Vehicle_Speed')
+        with self.assertRaises(AttributeError):
+            ecp._key = ('entity', 'component', 'Vehicle_InCabinTemperature')
+
+    def test_external_id_property_is_not_shared(self):
+        external_id_property = {'vehicleName': 'vehicle0'}
+        reference = IoTTwinMakerReference(eip=ExternalIdPropertyRef(external_id_property, 'Vehicle_Speed'))
+        external_id_property['vehicleName'] = 'vehicle1'
+        with self.assertRaises(TypeError):
+            reference.eip.external_id_property['vehicleName'] = 'vehicle1'
+        serialized = reference.serialize()
+        serialized['externalIdProperty']['vehicleName'] = 'vehicle1'
+        self.assertEqual(reference.serialize(), {'externalIdProperty': {'vehicleName': 'vehicle0'},
+                                                 'propertyName': 'Vehicle_Speed'})
+        self.assertEqual(dict(reference.eip.external_id_property), {'vehicleName': 'vehicle0'})
+
+
+if __name__ == '__main__':
+    unittest.main()
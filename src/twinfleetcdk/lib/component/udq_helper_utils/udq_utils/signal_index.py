@@ -0,0 +1,80 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2022
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+from types import MappingProxyType
+from typing import Dict
+
+from udq_utils.property_names import PROPERTY_NAMES
+
+# ---------------------------------------------------------------------------
+#   Allowlist of the signals a query can select or filter on
+#
+#   The time series signals of the FleetWise signal catalog (sensors and actuators) and the properties of the default
+#   schema of schema_init, with their value types, from a prebuilt table, signal_index.json, generated by
+#   schema_initializer/build_schema.py. The index is frozen at load, every check is a dictionary lookup. Without a
+#   table, e.g. SIGNAL_INDEX_TABLE set to 'none', every signal is accepted. The connectors are given the index,
+#   see TimestreamReader
+# ---------------------------------------------------------------------------
+
+# value type of the measures of a signal, per FleetWise signal data type: FleetWise stores every numeric as a double
+FLEETWISE_DATA_TYPES = {
+    'BOOLEAN': 'BOOLEAN',
+    'STRING': 'STRING',
+    **{numeric: 'DOUBLE' for numeric in ('INT8', 'UINT8', 'INT16', 'UINT16', 'INT32', 'UINT32', 'INT64', 'UINT64',
+                                         'FLOAT', 'DOUBLE', 'UNIX_TIMESTAMP')},
+}
+
+# properties accepted in selectedProperties that are not signals of the catalog
+NON_SIGNAL_PROPERTIES = frozenset(['alarm_status'])
+
+DEFAULT_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'signal_index.json')
+
+
+class SignalIndex:
+    """
+    Frozen index of the catalog signals, see the module comment
+    """
+
+    def __init__(self, signals: Dict[str, str] = None):
+        """
+        :param signals: {fully qualified name: value type}, value types being those of FLEETWISE_DATA_TYPES
+        None for no allowlist
+        """
+        self.enabled = signals is not None
+        self.signals = MappingProxyType(dict(signals or {}))
+        self.non_signal_measures = frozenset(PROPERTY_NAMES.to_signal(name) for name in NON_SIGNAL_PROPERTIES)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_TABLE_PATH) -> 'SignalIndex':
+        """
+        :return: the index of the table file at path, no allowlist when there is no such file
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as table_file:
+            table = json.load(table_file)
+        if table.get('version') != 1:
+            raise Exception(f"Unsupported signal index version[{table.get('version')}] in {path}")
+        return cls(table['signals'])
+
+    def accepts_measure(self, signal_name: str) -> bool:
+        """
+        :return: True if signal_name can be queried: a catalog signal, or the measure of a non-signal property
+        """
+        return not self.enabled or signal_name in self.signals or signal_name in self.non_signal_measures
+
+    def accepts_filter(self, signal_name: str, value_type: str) -> bool:
+        """
+        :param value_type: the value type of the filter value, 'DOUBLE', 'BOOLEAN' or 'STRING'
+        :return: True if signal_name can be queried and its values can compare to a value of value_type
+        """
+        signal_type = self.signals.get(signal_name)
+        if signal_type is None:
+            return self.accepts_measure(signal_name)
+        return signal_type == value_type
+
+
+# the allowlist of the connectors, set SIGNAL_INDEX_TABLE to use another table file, 'none' for no allowlist
+SIGNAL_INDEX = SignalIndex.load(os.environ.get('SIGNAL_INDEX_TABLE', DEFAULT_TABLE_PATH))
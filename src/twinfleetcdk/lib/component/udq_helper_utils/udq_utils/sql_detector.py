@@ -1,10 +1,38 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2022
 # SPDX-License-Identifier: Apache-2.0
 
-import sqlparse
+import re
+import threading
+from collections import OrderedDict
+
+# a literal that renders as exactly one SQL token: a string literal or quoted identifier with its quotes doubled,
+# a number, or a boolean. Interpolated into a fixed template, such literals cannot change the shape of the query
+SAFE_LITERAL_PATTERN = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false""")
+
+# What the check protects: the connectors render queries from fixed templates (udq_utils.query_builder), with
+# the request values (vehicle name, measure names, filter values, times) escaped into literals. A query whose literals
+# are all single safe tokens has the shape of its template and is accepted without parsing. Any other query means a
+# literal escaped its quoting, and is compared token by token to the sample query of its template with sqlparse.
+# sqlparse is neither in the udq_utils layer nor in the function code: there, such queries are rejected as queries
+# that cannot be verified, which is also what happens to a query that fails the comparison
+#
+# The fast path only guards the output of the query builder: it checks the literals after escaping, as rendered by
+# query_builder, never the raw request values, and it trusts that the query is the template rendered with exactly those
+# literals. It catches a literal that escapes its quoting through a bug of the escaping functions, it does not validate
+# the request. A query written by hand, or whose literals are not known, has to be checked without literals
+
+# bound of the cached token contexts of sample queries, there is one sample query per query shape
+MAX_SAMPLE_QUERIES = 256
 
 
 class SQLDetector:
+    def __init__(self):
+        self._sampleContexts = OrderedDict()
+        self._lock = threading.Lock()
+        # number of queries accepted from their literals only, and of queries compared token by token
+        self.fastPathCount = 0
+        self.fullParseCount = 0
+
     def getSubTokenCount(self, token):
         count = 0
         for _ in token.flatten():
@@ -12,6 +40,12 @@ class SQLDetector:
         return count
 
     def getQueryContext(self, query):
+        # sqlparse is imported on first use, it is only needed when a query has to be parsed
+        try:
+            import sqlparse
+        except ImportError:
+            raise Exception(f"Cannot verify query, sqlparse is not installed: {query}")
+
         tokenContext = []
         statements = sqlparse.parse(query)
         for statement in statements:
@@ -19,7 +53,25 @@ class SQLDetector:
                 tokenContext.append(self.getSubTokenCount(token))
         return tokenContext
 
-    def detectInjection(self, sampleQuery, query):
+    def getSampleContext(self, sampleQuery):
+        """The token context of a sample query, parsed once and then cached"""
+        with self._lock:
+            tokenContext = self._sampleContexts.get(sampleQuery)
+            if tokenContext is not None:
+                self._sampleContexts.move_to_end(sampleQuery)
+                return tokenContext
+        tokenContext = self.getQueryContext(sampleQuery)
+        with self._lock:
+            self._sampleContexts[sampleQuery] = tokenContext
+            if len(self._sampleContexts) > MAX_SAMPLE_QUERIES:
+                self._sampleContexts.popitem(last=False)
+        return tokenContext
+
+    @staticmethod
+    def isSafeLiteral(literal):
+        return SAFE_LITERAL_PATTERN.fullmatch(literal) is not None
+
+    def detectInjection(self, sampleQuery, query, literals=None):
         """Detection potential SQL Injection by comparing token context of sample query and real time query.
 
         Parameters
@@ -28,10 +80,18 @@ class SQLDetector:
                 The query string represents normal single statement.
             query: string, required
                 The real query string.
+            literals: list of strings, optional
+                The rendered literals interpolated into the query template, when query is rendered from a template
+                whose sample query is sampleQuery. If every literal is a single safe token, the query has the shape
+                of the sample query and is accepted without parsing it. Otherwise, or without literals, the query
+                is parsed and compared to the cached token context of the sample query.
+                Only pass the escaped literals the query was actually rendered with (udq_utils.query_builder): the
+                query itself is not looked at on the fast path.
 
         Returns
         -------
             If token context changed, the method will throw Exception.
+            If the query has to be parsed and sqlparse is not installed, the method will throw Exception.
 
         Examples
         --------
@@ -41,11 +101,18 @@ class SQLDetector:
             query = "SELECT * FROM users WHERE userId = 'abc_ef-gh'"
 
             detector.detectInjection(sample_query, query) # no issue, no exception
+            detector.detectInjection(sample_query, query, ["'abc_ef-gh'"]) # no issue, query not parsed
 
             query_injected = "SELECT * FROM users WHERE userId = 'abc' OR 1=1"
             detector.detectInjection(sample_query, query_injected) # Exception throws!
         """
-        sampleTokenContext = self.getQueryContext(sampleQuery)
+        if literals is not None and all(self.isSafeLiteral(literal) for literal in literals):
+            self.fastPathCount += 1
+            return
+
+        # without sqlparse, the query is rejected as one that cannot be verified
+        self.fullParseCount += 1
+        sampleTokenContext = self.getSampleContext(sampleQuery)
         tokenContext = self.getQueryContext(query)
         if not sampleTokenContext == tokenContext:
             raise Exception(f"Detected potential injection from query: {query}")
@@ -0,0 +1,145 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2022
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import time
+from typing import Dict, List
+
+# ---------------------------------------------------------------------------
+#   Per-phase latency metrics for UDQ connectors
+#
+#   Set a sink on the connector (IoTTwinMakerUnifiedDataQuery.metrics_sink) to record, for every invocation:
+#   - durations, in milliseconds: parse, query, timestream, conversion, marshal
+#   - counts: rows, pages, timestream_queries, prefetch_hits, and the response bytes
+#   process_query activates a UdqMetrics recorder for the invocation, connector code records into current().
+#   Without a sink the current recorder is DISABLED_METRICS, whose clock() returns a constant and whose add_duration,
+#   add_count and get do nothing: instrumented code calls it unconditionally, so a disabled recorder costs a no-op
+#   method call per instrumented call and never reads the clock. Code that does more than record, e.g. measuring the
+#   response size, checks `enabled` first
+# ---------------------------------------------------------------------------
+
+# CloudWatch unit of every metric, metrics not listed here are counts
+METRIC_UNITS = {
+    "parse": "Milliseconds",
+    "query": "Milliseconds",
+    "timestream": "Milliseconds",
+    "conversion": "Milliseconds",
+    "marshal": "Milliseconds",
+    "bytes": "Bytes",
+}
+
+
+class UdqMetrics:
+    """
+    The metrics recorded during one UDQ invocation
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.values: Dict[str, float] = {}
+        self.dimensions: Dict[str, str] = {}
+
+    @staticmethod
+    def clock() -> float:
+        return time.perf_counter()
+
+    def add_duration(self, name: str, start: float):
+        """
+        Adds the milliseconds elapsed since start, a clock() value, to the duration metric name
+        """
+        self.values[name] = self.values.get(name, 0.0) + (time.perf_counter() - start) * 1000.0
+
+    def add_count(self, name: str, count: int = 1):
+        self.values[name] = self.values.get(name, 0) + count
+
+    def get(self, name: str, default=0):
+        return self.values.get(name, default)
+
+
+class DisabledMetrics(UdqMetrics):
+    """
+    The recorder active when no sink is configured, it records nothing
+    """
+
+    enabled = False
+
+    @staticmethod
+    def clock() -> float:
+        return 0.0
+
+    def add_duration(self, name: str, start: float):
+        pass
+
+    def add_count(self, name: str, count: int = 1):
+        pass
+
+    def get(self, name: str, default=0):
+        return default
+
+
+DISABLED_METRICS = DisabledMetrics()
+
+_current = DISABLED_METRICS
+
+
+def current() -> UdqMetrics:
+    """
+    :return: the recorder of the running invocation, DISABLED_METRICS outside of an instrumented invocation
+    """
+    return _current
+
+
+def activate(metrics: UdqMetrics) -> UdqMetrics:
+    """
+    Makes metrics the current recorder, Lambda runs one invocation at a time per container
+    :return: the previous recorder, to be restored with activate() at the end of the invocation
+    """
+    global _current
+    previous = _current
+    _current = metrics
+    return previous
+
+
+class EmfMetricsSink:
+    """
+    Writes the metrics of every invocation to stdout as one CloudWatch Embedded Metric Format log line
+    see https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    """
+
+    def __init__(self, namespace: str, dimensions: Dict[str, str] = None):
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+
+    def emit(self, metrics: UdqMetrics):
+        dimensions = dict(self.dimensions, **metrics.dimensions)
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [sorted(dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": METRIC_UNITS.get(name, "Count")}
+                            for name in sorted(metrics.values)
+                        ],
+                    }
+                ],
+            }
+        }
+        record.update(dimensions)
+        record.update(metrics.values)
+        print(json.dumps(record))
+
+
+class LocalMetricsSink:
+    """
+    Keeps the metrics of every invocation in memory, for tests and the offline benchmark
+    """
+
+    def __init__(self):
+        self.records: List[Dict[str, float]] = []
+
+    def emit(self, metrics: UdqMetrics):
+        self.records.append(dict(metrics.dimensions, **metrics.values))
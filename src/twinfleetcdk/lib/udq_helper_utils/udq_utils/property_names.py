@@ -0,0 +1,109 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2022
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+from typing import Dict, Iterable
+
+# ---------------------------------------------------------------------------
+#   Mapping between FleetWise signal names and AWS IoT TwinMaker property names
+#
+#   FleetWise signal names (Timestream measure names) have '.' in them, which TwinMaker property names do not allow.
+#   Signals of the signal catalog are mapped through a precomputed table, property_names.json, generated by
+#   schema_initializer/build_schema.py: both directions are exact dictionary lookups, so signal names with '_'
+#   map back to themselves. Names that are not in the table, e.g. signals added after the table was generated,
+#   fall back to the historical encoding: illegal characters are replaced with '_' one way, '_' with '.' the other
+# ---------------------------------------------------------------------------
+
+ILLEGAL_CHARACTERS = ['#', '(', ')', ' ', '.']
+
+# bound of the memoized fallback conversions, names come from requests
+MAX_FALLBACK_NAMES = 4096
+
+DEFAULT_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'property_names.json')
+
+
+def encode_property_name(signal_name: str) -> str:
+    """
+    The historical encoding of a signal name into a property name, e.g. 'Vehicle.Speed' -> 'Vehicle_Speed'
+    """
+    for illegal_char in ILLEGAL_CHARACTERS:
+        signal_name = signal_name.replace(illegal_char, '_')
+    return signal_name.replace('__', '_')
+
+
+def decode_property_name(property_name: str) -> str:
+    """
+    The historical decoding of a property name into a signal name, e.g. 'Vehicle_Speed' -> 'Vehicle.Speed'
+    """
+    return property_name.replace('_', '.')
+
+
+class PropertyNames:
+    """
+    Bijective mapping of signal names to property names, see the module comment
+    """
+
+    def __init__(self, table: Dict[str, str] = None):
+        """
+        :param table: {property name: signal name}, see build_table
+        """
+        self.signals = dict(table or {})
+        self.properties = {signal_name: property_name for property_name, signal_name in self.signals.items()}
+        if len(self.properties) != len(self.signals):
+            raise Exception("Property name table maps several properties to the same signal")
+        self._encoded = {}
+        self._decoded = {}
+
+    @staticmethod
+    def build_table(signal_names: Iterable[str]) -> Dict[str, str]:
+        """
+        :return: {property name: signal name} of signal_names. A signal gets its historical encoding unless another
+        signal already has it, e.g. 'Vehicle.Cell_Temp' and 'Vehicle.Cell.Temp', then a '_<n>' suffix
+        """
+        table = {}
+        for signal_name in sorted(set(signal_names)):
+            property_name = encode_property_name(signal_name)
+            suffix = 2
+            while property_name in table:
+                property_name = f'{encode_property_name(signal_name)}_{suffix}'
+                suffix += 1
+            table[property_name] = signal_name
+        return table
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_TABLE_PATH) -> 'PropertyNames':
+        """
+        :return: the mapping of the table file at path, only the fallback encoding when there is no such file
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as table_file:
+            table = json.load(table_file)
+        if table.get('version') != 1:
+            raise Exception(f"Unsupported property name table version[{table.get('version')}] in {path}")
+        return cls(table['properties'])
+
+    def to_property(self, signal_name: str) -> str:
+        property_name = self.properties.get(signal_name)
+        if property_name is None:
+            property_name = self._encoded.get(signal_name)
+            if property_name is None:
+                if len(self._encoded) >= MAX_FALLBACK_NAMES:
+                    self._encoded.clear()
+                property_name = self._encoded[signal_name] = encode_property_name(signal_name)
+        return property_name
+
+    def to_signal(self, property_name: str) -> str:
+        signal_name = self.signals.get(property_name)
+        if signal_name is None:
+            signal_name = self._decoded.get(property_name)
+            if signal_name is None:
+                if len(self._decoded) >= MAX_FALLBACK_NAMES:
+                    self._decoded.clear()
+                signal_name = self._decoded[property_name] = decode_property_name(property_name)
+        return signal_name
+
+
+# the mapping of the connectors, set PROPERTY_NAMES_TABLE to use another table file
+PROPERTY_NAMES = PropertyNames.load(os.environ.get('PROPERTY_NAMES_TABLE', DEFAULT_TABLE_PATH))
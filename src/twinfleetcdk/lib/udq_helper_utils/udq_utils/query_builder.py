@@ -0,0 +1,365 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2021
+# SPDX-License-Identifier: Apache-2.0
+
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# ---------------------------------------------------------------------------
+#   Compiled query templates for the Timestream queries issued by the UDQ connector
+#
+#   A query is described by its shape (the parts that change the SQL structure: number of measures, time bound
+#   operators, filters, ordering, ...) and its literals (measure names, vehicle name, timestamps, filter values).
+#   Each shape is compiled once into a template with one slot per literal, literals are escaped and rendered into it.
+#   Query strings are therefore stable for a given request, and the sample query of a shape, used for SQL injection
+#   detection, is computed once per shape.
+# ---------------------------------------------------------------------------
+
+# operators accepted in propertyFilters, both as SQL operators and as IoT TwinMaker operator names
+FILTER_OPERATORS = {
+    '=': '=',
+    '!=': '!=',
+    '<>': '!=',
+    '<': '<',
+    '<=': '<=',
+    '>': '>',
+    '>=': '>=',
+    'EQUAL': '=',
+    'NOT_EQUAL': '!=',
+    'LESS_THAN': '<',
+    'LESS_THAN_OR_EQUAL': '<=',
+    'GREATER_THAN': '>',
+    'GREATER_THAN_OR_EQUAL': '>=',
+}
+
+# the measure value column compared by a propertyFilter, per IoT TwinMaker value type
+FILTER_VALUE_COLUMNS = {
+    'doubleValue': 'measure_value::double',
+    'integerValue': 'measure_value::double',
+    'longValue': 'measure_value::double',
+    'booleanValue': 'measure_value::boolean',
+    'stringValue': 'measure_value::varchar',
+}
+
+# the measure value column of a single-measure record, per Timestream type of a multi-measure column
+MEASURE_VALUE_COLUMNS = {
+    'double': 'measure_value::double',
+    'bigint': 'measure_value::bigint',
+    'boolean': 'measure_value::boolean',
+    'varchar': 'measure_value::varchar',
+}
+
+TIME_FUNCTIONS = ('from_iso8601_timestamp', 'from_milliseconds', 'from_nanoseconds')
+TIME_OPERATORS = ('>', '>=', '<', '<=')
+
+NUMBER_PATTERN = re.compile(r'^-?\d+(\.\d+)?([eE][-+]?\d+)?$')
+
+QueryShape = namedtuple('QueryShape', [
+    'database_name',
+    'table_name',
+    'bin',             # True to average the measures per bin(time, <literal>s)
+    'measure_count',
+    'vehicle',         # True to restrict the query to a single vehicleName
+    'lower',           # (operator, function) of the lower time bound
+    'upper',           # (operator, function) of the upper time bound
+    'filters',         # ((operator, value_column), ...) of the property filters, (operator, measure index) on multi-measure tables
+    'descending',
+    'measure_types',   # Timestream type of each measure column of a multi-measure table, None for single-measure records
+])
+
+
+def string_literal(value) -> str:
+    """
+    Renders a SQL string literal, quotes are escaped by doubling them
+    e.g. "it's" -> "'it''s'"
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def number_literal(value) -> str:
+    """
+    Renders a SQL numeric literal, anything that is not a number is rejected
+    """
+    text = str(value).strip()
+    if NUMBER_PATTERN.match(text):
+        return text
+    raise Exception(f"Invalid numeric literal[{value}]")
+
+
+def identifier(name) -> str:
+    """
+    Renders a quoted SQL identifier, quotes are escaped by doubling them
+    e.g. 'Vehicle.Speed' -> '"Vehicle.Speed"'
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def boolean_literal(value) -> str:
+    text = str(value).strip().lower()
+    if text in ('true', 'false'):
+        return text
+    raise Exception(f"Invalid boolean literal[{value}]")
+
+
+class TimeBound:
+    """
+    One side of the time range of a query, e.g. TimeBound('>', 'from_iso8601_timestamp', '2022-04-06T00:00:00Z')
+    """
+
+    __slots__ = ('operator', 'function', 'value')
+
+    def __init__(self, operator, function, value):
+        if operator not in TIME_OPERATORS or function not in TIME_FUNCTIONS:
+            raise Exception(f"Unsupported time bound[time {operator} {function}]")
+        self.operator = operator
+        self.function = function
+        self.value = value
+
+    @property
+    def shape(self):
+        return self.operator, self.function
+
+    @property
+    def literal(self) -> str:
+        if self.function == 'from_iso8601_timestamp':
+            return string_literal(self.value)
+        return str(int(self.value))
+
+
+class PropertyFilter:
+    """
+    A parsed IoT TwinMaker propertyFilter restricting the rows of one measure
+    e.g. {'propertyName': 'Vehicle_Speed', 'operator': '>', 'value': {'doubleValue': 50}}
+    """
+
+    __slots__ = ('measure_name', 'operator', 'value_column', 'literal')
+
+    def __init__(self, measure_name, operator, value_column, literal):
+        self.measure_name = measure_name
+        self.operator = operator
+        self.value_column = value_column
+        self.literal = literal
+
+    @staticmethod
+    def parse(property_filter: dict, measure_name: str):
+        operator = FILTER_OPERATORS.get(str(property_filter.get('operator', '')).upper())
+        if operator is None:
+            raise Exception(f"Unsupported filter operator[{property_filter.get('operator')}]")
+
+        value = property_filter.get('value', {})
+        for value_type, value_column in FILTER_VALUE_COLUMNS.items():
+            if value_type in value:
+                if value_type == 'booleanValue':
+                    literal = boolean_literal(value[value_type])
+                elif value_type == 'stringValue':
+                    literal = string_literal(value[value_type])
+                else:
+                    literal = number_literal(value[value_type])
+                return PropertyFilter(measure_name, operator, value_column, literal)
+        raise Exception(f"Unhandled filter value type[{value}]")
+
+    @property
+    def shape(self):
+        return self.operator, self.value_column
+
+
+@lru_cache(maxsize=256)
+def compile_query(shape: QueryShape) -> 'CompiledQuery':
+    """
+    Compiles a query shape into a template with one '{}' slot per literal, in this order:
+    bin seconds (if bin), lower time, upper time, vehicle name (if vehicle), measure names, then name and value of
+    every filter
+    """
+    if shape.measure_types is not None:
+        return compile_multi_measure_query(shape)
+    if shape.bin:
+        select = 'SELECT vehicleName, measure_name, bin(time, {}s) AS time,' \
+                 ' coalesce(avg(measure_value::double), max(CASE WHEN measure_value::boolean THEN 1.0 ELSE 0.0 END))' \
+                 ' AS "measure_value::double"'
+    else:
+        select = 'SELECT vehicleName, campaignName, measure_name, time, measure_value::boolean, measure_value::double'
+
+    parts = [
+        select,
+        f' FROM {shape.database_name}.{shape.table_name}',
+        f' WHERE time {shape.lower[0]} {shape.lower[1]}({{}})',
+        f' AND time {shape.upper[0]} {shape.upper[1]}({{}})',
+    ]
+    if shape.vehicle:
+        parts.append(' AND vehicleName = {}')
+    parts.append(' AND measure_name IN (' + ', '.join(['{}'] * shape.measure_count) + ')')
+    if shape.filters:
+        # a filter only restricts the rows of its own measure, the reader only selects filtered measures
+        for operator, value_column in shape.filters:
+            parts.append(f' AND (measure_name <> {{}} OR {value_column} {operator} {{}})')
+    if shape.bin:
+        parts.append(' GROUP BY vehicleName, measure_name, bin(time, {}s)')
+    # rows tying on time are ordered on the rest of their key, cursors resume on it, see TimestreamQueryShard
+    parts.append(f" ORDER BY time {'DESC' if shape.descending else 'ASC'}, vehicleName ASC, measure_name ASC")
+    return CompiledQuery(shape, ''.join(parts))
+
+
+def compile_multi_measure_query(shape: QueryShape) -> 'CompiledQuery':
+    """
+    Compiles the shape of a query on a multi-measure table, where each row carries the measures as typed columns
+
+    The literals are the same, in the same order, as for single-measure records, measure names and filter names being
+    column identifiers. The template refers to them by position since measure columns are used more than once.
+    A filter only restricts the values of its own measure: a failing value is selected as NULL, which is dropped when
+    the row is fanned out. The reader only selects filtered measures, see TimestreamReader._filtered_measures
+    """
+    bin_index = 0 if shape.bin else None
+    index = 1 if shape.bin else 0
+    lower_index, upper_index = index, index + 1
+    index += 2
+    vehicle_index = None
+    if shape.vehicle:
+        vehicle_index = index
+        index += 1
+    measure_indexes = list(range(index, index + shape.measure_count))
+    index += shape.measure_count
+
+    # the value of each measure column, NULL where one of its filters fails
+    conditions = [[] for _ in measure_indexes]
+    for operator, measure in shape.filters:
+        conditions[measure].append(f'{{{measure_indexes[measure]}}} {operator} {{{index + 1}}}')
+        index += 2
+    values = []
+    for measure_index, measure_conditions in zip(measure_indexes, conditions):
+        if measure_conditions:
+            values.append(f"CASE WHEN {' AND '.join(measure_conditions)} THEN {{{measure_index}}} END")
+        else:
+            values.append(f'{{{measure_index}}}')
+
+    if shape.bin:
+        # booleans are aggregated to 1.0 if true anywhere in the bin, like for single-measure records
+        aggregates = {
+            'double': 'avg({})',
+            'bigint': 'avg({})',
+            'boolean': 'max(CASE WHEN {0} THEN 1.0 WHEN NOT {0} THEN 0.0 END)',
+        }
+        columns = [aggregates.get(measure_type, 'max({})').format(value) + f' AS {{{measure_index}}}'
+                   for measure_type, value, measure_index in zip(shape.measure_types, values, measure_indexes)]
+        select = f'SELECT vehicleName, bin(time, {{{bin_index}}}s) AS time, ' + ', '.join(columns)
+    else:
+        columns = [value if value == f'{{{measure_index}}}' else f'{value} AS {{{measure_index}}}'
+                   for value, measure_index in zip(values, measure_indexes)]
+        select = 'SELECT vehicleName, time, ' + ', '.join(columns)
+
+    parts = [
+        select,
+        f' FROM {shape.database_name}.{shape.table_name}',
+        f' WHERE time {shape.lower[0]} {shape.lower[1]}({{{lower_index}}})',
+        f' AND time {shape.upper[0]} {shape.upper[1]}({{{upper_index}}})',
+    ]
+    if shape.vehicle:
+        parts.append(f' AND vehicleName = {{{vehicle_index}}}')
+    # rows of other multi-measure records, or without any selected measure, are not scanned into the result
+    parts.append(' AND (' + ' OR '.join(f'{{{i}}} IS NOT NULL' for i in measure_indexes) + ')')
+    if shape.bin:
+        parts.append(f' GROUP BY vehicleName, bin(time, {{{bin_index}}}s)')
+    # the measures of a row are fanned out in column order, see compile_query
+    parts.append(f" ORDER BY time {'DESC' if shape.descending else 'ASC'}, vehicleName ASC")
+    return CompiledQuery(shape, ''.join(parts))
+
+
+class CompiledQuery:
+    """
+    The template of a query shape, see compile_query
+    """
+
+    __slots__ = ('shape', 'template', '_sample')
+
+    def __init__(self, shape, template):
+        self.shape = shape
+        self.template = template
+        self._sample = None
+
+    def render(self, literals) -> str:
+        return self.template.format(*literals)
+
+    @property
+    def sample(self) -> str:
+        """
+        The query rendered with placeholder literals, a known-good query of this shape for SQL injection detection
+        """
+        if self._sample is None:
+            # a bin of 0s lexes as one token, any other bin as two, the sample takes a typical one
+            literals = ['60'] if self.shape.bin else []
+            literals += [self._sample_time(self.shape.lower[1]), self._sample_time(self.shape.upper[1])]
+            if self.shape.vehicle:
+                literals.append("'vehicle'")
+            measure_types = self.shape.measure_types
+            if measure_types is None:
+                literals += [f"'p{i}'" for i in range(self.shape.measure_count)]
+            else:
+                literals += [f'"p{i}"' for i in range(self.shape.measure_count)]
+            for i, (_, value_column) in enumerate(self.shape.filters):
+                if measure_types is not None:
+                    literals.append(f'"f{i}"')
+                    value_column = MEASURE_VALUE_COLUMNS.get(measure_types[value_column])
+                else:
+                    literals.append(f"'f{i}'")
+                literals.append("'abc'" if value_column == 'measure_value::varchar' else
+                                'true' if value_column == 'measure_value::boolean' else '0')
+            if self.shape.bin:
+                literals.append('60')
+            self._sample = self.render(literals)
+        return self._sample
+
+    @staticmethod
+    def _sample_time(function):
+        return "'2022-01-01T00:00:00Z'" if function == 'from_iso8601_timestamp' else '0'
+
+
+class MeasuresQuery:
+    """
+    A query selecting measures of the connector table, rendered from its compiled template
+
+    Measure names are sorted so the same selection always renders the same query string
+    For a multi-measure table, measure_types maps every measure column to its Timestream type, e.g. {'Vehicle.Speed':
+    'double'}, the measures are selected as columns and filters on measures that are not selected are ignored
+    """
+
+    __slots__ = ('compiled', 'literals', 'query_string')
+
+    def __init__(self, database_name, table_name, measure_names, lower: TimeBound, upper: TimeBound,
+                 vehicle_name=None, filters=(), descending=False, bin_seconds=None, measure_types=None):
+        measure_names = sorted(set(measure_names))
+        if measure_types is not None:
+            filters = [f for f in filters if f.measure_name in measure_names]
+            filter_shapes = tuple((f.operator, measure_names.index(f.measure_name)) for f in filters)
+            measure_literal = identifier
+        else:
+            filter_shapes = tuple(f.shape for f in filters)
+            measure_literal = string_literal
+        shape = QueryShape(
+            database_name=database_name,
+            table_name=table_name,
+            bin=bin_seconds is not None,
+            measure_count=len(measure_names),
+            vehicle=vehicle_name is not None,
+            lower=lower.shape,
+            upper=upper.shape,
+            filters=filter_shapes,
+            descending=descending,
+            measure_types=tuple(measure_types[name] for name in measure_names) if measure_types is not None else None,
+        )
+        literals = [str(int(bin_seconds))] if bin_seconds is not None else []
+        literals += [lower.literal, upper.literal]
+        if vehicle_name is not None:
+            literals.append(string_literal(vehicle_name))
+        literals += [measure_literal(name) for name in measure_names]
+        for f in filters:
+            literals.append(measure_literal(f.measure_name))
+            literals.append(f.literal)
+        if bin_seconds is not None:
+            literals.append(str(int(bin_seconds)))
+
+        self.compiled = compile_query(shape)
+        self.literals = literals
+        self.query_string = self.compiled.render(literals)
+
+    @property
+    def sample_query(self) -> str:
+        return self.compiled.sample
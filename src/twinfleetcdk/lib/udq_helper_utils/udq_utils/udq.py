@@ -3,7 +3,7 @@
 
 from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import List
+from typing import Callable, Iterable
 
 from udq_utils.udq_models import (
     IoTTwinMakerReference,
@@ -38,8 +38,12 @@ class IoTTwinMakerDataRow(ABC):
     - IoTTwinMakerReference that uniquely identifies the property location of this row
     - Timestamp for the row
     - Value for the row
+
+    The interface declares no instance attributes so implementations can use __slots__ for compact rows
     """
 
+    __slots__ = ()
+
     @abstractmethod
     def get_iottwinmaker_reference(self) -> IoTTwinMakerReference:
         """
@@ -91,12 +95,18 @@ class IoTTwinMakerUdqResponse:
     IoTTwinMakerUdqResponse models the return from the UDQ Lambda
 
     The UDQ framework will handle marshalling this IoTTwinMakerUdqResponse object into the JSON payload expected by IoT TwinMaker
-    It consists of a List of Connector Author implemented IoTTwinMakerDataRow and optional nextToken for pagination
+    It consists of an Iterable of Connector Author implemented IoTTwinMakerDataRow and optional nextToken for pagination
+    The rows can be a generator, they are consumed once, one at a time, while the response is marshalled
+
+    resume optionally maps a number of rows to the nextToken resuming the query right after the first rows of this
+    response, e.g. a UdqCursor holding the connector position. It is used when the framework cuts the response
     """
 
-    def __init__(self, rows: List[IoTTwinMakerDataRow], next_token: str = None):
+    def __init__(self, rows: Iterable[IoTTwinMakerDataRow], next_token: str = None,
+                 resume: Callable[[int], str] = None):
         self._rows = rows
         self._next_token = next_token
+        self._resume = resume
 
     @property
     def rows(self):
@@ -106,6 +116,10 @@ class IoTTwinMakerUdqResponse:
     def next_token(self):
         return self._next_token
 
+    @property
+    def resume(self):
+        return self._resume
+
     def __str__(self):
         return str(self.__dict__)
 
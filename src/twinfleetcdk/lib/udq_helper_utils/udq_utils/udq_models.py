@@ -1,72 +1,159 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. 2022
 # SPDX-License-Identifier: Apache-2.0
 
+import base64
+import hashlib
+import hmac
+import itertools
 import json
+import os
+import types
+import weakref
 from abc import ABC
 from datetime import datetime
 from enum import Enum
+from json.encoder import encode_basestring_ascii
 from typing import List
 
+from udq_utils import udq_metrics
 
-class EntityComponentPropertyRef:
+
+class _InternedRef:
     """
-    Represents an entity-component-property reference that uniquely identifies an AWS IoT TwinMaker property
-    Consists of an entityId, componentName, and propertyName
+    Base of the immutable reference types
+
+    A reference is interned: constructing a reference equal to a live one returns the live instance, so equal
+    references are usually the same object. The hash is computed once, at construction
     """
 
-    def __init__(self, entity_id: str, component_name: str, property_name: str):
-        self.entity_id = entity_id
-        self.component_name = component_name
-        self.property_name = property_name
+    __slots__ = ("_key", "_hash", "__weakref__")
+
+    def __new__(cls, key, *args):
+        interned = cls._interned.get(key)
+        if interned is None:
+            interned = object.__new__(cls)
+            object.__setattr__(interned, "_key", key)
+            object.__setattr__(interned, "_hash", hash(key))
+            interned._init(*args)
+            cls._interned[key] = interned
+        return interned
+
+    def _init(self, *args):
+        pass
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
 
     def __hash__(self):
-        return hash((self.entity_id, self.component_name, self.property_name))
+        return self._hash
 
     def __eq__(self, other):
-        return (self.entity_id, self.component_name, self.property_name) == (
-            other.entity_id,
-            other.component_name,
-            other.property_name,
+        return self is other or (
+            self.__class__ is other.__class__ and self._key == other._key
         )
 
+    def __reduce__(self):
+        return self.__class__, self._args()
+
 
-class ExternalIdPropertyRef:
+class EntityComponentPropertyRef(_InternedRef):
+    """
+    Represents an entity-component-property reference that uniquely identifies an AWS IoT TwinMaker property
+    Consists of an entityId, componentName, and propertyName
+    """
+
+    __slots__ = ()
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, entity_id: str, component_name: str, property_name: str):
+        return super().__new__(cls, (entity_id, component_name, property_name))
+
+    @property
+    def entity_id(self) -> str:
+        return self._key[0]
+
+    @property
+    def component_name(self) -> str:
+        return self._key[1]
+
+    @property
+    def property_name(self) -> str:
+        return self._key[2]
+
+    def _args(self):
+        return self._key
+
+
+class ExternalIdPropertyRef(_InternedRef):
     """
     Represents an externalIdProperty reference that uniquely identifies an AWS IoT TwinMaker property across entities
     Consists of a key-value map externalIdProperty and propertyName
     """
 
-    def __init__(self, external_id_property: dict, property_name: str):
-        self.external_id_property = external_id_property
-        self.property_name = property_name
+    __slots__ = ("_external_id_property",)
+    _interned = weakref.WeakValueDictionary()
 
-    def __hash__(self):
-        return hash((json.dumps(self.external_id_property), self.property_name))
-
-    def __eq__(self, other):
-        return (self.external_id_property, self.property_name) == (
-            other.external_id_property,
-            other.property_name,
+    def __new__(cls, external_id_property: dict, property_name: str):
+        return super().__new__(
+            cls,
+            (cls._external_id_key(external_id_property), property_name),
+            external_id_property,
         )
 
+    def _init(self, external_id_property):
+        object.__setattr__(self, "_external_id_property", dict(external_id_property))
+
+    @staticmethod
+    def _external_id_key(external_id_property: dict):
+        # the externalIdProperty values are strings, the sorted items make equal maps share one key whatever the
+        # key order. Other values fall back to their canonical JSON
+        try:
+            key = tuple(sorted(external_id_property.items()))
+            hash(key)
+            return key
+        except TypeError:
+            return json.dumps(external_id_property, sort_keys=True)
+
+    @property
+    def external_id_property(self) -> types.MappingProxyType:
+        # a read-only view, the map is shared by every holder of the interned reference
+        return types.MappingProxyType(self._external_id_property)
 
-class IoTTwinMakerReference:
+    @property
+    def property_name(self) -> str:
+        return self._key[1]
+
+    def _args(self):
+        return self._external_id_property, self._key[1]
+
+
+class IoTTwinMakerReference(_InternedRef):
     """
     Represents a unique reference to a property in AWS IoT TwinMaker
     May include an EntityComponentPropertyRef or an ExternalIdPropertyRef
     """
 
-    def __init__(
-        self, ecp: EntityComponentPropertyRef = None, eip: ExternalIdPropertyRef = None
+    __slots__ = ()
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(
+        cls, ecp: EntityComponentPropertyRef = None, eip: ExternalIdPropertyRef = None
     ):
-        self.ecp = ecp
-        self.eip = eip
+        return super().__new__(cls, (ecp, eip))
 
-    def __hash__(self):
-        return hash((self.ecp, self.eip))
+    @property
+    def ecp(self) -> EntityComponentPropertyRef:
+        return self._key[0]
 
-    def __eq__(self, other):
-        return (self.ecp, self.eip) == (other.ecp, other.eip)
+    @property
+    def eip(self) -> ExternalIdPropertyRef:
+        return self._key[1]
+
+    def _args(self):
+        return self._key
 
     def serialize(self):
         ret = {}
@@ -75,26 +162,152 @@ class IoTTwinMakerReference:
             ret["componentName"] = self.ecp.component_name
             ret["propertyName"] = self.ecp.property_name
         if self.eip:
-            ret["externalIdProperty"] = self.eip.external_id_property
+            ret["externalIdProperty"] = dict(self.eip.external_id_property)
             ret["propertyName"] = self.eip.property_name
         return ret
 
 
+# marshall python native types into common IoT TwinMaker types: value key and string conversion per python type
+# Note: the UDQ interface expects string value returns instead of JSON-native types
+VALUE_TYPES = {
+    str: ("stringValue", str),
+    float: ("doubleValue", str),
+    bool: ("booleanValue", str),
+}
+
+# encoded size of the JSON structure around the strings of the response, as serialized by json.dumps.
+# An empty string literal counts 2 bytes for its quotes, hence the - 4 for the two empty strings of a value entry
+VALUE_ENTRY_SIZES = {
+    key: len(json.dumps({"time": "", "value": {key: ""}})) - 4
+    for key, _ in VALUE_TYPES.values()
+}
+RESPONSE_SIZE = len(json.dumps({"propertyValues": [], "nextToken": None}))
+SEPARATOR_SIZE = len(", ")
+
+# room kept in a budgeted response for a connector cursor returned by IoTTwinMakerUdqResponse.resume
+CURSOR_RESERVE_SIZE = 512
+
+# cursors are signed with UDQ_CURSOR_SECRET, set it to make them tamper-proof. Without it the key is derived from the
+# function name, which still rejects corrupted tokens and cursors of another connector
+CURSOR_KEY = os.environ.get(
+    "UDQ_CURSOR_SECRET", "udq:" + os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "")
+).encode()
+
+
+class UdqCursor:
+    """
+    A versioned, signed nextToken holding a connector position instead of a data source token
+
+    The cursor has a kind naming the position format, and a JSON state. It is encoded as
+        udq<version>.<base64url JSON [kind, state]>.<base64url truncated HMAC-SHA256>
+    e.g. UdqCursor("page", {"t": "AYABe...", "s": 120}).encode() -> 'udq1.WyJwYWdlIix7InQiOi...ImV9XQ.3sS1...'
+
+    Kinds used by the framework:
+    - page: a response cut by the payload budget, t is the nextToken of the page and s the rows already returned
+    """
+
+    VERSION = 1
+    PREFIX = f"udq{VERSION}."
+    SIGNATURE_BYTES = 12
+
+    def __init__(self, kind: str, state: dict):
+        self.kind = kind
+        self.state = state
+
+    @staticmethod
+    def is_cursor(token) -> bool:
+        return bool(token) and token.startswith("udq") and "." in token[:8]
+
+    @staticmethod
+    def _b64encode(data: bytes) -> str:
+        return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+    @staticmethod
+    def _b64decode(text: str) -> bytes:
+        return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+    @staticmethod
+    def _sign(payload: str) -> str:
+        digest = hmac.new(CURSOR_KEY, payload.encode(), hashlib.sha256).digest()
+        return UdqCursor._b64encode(digest[: UdqCursor.SIGNATURE_BYTES])
+
+    def encode(self) -> str:
+        data = json.dumps([self.kind, self.state], separators=(",", ":"))
+        payload = UdqCursor.PREFIX + UdqCursor._b64encode(data.encode())
+        return payload + "." + UdqCursor._sign(payload)
+
+    @staticmethod
+    def decode(token: str, kind: str = None) -> "UdqCursor":
+        """
+        :return: the cursor of the token, after checking its version, signature and, if given, kind
+        """
+        if not token.startswith(UdqCursor.PREFIX):
+            raise Exception(f"Unsupported nextToken version[{token[:8]}]")
+        payload, _, signature = token.rpartition(".")
+        if not hmac.compare_digest(signature, UdqCursor._sign(payload)):
+            raise Exception(f"Invalid nextToken signature[{token}]")
+        cursor_kind, state = json.loads(
+            UdqCursor._b64decode(payload[len(UdqCursor.PREFIX):])
+        )
+        if kind is not None and cursor_kind != kind:
+            raise Exception(f"Unexpected nextToken kind[{cursor_kind}], expected {kind}")
+        return UdqCursor(cursor_kind, state)
+
+
 class IoTTwinMakerUnifiedDataQuery(ABC):
     """
     main entry point to UDQ wrapper, handles request/response unmarshalling/marshalling
     delegates to the connector author's Reader implementation to retrieve data rows from their data source
     delegates to the connector author's DataRow implementation to extract necessary fields for response construction
+
+    max_response_bytes optionally bounds the encoded size of the response JSON. When the rows of a response would
+    exceed it, the response is cut and its nextToken resumes at the first row not returned: the cursor returned by
+    IoTTwinMakerUdqResponse.resume if the connector supports it, otherwise a page cursor re-reading the same page
+
+    metrics_sink optionally receives the per-phase metrics of every invocation, see udq_metrics
     """
 
+    max_response_bytes = None
+    metrics_sink = None
+
     def process_query(self, lambda_event):
+        sink = self.metrics_sink
+        if sink is None:
+            return self._process_query(lambda_event, udq_metrics.DISABLED_METRICS)
+
+        metrics = udq_metrics.UdqMetrics()
+        metrics.dimensions["Connector"] = self.__class__.__name__
+        previous = udq_metrics.activate(metrics)
+        try:
+            return self._process_query(lambda_event, metrics)
+        except Exception:
+            metrics.add_count("errors")
+            raise
+        finally:
+            udq_metrics.activate(previous)
+            sink.emit(metrics)
+
+    def _process_query(self, lambda_event, metrics):
         from udq_utils.udq import SingleEntityReader, MultiEntityReader
 
+        # a page cursor is replaced by the nextToken of the page it resumes, the rows already returned are skipped
+        skip = 0
+        token = lambda_event.get("nextToken")
+        if UdqCursor.is_cursor(token):
+            cursor = UdqCursor.decode(token)
+            if cursor.kind == "page":
+                lambda_event = dict(lambda_event, nextToken=cursor.state["t"])
+                skip = cursor.state["s"]
+
         # parse the raw lambda event into a structured IoTTwinMakerUdqRequest request object
+        start = metrics.clock()
         request = IoTTwinMakerUdqRequest.parse(lambda_event)
+        metrics.add_duration("parse", start)
 
         # invoke the approriate entity reader function based on the request, or throw error if not supported
+        start = metrics.clock()
         if isinstance(request, IoTTwinMakerUDQEntityRequest):
+            metrics.dimensions["RequestType"] = "entity"
             if isinstance(self, SingleEntityReader):
                 udq_response = self.entity_query(request)
             else:
@@ -102,6 +315,7 @@ class IoTTwinMakerUnifiedDataQuery(ABC):
                     f"Received entity request but this processor ({self.__class__.__name__}) doesn't support it"
                 )
         elif isinstance(request, IoTTwinMakerUDQComponentTypeRequest):
+            metrics.dimensions["RequestType"] = "componentType"
             if isinstance(self, MultiEntityReader):
                 udq_response = self.component_type_query(request)
             else:
@@ -112,50 +326,109 @@ class IoTTwinMakerUnifiedDataQuery(ABC):
             raise NotImplementedError(
                 f"Received unknown UDQ request type: {lambda_event}"
             )
-
-        # inline helper to marshall python native types into common IoT TwinMaker types
-        def serialize_value(val):
-            if type(val) is str:
-                return {"stringValue": val}
-            elif type(val) is float:
-                return {
-                    "doubleValue": str(
-                        val
-                    )  # Note: the UDQ interface expects string value returns instead of JSON-native types
-                }
-            elif type(val) is bool:
-                return {"booleanValue": str(val)}
-            else:
-                assert False
-
-        # marshall data rows into property values grouped by entityPropertyReference
-        entity_prop_ref_to_values = {}
-        for row in udq_response.rows:
-            ref = row.get_iottwinmaker_reference()
-            if ref not in entity_prop_ref_to_values:
-                entity_prop_ref_to_values[ref] = []
-            ts = row.get_iso8601_timestamp()
-            if ts is None:
-                ts = row.get_timestamp().strftime("%Y-%m-%dT%H:%M:%S.000Z")
-            entity_prop_ref_to_values[ref].append(
-                {"time": ts, "value": serialize_value(row.get_value())}
+        metrics.add_duration("query", start)
+
+        next_token = udq_response.next_token if udq_response.next_token else None
+        rows = udq_response.rows
+        if skip:
+            rows = itertools.islice(rows, skip, None)
+
+        max_bytes = self.max_response_bytes
+        if max_bytes is not None:
+            # room for the nextToken: the one of the page, a connector cursor or a page cursor with any row count
+            max_bytes -= max(
+                len(encode_basestring_ascii(next_token or "")),
+                len(UdqCursor("page", {"t": request.next_token, "s": 10 ** 12}).encode()) + 2,
+                CURSOR_RESERVE_SIZE if udq_response.resume is not None else 0,
             )
 
-        # marshall the entity_prop_ref_to_values into response propertyValues structure
-        property_values = []
-        for ref in entity_prop_ref_to_values:
-            property_values.append(
-                {
-                    "entityPropertyReference": ref.serialize(),
-                    "values": entity_prop_ref_to_values[ref],
-                }
-            )
+        # rows are usually converted lazily while they are marshalled, that conversion time is not marshal time
+        start = metrics.clock()
+        conversion = metrics.get("conversion")
+        property_values, emitted, complete, size = self._marshall_rows(rows, max_bytes)
+        metrics.add_duration("marshal", start + (metrics.get("conversion") - conversion) / 1000.0)
+        metrics.add_count("rows", emitted)
+        if not complete:
+            next_token = None
+            if udq_response.resume is not None:
+                next_token = udq_response.resume(skip + emitted)
+            if next_token is None:
+                next_token = UdqCursor(
+                    "page", {"t": request.next_token, "s": skip + emitted}
+                ).encode()
 
         # marshall propertyValues and nextToken into final UDQ response
-        return {
+        response = {
             "propertyValues": property_values,
-            "nextToken": udq_response.next_token if udq_response.next_token else None,
+            "nextToken": next_token,
         }
+        if metrics.enabled:
+            if size is None:
+                size = len(json.dumps(response))
+            elif next_token is not None:
+                size += len(encode_basestring_ascii(next_token)) - len("null")
+            metrics.add_count("bytes", size)
+        return response
+
+    @staticmethod
+    def _marshall_rows(rows, max_bytes=None):
+        """
+        Marshalls data rows into property values grouped by entityPropertyReference
+
+        Each distinct reference is looked up and serialized once, its values are appended straight into the values list
+        of its propertyValues entry. Consecutive rows returning the same reference object skip the lookup
+        Rows are consumed one at a time, with max_bytes the encoded size of the response is tracked and the rows stop
+        before the one that would exceed it. At least one row is always returned
+
+        :return: (propertyValues, number of rows returned, True if all the rows were returned,
+                  encoded size of the response with a null nextToken if max_bytes is given, otherwise None)
+        """
+        property_values = []
+        ref_to_values = {}
+        last_ref = None
+        values = None
+        emitted = 0
+        size = RESPONSE_SIZE
+        for row in rows:
+            ref = row.get_iottwinmaker_reference()
+            new_values = None
+            if ref is not last_ref:
+                values = ref_to_values.get(ref)
+                if values is None:
+                    new_values = {"entityPropertyReference": ref.serialize(), "values": []}
+                    values = new_values["values"]
+            ts = row.get_iso8601_timestamp()
+            if ts is None:
+                ts = row.get_timestamp().strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            val = row.get_value()
+            value_type = VALUE_TYPES.get(type(val))
+            assert value_type is not None
+            key, to_string = value_type
+            value_string = to_string(val)
+
+            if max_bytes is not None:
+                row_size = (
+                    VALUE_ENTRY_SIZES[key]
+                    + len(encode_basestring_ascii(ts))
+                    + len(encode_basestring_ascii(value_string))
+                )
+                if values:
+                    row_size += SEPARATOR_SIZE
+                if new_values is not None:
+                    row_size += len(json.dumps(new_values))
+                    if property_values:
+                        row_size += SEPARATOR_SIZE
+                if emitted and size + row_size > max_bytes:
+                    return property_values, emitted, False, size
+                size += row_size
+
+            if new_values is not None:
+                ref_to_values[ref] = values
+                property_values.append(new_values)
+            last_ref = ref
+            values.append({"time": ts, "value": {key: value_string}})
+            emitted += 1
+        return property_values, emitted, True, size if max_bytes is not None else None
 
 
 class OrderBy(Enum):
@@ -176,6 +449,14 @@ class IoTTwinMakerUdqRequest:
         else:
             return dict[key]
 
+    @staticmethod
+    def get_optional_datetime(time_in_sec):
+        # optional since these fields are being replaced with startTime / endTime for better time precision
+        try:
+            return datetime.utcfromtimestamp(time_in_sec)
+        except:
+            return None
+
     @staticmethod
     def validate_timestamp(seconds_since_epoch):
         try:
@@ -212,7 +493,8 @@ class IoTTwinMakerUdqRequest:
         )
 
         # validate the selected properties
-        # verify each selected property is in the properties map from the event
+        # verify each selected property is in the properties map from the event, the connector checks them against
+        # its data source, e.g. the signal catalog allowlist of the data reader
         allowed_props = self._udq_context["properties"].keys()
         if len(self._selectedProperties) < 1:
             raise Exception(
@@ -228,16 +510,9 @@ class IoTTwinMakerUdqRequest:
                 )
 
         # deprecated: only used while startDateTime/endDateTime not yet replaced with startTime/endTime
-        def get_optional_datetime_field(event, field_name):
-            time_in_sec = IoTTwinMakerUdqRequest.get_required_field(event, field_name)
-            try:
-                return datetime.utcfromtimestamp(time_in_sec)
-            except:
-                return None
-
-        # optional since these fields are being replaced with startTime / endTime for better time precision
-        self._startDateTime = get_optional_datetime_field(self._event, "startDateTime")
-        self._endDateTime = get_optional_datetime_field(self._event, "endDateTime")
+        # converted to datetime on first access, see start_datetime / end_datetime
+        self._startDateTime = IoTTwinMakerUdqRequest.get_required_field(self._event, "startDateTime")
+        self._endDateTime = IoTTwinMakerUdqRequest.get_required_field(self._event, "endDateTime")
 
         self._startTime = IoTTwinMakerUdqRequest.get_required_field(
             self._event, "startTime"
@@ -304,7 +579,7 @@ class IoTTwinMakerUdqRequest:
         """
         The exclusive start time of the query
         """
-        return self._startDateTime
+        return IoTTwinMakerUdqRequest.get_optional_datetime(self._startDateTime)
 
     # deprecated, used end_time instead, which supports higher precision
     @property
@@ -312,7 +587,7 @@ class IoTTwinMakerUdqRequest:
         """
         The inclusive end time of the query
         """
-        return self._endDateTime
+        return IoTTwinMakerUdqRequest.get_optional_datetime(self._endDateTime)
 
     @property
     def start_time(self) -> str: